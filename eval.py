@@ -14,7 +14,8 @@ from datetime import datetime
 
 from src.models import shallow_conv, resnet_12, wide_resnet, dense_net
 from src.algorithm_trainer.algorithm_trainer import Meta_algorithm_trainer, Init_algorithm_trainer
-from src.algorithms.algorithm import SVM, ProtoNet, Ridge, InitBasedAlgorithm
+from src.algorithms.utils import Kernel
+from src.algorithms.algorithm import SVM, ProtoNet, Ridge, GDA, InitBasedAlgorithm, LogisticRegressionHead
 from src.optimizers import modified_sgd
 from src.data.dataset_managers import MetaDataLoader
 from src.data.datasets import MetaDataset, ClassImagesSet
@@ -70,7 +71,11 @@ def main(args):
     """
 
     print("\n", "--"*20, "BASE", "--"*20)
-    train_classes = ClassImagesSet(train_file, preload=str2bool(args.preload_train))
+    train_classes = ClassImagesSet(train_file, preload=str2bool(args.preload_train), packed=str2bool(args.packed_images),
+        preload_memory_budget=int(args.preload_memory_gb * 2 ** 30),
+        image_cache_budget=int(args.image_cache_gb * 2 ** 30), image_cache_shared=str2bool(args.image_cache_shared),
+        image_cache_slot_bytes=int(args.image_cache_slot_kb * 2 ** 10),
+        encoded_in_memory=str2bool(args.encoded_in_memory))
     
     # create a dataloader that has no fixed support
     no_fixS_train_meta_dataset = MetaDataset(
@@ -82,7 +87,8 @@ def main(args):
                                     query_aug=False,
                                     fix_support=0, # no fixed support
                                     save_folder='',
-                                    verbose=False)
+                                    verbose=False,
+                                    batched_transforms=str2bool(args.batched_augmentation))
 
     no_fixS_train_loader = MetaDataLoader(
                                 dataset=no_fixS_train_meta_dataset,
@@ -91,10 +97,16 @@ def main(args):
                                 n_way=args.n_way_val,
                                 n_shot=args.n_shot_val,
                                 n_query=args.n_query_val, 
-                                randomize_query=False)
+                                randomize_query=False,
+                                return_image_keys=str2bool(args.eval_embedding_cache),
+                                dedup_images=str2bool(args.eval_dedup_images))
 
     print("\n", "--"*20, "VAL", "--"*20)
-    val_classes = ClassImagesSet(val_file, preload=str2bool(args.preload_train))    
+    val_classes = ClassImagesSet(val_file, preload=str2bool(args.preload_train), packed=str2bool(args.packed_images),
+        preload_memory_budget=int(args.preload_memory_gb * 2 ** 30),
+        image_cache_budget=int(args.image_cache_gb * 2 ** 30), image_cache_shared=str2bool(args.image_cache_shared),
+        image_cache_slot_bytes=int(args.image_cache_slot_kb * 2 ** 10),
+        encoded_in_memory=str2bool(args.encoded_in_memory))    
     val_meta_datasets = {}
     val_loaders = {}
     for ns_val in all_n_shot_vals:
@@ -107,7 +119,8 @@ def main(args):
                                         support_aug=False,
                                         query_aug=False,
                                         fix_support=0,
-                                        save_folder='')
+                                        save_folder='',
+                                        batched_transforms=str2bool(args.batched_augmentation))
 
         val_loaders[ns_val] = MetaDataLoader(
                                 dataset=val_meta_datasets[ns_val],
@@ -116,10 +129,16 @@ def main(args):
                                 n_way=args.n_way_val,
                                 n_shot=ns_val,
                                 n_query=args.n_query_val, 
-                                randomize_query=False)
+                                randomize_query=False,
+                                return_image_keys=str2bool(args.eval_embedding_cache),
+                                dedup_images=str2bool(args.eval_dedup_images))
 
     print("\n", "--"*20, "NOVEL", "--"*20)
-    test_classes = ClassImagesSet(test_file, preload=str2bool(args.preload_train))
+    test_classes = ClassImagesSet(test_file, preload=str2bool(args.preload_train), packed=str2bool(args.packed_images),
+        preload_memory_budget=int(args.preload_memory_gb * 2 ** 30),
+        image_cache_budget=int(args.image_cache_gb * 2 ** 30), image_cache_shared=str2bool(args.image_cache_shared),
+        image_cache_slot_bytes=int(args.image_cache_slot_kb * 2 ** 10),
+        encoded_in_memory=str2bool(args.encoded_in_memory))
     test_meta_datasets = {}
     test_loaders = {}
     for ns_val in all_n_shot_vals:
@@ -132,7 +151,8 @@ def main(args):
                                         support_aug=False,
                                         query_aug=False,
                                         fix_support=0,
-                                        save_folder='')
+                                        save_folder='',
+                                        batched_transforms=str2bool(args.batched_augmentation))
 
         test_loaders[ns_val] = MetaDataLoader(
                                     dataset=test_meta_datasets[ns_val],
@@ -141,12 +161,18 @@ def main(args):
                                     n_way=args.n_way_val,
                                     n_shot=ns_val,
                                     n_query=args.n_query_val,
-                                    randomize_query=False,)
+                                    randomize_query=False,
+                                    return_image_keys=str2bool(args.eval_embedding_cache),
+                                    dedup_images=str2bool(args.eval_dedup_images))
 
     if base_class_generalization:
         # can only do this if there is only one type of evaluation
         print("\n", "--"*20, "BASE TEST", "--"*20)
-        base_test_classes = ClassImagesSet(base_test_file, preload=str2bool(args.preload_train))
+        base_test_classes = ClassImagesSet(base_test_file, preload=str2bool(args.preload_train), packed=str2bool(args.packed_images),
+        preload_memory_budget=int(args.preload_memory_gb * 2 ** 30),
+        image_cache_budget=int(args.image_cache_gb * 2 ** 30), image_cache_shared=str2bool(args.image_cache_shared),
+        image_cache_slot_bytes=int(args.image_cache_slot_kb * 2 ** 10),
+        encoded_in_memory=str2bool(args.encoded_in_memory))
         
         # if args.fix_support > 0:
         #     base_test_meta_dataset_using_fixS = MetaDataset(
@@ -174,7 +200,10 @@ def main(args):
         assert len(set(base_test_classes.keys()).intersection(set(test_classes.keys()))) == 0,\
             f"the base and novel classes must have different ids, base:{set(base_test_classes.keys())}, novel: f{set(test_classes.keys())}"
         # combine both base and novel classes
-        base_novel_test_classes = ClassImagesSet(base_test_file, test_file)
+        base_novel_test_classes = ClassImagesSet(base_test_file, test_file, packed=str2bool(args.packed_images),
+            image_cache_budget=int(args.image_cache_gb * 2 ** 30), image_cache_shared=str2bool(args.image_cache_shared),
+            image_cache_slot_bytes=int(args.image_cache_slot_kb * 2 ** 10),
+            encoded_in_memory=str2bool(args.encoded_in_memory))
         base_novel_test_meta_dataset = MetaDataset(
                                     dataset_name=dataset_name,
                                     support_class_images_set=base_novel_test_classes,
@@ -183,7 +212,8 @@ def main(args):
                                     support_aug=False,
                                     query_aug=False,
                                     fix_support=0,
-                                    save_folder='')
+                                    save_folder='',
+                                    batched_transforms=str2bool(args.batched_augmentation))
 
         # sample classes from base and novel with mix prob. given by lambd
         base_novel_test_loaders_dict = {}
@@ -199,7 +229,9 @@ def main(args):
                 p_dict={
                     k: ((1-lambd) / len(base_test_classes) if k in base_test_classes else lambd / len(test_classes))
                         for k in list(base_test_classes) + list(test_classes)
-                }
+                },
+                return_image_keys=str2bool(args.eval_embedding_cache),
+                dedup_images=str2bool(args.eval_dedup_images)
             )
 
 
@@ -275,6 +307,13 @@ def main(args):
     ####################################################
 
     # algorithm
+    # kernel of the SVM, Ridge and ProtoNet heads
+    kernel = Kernel(
+        name=args.kernel,
+        gamma=args.kernel_gamma,
+        degree=args.kernel_degree,
+        approximation=args.kernel_approximation,
+        n_components=args.kernel_n_components)
     if args.algorithm == 'InitBasedAlgorithm':
         algorithm = InitBasedAlgorithm(
             model=model,
@@ -283,25 +322,59 @@ def main(args):
             alpha=args.alpha,
             inner_loop_grad_clip=args.grad_clip_inner,
             inner_update_method=args.inner_update_method,
+            imaml_lambda=args.imaml_lambda,
+            imaml_cg_steps=args.imaml_cg_steps,
+            checkpoint_segment_length=args.maml_checkpoint_segment,
+            adapted_layers=args.adapted_layers,
+            inner_loop_tol=args.inner_loop_tol,
+            inner_loop_criterion=args.inner_loop_criterion,
+            hessian_vector_product=args.maml_hessian_vector_product,
+            finite_difference_epsilon=args.maml_finite_difference_epsilon,
             device='cuda')
+        if 'inner_lrs' in chkpt:
+            algorithm.load_inner_update_parameters(chkpt['inner_lrs'])
     elif args.algorithm == 'ProtoNet':
         algorithm = ProtoNet(
             model=model,
             inner_loss_func=torch.nn.CrossEntropyLoss(),
             device='cuda',
             scale=args.scale_factor,
-            metric=args.classifier_metric)
+            metric=args.classifier_metric,
+            kernel=kernel)
     elif args.algorithm == 'SVM':
         algorithm = SVM(
             model=model,
             inner_loss_func=torch.nn.CrossEntropyLoss(),
             scale=args.scale_factor,
+            solver=args.svm_solver,
+            solver_tol=args.svm_solver_tol,
+            solver_max_iter=args.svm_solver_max_iter,
+            implicit_grad=str2bool(args.svm_implicit_grad),
+            kernel=kernel,
             device='cuda')
     elif args.algorithm == 'Ridge':
         algorithm = Ridge(
             model=model,
             inner_loss_func=torch.nn.CrossEntropyLoss(),
             scale=args.scale_factor,
+            kernel=kernel,
+            device='cuda')
+    elif args.algorithm == 'GDA':
+        algorithm = GDA(
+            model=model,
+            inner_loss_func=torch.nn.CrossEntropyLoss(),
+            scale=args.scale_factor,
+            shrinkage=args.gda_shrinkage,
+            device='cuda')
+    elif args.algorithm == 'LogisticRegression':
+        algorithm = LogisticRegressionHead(
+            model=model,
+            inner_loss_func=torch.nn.CrossEntropyLoss(),
+            scale=args.scale_factor,
+            lambda_reg=args.logistic_regression_lambda,
+            solver=args.logistic_regression_solver,
+            max_iter=args.logistic_regression_max_iter,
+            hessian_solver=args.logistic_regression_hessian_solver,
             device='cuda')
     else:
         raise ValueError(
@@ -316,7 +389,8 @@ def main(args):
             log_interval=args.log_interval, 
             save_folder='', 
             grad_clip=None,
-            init_global_iteration=None)
+            init_global_iteration=None,
+            embedding_cache=str2bool(args.eval_embedding_cache))
     else:
         trainer = Init_algorithm_trainer(
             algorithm=algorithm,
@@ -327,7 +401,8 @@ def main(args):
             grad_clip=None,
             num_updates_inner_train=args.num_updates_inner_train,
             num_updates_inner_val=args.num_updates_inner_val,
-            init_global_iteration=None)
+            init_global_iteration=None,
+            vectorize_tasks=str2bool(args.vectorize_tasks))
 
 
     ####################################################
@@ -423,7 +498,7 @@ if __name__ == '__main__':
     parser.add_argument('--alpha', type=float, default=0.0,
         help='inner learning rate for init based methods')
     parser.add_argument('--init-meta-algorithm', type=str, default='MAML',
-        help='MAML/Reptile/FOMAML')
+        help='MAML/Reptile/FOMAML/iMAML')
     parser.add_argument('--grad-clip-inner', type=float, default=0.0,
         help='gradient clip value in inner loop')
     parser.add_argument('--num-updates-inner-train', type=int, default=1,
@@ -431,7 +506,69 @@ if __name__ == '__main__':
     parser.add_argument('--num-updates-inner-val', type=int, default=1,
         help='number of updates in inner loop val')
     parser.add_argument('--inner-update-method', type=str, default='sgd',
-        help='inner update method can be sgd or adam')
+        help='inner update method can be sgd, adam or metasgd (per parameter step sizes meta-learned with MAML)')
+    parser.add_argument('--imaml-lambda', type=float, default=1.0,
+        help='iMAML proximal regularization strength')
+    parser.add_argument('--imaml-cg-steps', type=int, default=5,
+        help='iMAML number of conjugate gradient steps for the meta-gradient')
+    parser.add_argument('--maml-checkpoint-segment', type=int, default=0,
+        help='MAML: number of inner steps between stored checkpoints, the inner loop is recomputed '
+             'segment by segment for the outer gradient (0 to keep the whole graph)')
+    parser.add_argument('--maml-hessian-vector-product', type=str, default='exact',
+        help='MAML: exact (second order graph of the inner loop) or finite_difference (two extra first order '
+             'gradients per inner step, FOMAML memory; noisy across the kinks of ReLU/max pool backbones)')
+    parser.add_argument('--maml-finite-difference-epsilon', type=float, default=0.01,
+        help='MAML finite_difference: norm of the parameter perturbation of the central difference')
+    parser.add_argument('--adapted-layers', type=str, default='all',
+        help='MAML/FOMAML: comma separated parameter name prefixes updated in the inner loop '
+             '(e.g. fc for ANIL, whose features are computed once per task, or layer4,fc for resnet_12, '
+             'whose frozen layer1-3 run once per task), all for every parameter')
+    parser.add_argument('--inner-loop-tol', type=float, default=0.,
+        help='MAML/Reptile/FOMAML/iMAML: stop the inner loop of a task before the maximum number of '
+             'inner steps once the convergence criterion falls below this tolerance (0 to always run every step)')
+    parser.add_argument('--inner-loop-criterion', type=str, default='grad_norm',
+        help='inner loop convergence criterion: decrease of the support loss in one step or norm of the support gradient')
+    parser.add_argument('--vectorize-tasks', type=str, default="False",
+        help='adapt all the tasks of a task batch at once (vmap over per task parameters and batch norm buffers), '
+            'not supported by resnet_12 with dropout/DropBlock')
+
+
+    # SVM head
+    parser.add_argument('--kernel', type=str, default='linear',
+        help='kernel of the SVM, Ridge and ProtoNet heads: linear, rbf or poly')
+    parser.add_argument('--kernel-gamma', type=float, default=None,
+        help='width of the rbf and poly kernels, 1 / (d * support feature variance) of each task if not set')
+    parser.add_argument('--kernel-degree', type=int, default=3,
+        help='degree of the poly kernel')
+    parser.add_argument('--kernel-approximation', type=str, default='exact',
+        help='exact kernel matrices or an explicit feature map of linear cost in the number of support examples: '
+             'exact, nystrom or random_features (rbf only)')
+    parser.add_argument('--kernel-n-components', type=int, default=256,
+        help='number of nystrom landmarks or random features of the kernel approximation')
+    parser.add_argument('--svm-solver', type=str, default='qpth',
+        help='solver for the SVM dual: qpth/fista')
+    parser.add_argument('--svm-solver-tol', type=float, default=1e-4,
+        help='convergence tolerance of the fista SVM solver')
+    parser.add_argument('--svm-solver-max-iter', type=int, default=1000,
+        help='maximum number of iterations of the fista SVM solver')
+    parser.add_argument('--svm-implicit-grad', type=str, default="False",
+        help='backpropagate through the qpth SVM solution with implicit differentiation of the KKT conditions '
+             '(always the case for fista)')
+    parser.add_argument('--logistic-regression-solver', type=str, default='newton',
+        help='LogisticRegression head solver, newton or lbfgs (batched over the tasks)')
+    parser.add_argument('--logistic-regression-lambda', type=float, default=0.1,
+        help='LogisticRegression head L2 regularization of the mean cross entropy')
+    parser.add_argument('--logistic-regression-max-iter', type=int, default=20,
+        help='LogisticRegression head maximum number of solver iterations')
+    parser.add_argument('--logistic-regression-hessian-solver', type=str, default='cg',
+        help='LogisticRegression head linear solves with the hessian (newton steps and implicit gradient): '
+             'cg (matrix-free conjugate gradient) or woodbury (direct N(C+1) x N(C+1) solve)')
+    parser.add_argument('--gda-shrinkage', type=float, default=0.5,
+        help='GDA head shrinkage in (0, 1] of the shared covariance towards a scaled identity')
+    parser.add_argument('--eval-embedding-cache', type=str, default="False",
+        help='cache the backbone features of (non-augmented) evaluation images and reuse them across tasks')
+    parser.add_argument('--eval-dedup-images', type=str, default="False",
+        help='run the backbone once per distinct (non-augmented) image of an evaluation task batch')
 
 
     # Dataset
@@ -473,6 +610,22 @@ if __name__ == '__main__':
     parser.add_argument('--n-iterations-val', type=int, default=100,
         help='no. of iterations validation.') 
     parser.add_argument('--preload-train', type=str, default="True")
+    parser.add_argument('--batched-augmentation', type=str, default="False",
+        help='transform the images of a whole task batch at once with tensor operations instead of per-image PIL transforms')
+    parser.add_argument('--preload-memory-gb', type=float, default=0.,
+        help='maximum GB of decoded images preloaded for each split, the rest is loaded lazily (0 for no limit)')
+    parser.add_argument('--encoded-in-memory', type=str, default="False",
+        help='keep the encoded bytes of every image file in memory and decode them from there instead of reading the disk')
+    parser.add_argument('--image-cache-gb', type=float, default=0.,
+        help='GB of lazily loaded images kept decoded in an LRU cache (per loader worker unless shared, the workers '
+             'then persist across epochs to keep their caches), 0 for no cache')
+    parser.add_argument('--image-cache-shared', type=str, default="False",
+        help='one decoded image cache in shared memory for all the loader workers')
+    parser.add_argument('--image-cache-slot-kb', type=float, default=0.,
+        help='KB of each slot of the shared image cache, larger images are not cached '
+             '(0 for the largest of a sample of the images)')
+    parser.add_argument('--packed-images', type=str, default="False",
+        help='read the images from the memory-mapped stores written by python -m src.data.image_store')
     parser.add_argument('--eot-model', type=str, default="False")
 
 
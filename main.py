@@ -16,8 +16,10 @@ import pytz
 
 
 from src.models import shallow_conv, resnet_12, wide_resnet, dense_net
-from src.algorithm_trainer.algorithm_trainer import Meta_algorithm_trainer, Init_algorithm_trainer, TL_algorithm_trainer
-from src.algorithms.algorithm import SVM, ProtoNet, Ridge, InitBasedAlgorithm
+from src.algorithm_trainer.algorithm_trainer import Meta_algorithm_trainer, Init_algorithm_trainer, TL_algorithm_trainer, \
+    Async_reptile_trainer
+from src.algorithms.utils import Kernel
+from src.algorithms.algorithm import SVM, ProtoNet, Ridge, GDA, InitBasedAlgorithm, LogisticRegressionHead
 from src.optimizers import modified_sgd
 from src.data.dataset_managers import MetaDataLoader
 from src.data.datasets import MetaDataset, ClassImagesSet, SimpleDataset
@@ -97,7 +99,11 @@ def main(args):
     """
 
     print("\n", "--"*20, "TRAIN", "--"*20)
-    train_classes = ClassImagesSet(train_file, preload=str2bool(args.preload_train))
+    train_classes = ClassImagesSet(train_file, preload=str2bool(args.preload_train), packed=str2bool(args.packed_images),
+        preload_memory_budget=int(args.preload_memory_gb * 2 ** 30),
+        image_cache_budget=int(args.image_cache_gb * 2 ** 30), image_cache_shared=str2bool(args.image_cache_shared),
+        image_cache_slot_bytes=int(args.image_cache_slot_kb * 2 ** 10),
+        encoded_in_memory=str2bool(args.encoded_in_memory))
     if args.algorithm == 'TransferLearning':
         """
         For Transfer Learning we create a SimpleDataset.
@@ -113,7 +119,8 @@ def main(args):
                             train_dataset, 
                             batch_size=args.batch_size_train, 
                             shuffle=True,
-                            num_workers=6)
+                            num_workers=6,
+                            persistent_workers=train_classes.has_per_worker_image_cache())
 
     else:
         train_meta_dataset = MetaDataset(
@@ -125,7 +132,8 @@ def main(args):
                                 query_aug=str2bool(args.query_aug),
                                 fix_support=args.fix_support,
                                 save_folder=save_folder,
-                                fix_support_path=args.fix_support_path)
+                                fix_support_path=args.fix_support_path,
+                                batched_transforms=str2bool(args.batched_augmentation))
 
         train_loader = MetaDataLoader(
                             dataset=train_meta_dataset,
@@ -134,7 +142,8 @@ def main(args):
                             n_way=args.n_way_train,
                             n_shot=args.n_shot_train,
                             n_query=args.n_query_train,
-                            randomize_query=str2bool(args.randomize_query))
+                            randomize_query=str2bool(args.randomize_query),
+                            dedup_images=str2bool(args.train_dedup_images))
 
     # create a dataloader that has no fixed support
     no_fixS_train_meta_dataset = MetaDataset(
@@ -146,7 +155,8 @@ def main(args):
                                     query_aug=False,
                                     fix_support=0, # no fixed support
                                     save_folder='',
-                                    verbose=False)
+                                    verbose=False,
+                                    batched_transforms=str2bool(args.batched_augmentation))
 
     no_fixS_train_loader = MetaDataLoader(
                                 dataset=no_fixS_train_meta_dataset,
@@ -155,10 +165,15 @@ def main(args):
                                 n_way=args.n_way_val,
                                 n_shot=args.n_shot_val,
                                 n_query=args.n_query_val, 
-                                randomize_query=False)
+                                randomize_query=False,
+                                return_image_keys=str2bool(args.eval_embedding_cache),
+                                dedup_images=str2bool(args.eval_dedup_images))
 
     print("\n", "--"*20, "VAL", "--"*20)
-    val_classes = ClassImagesSet(val_file, preload=False)    
+    val_classes = ClassImagesSet(val_file, preload=False, packed=str2bool(args.packed_images),
+        image_cache_budget=int(args.image_cache_gb * 2 ** 30), image_cache_shared=str2bool(args.image_cache_shared),
+        image_cache_slot_bytes=int(args.image_cache_slot_kb * 2 ** 10),
+        encoded_in_memory=str2bool(args.encoded_in_memory))    
     val_meta_datasets = {}
     val_loaders = {}
     for ns_val in all_n_shot_vals:
@@ -171,7 +186,8 @@ def main(args):
                                         support_aug=False,
                                         query_aug=False,
                                         fix_support=0,
-                                        save_folder='')
+                                        save_folder='',
+                                        batched_transforms=str2bool(args.batched_augmentation))
 
         val_loaders[ns_val] = MetaDataLoader(
                                 dataset=val_meta_datasets[ns_val],
@@ -180,10 +196,15 @@ def main(args):
                                 n_way=args.n_way_val,
                                 n_shot=ns_val,
                                 n_query=args.n_query_val, 
-                                randomize_query=False)
+                                randomize_query=False,
+                                return_image_keys=str2bool(args.eval_embedding_cache),
+                                dedup_images=str2bool(args.eval_dedup_images))
 
     print("\n", "--"*20, "TEST", "--"*20)
-    test_classes = ClassImagesSet(test_file)
+    test_classes = ClassImagesSet(test_file, packed=str2bool(args.packed_images),
+        image_cache_budget=int(args.image_cache_gb * 2 ** 30), image_cache_shared=str2bool(args.image_cache_shared),
+        image_cache_slot_bytes=int(args.image_cache_slot_kb * 2 ** 10),
+        encoded_in_memory=str2bool(args.encoded_in_memory))
     test_meta_datasets = {}
     test_loaders = {}
     for ns_val in all_n_shot_vals:
@@ -196,7 +217,8 @@ def main(args):
                                         support_aug=False,
                                         query_aug=False,
                                         fix_support=0,
-                                        save_folder='')
+                                        save_folder='',
+                                        batched_transforms=str2bool(args.batched_augmentation))
 
         test_loaders[ns_val] = MetaDataLoader(
                                     dataset=test_meta_datasets[ns_val],
@@ -205,12 +227,17 @@ def main(args):
                                     n_way=args.n_way_val,
                                     n_shot=ns_val,
                                     n_query=args.n_query_val,
-                                    randomize_query=False,)
+                                    randomize_query=False,
+                                    return_image_keys=str2bool(args.eval_embedding_cache),
+                                    dedup_images=str2bool(args.eval_dedup_images))
 
     if base_class_generalization:
         # can only do this if there is only one type of evaluation
         print("\n", "--"*20, "BASE TEST", "--"*20)
-        base_test_classes = ClassImagesSet(base_test_file)
+        base_test_classes = ClassImagesSet(base_test_file, packed=str2bool(args.packed_images),
+            image_cache_budget=int(args.image_cache_gb * 2 ** 30), image_cache_shared=str2bool(args.image_cache_shared),
+            image_cache_slot_bytes=int(args.image_cache_slot_kb * 2 ** 10),
+            encoded_in_memory=str2bool(args.encoded_in_memory))
         base_test_meta_dataset = MetaDataset(
                                     dataset_name=dataset_name,
                                     support_class_images_set=base_test_classes,
@@ -219,7 +246,8 @@ def main(args):
                                     support_aug=False,
                                     query_aug=False,
                                     fix_support=0,
-                                    save_folder=save_folder)
+                                    save_folder=save_folder,
+                                    batched_transforms=str2bool(args.batched_augmentation))
         base_test_loader = MetaDataLoader(
                                 dataset=base_test_meta_dataset,
                                 n_batches=args.n_iterations_val,
@@ -227,7 +255,9 @@ def main(args):
                                 n_way=args.n_way_val,
                                 n_shot=args.n_shot_val,
                                 n_query=args.n_query_val, 
-                                randomize_query=False)
+                                randomize_query=False,
+                                return_image_keys=str2bool(args.eval_embedding_cache),
+                                dedup_images=str2bool(args.eval_dedup_images))
 
 
         if args.fix_support > 0:
@@ -239,7 +269,8 @@ def main(args):
                                                     query_aug=False,
                                                     fix_support=0,
                                                     save_folder=save_folder, 
-                                                    fix_support_path=os.path.join(save_folder, "fixed_support_pool.pkl"))
+                                                    fix_support_path=os.path.join(save_folder, "fixed_support_pool.pkl"),
+                                                    batched_transforms=str2bool(args.batched_augmentation))
 
             base_test_loader_using_fixS = MetaDataLoader(
                                             dataset=base_test_meta_dataset_using_fixS,
@@ -248,7 +279,9 @@ def main(args):
                                             n_way=args.n_way_val,
                                             n_shot=args.n_shot_val,
                                             n_query=args.n_query_val, 
-                                            randomize_query=False,)
+                                            randomize_query=False,
+                                            return_image_keys=str2bool(args.eval_embedding_cache),
+                                            dedup_images=str2bool(args.eval_dedup_images))
                                             
 
     ####################################################
@@ -285,6 +318,137 @@ def main(args):
 
 
 
+    ####################################################
+    #                LOAD FROM CHECKPOINT              #
+    ####################################################
+
+    if args.checkpoint != '':
+        print(f"loading model from {args.checkpoint}")
+        model_dict = model.state_dict() # new model's state dict
+        chkpt = torch.load(args.checkpoint, map_location=torch.device('cpu'))
+
+        ### load model
+        chkpt_state_dict = chkpt['model']
+        chkpt_state_dict_old_keys = list(chkpt_state_dict.keys())
+        # remove "module." from key, possibly present as it was dumped by data-parallel
+        for key in chkpt_state_dict_old_keys:
+            if 'module.' in key:
+                new_key = re.sub('module\.', '',  key)
+                chkpt_state_dict[new_key] = chkpt_state_dict.pop(key)
+        load_model_state_dict = {k: v for k, v in chkpt_state_dict.items() if k in model_dict}
+        model_dict.update(load_model_state_dict)
+        # updated_keys = set(model_dict).intersection(set(chkpt_state_dict))
+        print(f"Updated {len(load_model_state_dict.keys())} keys using chkpt")
+        print("Following keys updated :", "\n".join(sorted(load_model_state_dict.keys())))
+        missed_keys = set(model_dict).difference(set(load_model_state_dict))
+        print(f"Missed {len(missed_keys)} keys")
+        print("Following keys missed :", "\n".join(sorted(missed_keys)))
+        model.load_state_dict(model_dict)
+
+    ### Multi-gpu support and device setup
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.device_number
+    print('Using GPUs: ', os.environ["CUDA_VISIBLE_DEVICES"])
+    # move model to cuda
+    model = torch.nn.DataParallel(model, device_ids=range(torch.cuda.device_count()))
+    model.cuda()
+    print("Successfully moved the model to cuda")
+
+
+    ####################################################
+    #                ALGORITHM CREATION                #
+    ####################################################
+
+    # start tboard from restart iter
+    init_global_iteration = 0
+    if args.restart_iter:
+        init_global_iteration = args.restart_iter * args.n_iters_per_epoch 
+
+    # algorithm
+    # kernel of the SVM, Ridge and ProtoNet heads
+    kernel = Kernel(
+        name=args.kernel,
+        gamma=args.kernel_gamma,
+        degree=args.kernel_degree,
+        approximation=args.kernel_approximation,
+        n_components=args.kernel_n_components)
+    if args.algorithm == 'InitBasedAlgorithm':
+        algorithm = InitBasedAlgorithm(
+            model=model,
+            loss_func=torch.nn.CrossEntropyLoss(),
+            method=args.init_meta_algorithm,
+            alpha=args.alpha,
+            inner_loop_grad_clip=args.grad_clip_inner,
+            inner_update_method=args.inner_update_method,
+            imaml_lambda=args.imaml_lambda,
+            imaml_cg_steps=args.imaml_cg_steps,
+            checkpoint_segment_length=args.maml_checkpoint_segment,
+            adapted_layers=args.adapted_layers,
+            inner_loop_tol=args.inner_loop_tol,
+            inner_loop_criterion=args.inner_loop_criterion,
+            hessian_vector_product=args.maml_hessian_vector_product,
+            finite_difference_epsilon=args.maml_finite_difference_epsilon,
+            device='cuda')
+        if args.checkpoint != '' and 'inner_lrs' in chkpt:
+            algorithm.load_inner_update_parameters(chkpt['inner_lrs'])
+    elif args.algorithm == 'ProtoNet':
+        algorithm = ProtoNet(
+            model=model,
+            inner_loss_func=torch.nn.CrossEntropyLoss(),
+            device='cuda',
+            scale=args.scale_factor,
+            metric=args.classifier_metric,
+            kernel=kernel)
+    elif args.algorithm == 'SVM':
+        algorithm = SVM(
+            model=model,
+            inner_loss_func=torch.nn.CrossEntropyLoss(),
+            scale=args.scale_factor,
+            solver=args.svm_solver,
+            solver_tol=args.svm_solver_tol,
+            solver_max_iter=args.svm_solver_max_iter,
+            implicit_grad=str2bool(args.svm_implicit_grad),
+            kernel=kernel,
+            device='cuda')
+    elif args.algorithm == 'Ridge':
+        algorithm = Ridge(
+            model=model,
+            inner_loss_func=torch.nn.CrossEntropyLoss(),
+            scale=args.scale_factor,
+            kernel=kernel,
+            device='cuda')
+    elif args.algorithm == 'GDA':
+        algorithm = GDA(
+            model=model,
+            inner_loss_func=torch.nn.CrossEntropyLoss(),
+            scale=args.scale_factor,
+            shrinkage=args.gda_shrinkage,
+            device='cuda')
+    elif args.algorithm == 'LogisticRegression':
+        algorithm = LogisticRegressionHead(
+            model=model,
+            inner_loss_func=torch.nn.CrossEntropyLoss(),
+            scale=args.scale_factor,
+            lambda_reg=args.logistic_regression_lambda,
+            solver=args.logistic_regression_solver,
+            max_iter=args.logistic_regression_max_iter,
+            hessian_solver=args.logistic_regression_hessian_solver,
+            device='cuda')
+    elif args.algorithm == 'TransferLearning':
+        """
+        We use the ProtoNet algorithm at test time.
+        """
+        algorithm = ProtoNet(
+            model=model,
+            inner_loss_func=torch.nn.CrossEntropyLoss(),
+            device='cuda',
+            scale=args.scale_factor,
+            metric=args.classifier_metric,
+            kernel=kernel)
+    else:
+        raise ValueError(
+            'Unrecognized algorithm {}'.format(args.algorithm))
+
+
     ####################################################
     #                OPTIMIZER CREATION                #
     ####################################################
@@ -301,6 +465,11 @@ def main(args):
             {'params': model.parameters(), 'lr': args.lr,
             'weight_decay': args.weight_decay, 'momentum': 0.9, 'nesterov': True},
         ])
+    if args.algorithm == 'InitBasedAlgorithm' and len(algorithm.inner_update_parameters()) > 0:
+        # meta-learned inner step sizes (metasgd) are trained along with the model,
+        # the group is added before the lr scheduler and the checkpoint's optimizer state
+        optimizer.add_param_group(
+            {'params': algorithm.inner_update_parameters(), 'lr': args.lr, 'weight_decay': 0.})
     print("Total n_epochs: ", args.n_epochs)   
 
     # learning rate scheduler creation
@@ -358,51 +527,21 @@ def main(args):
 
 
     ####################################################
-    #                LOAD FROM CHECKPOINT              #
+    #           LOAD OPTIMIZER FROM CHECKPOINT         #
     ####################################################
 
     if args.checkpoint != '':
-        print(f"loading model from {args.checkpoint}")
-        model_dict = model.state_dict() # new model's state dict
-        chkpt = torch.load(args.checkpoint, map_location=torch.device('cpu'))
-
-        ### load model
-        chkpt_state_dict = chkpt['model']
-        chkpt_state_dict_old_keys = list(chkpt_state_dict.keys())
-        # remove "module." from key, possibly present as it was dumped by data-parallel
-        for key in chkpt_state_dict_old_keys:
-            if 'module.' in key:
-                new_key = re.sub('module\.', '',  key)
-                chkpt_state_dict[new_key] = chkpt_state_dict.pop(key)
-        load_model_state_dict = {k: v for k, v in chkpt_state_dict.items() if k in model_dict}
-        model_dict.update(load_model_state_dict)
-        # updated_keys = set(model_dict).intersection(set(chkpt_state_dict))
-        print(f"Updated {len(load_model_state_dict.keys())} keys using chkpt")
-        print("Following keys updated :", "\n".join(sorted(load_model_state_dict.keys())))
-        missed_keys = set(model_dict).difference(set(load_model_state_dict))
-        print(f"Missed {len(missed_keys)} keys")
-        print("Following keys missed :", "\n".join(sorted(missed_keys)))
-        model.load_state_dict(model_dict)
-
         ### load optimizer
         try:
             print(f"loading optimizer from {args.checkpoint}")
             optimizer.load_state_dict(chkpt['optimizer'].state_dict())
             print("Successfully loaded optimizer")
 
-        except:
-            print("Failed to load optimizer")
-        
-    ### Multi-gpu support and device setup
-    os.environ["CUDA_VISIBLE_DEVICES"] = args.device_number
-    print('Using GPUs: ', os.environ["CUDA_VISIBLE_DEVICES"])
-    # move model to cuda
-    model = torch.nn.DataParallel(model, device_ids=range(torch.cuda.device_count()))
-    model.cuda()
-    print("Successfully moved the model to cuda")
+        except (KeyError, ValueError) as e:
+            # e.g. a checkpoint saved with a different number of param groups
+            print(f"Failed to load optimizer: {e!r}")
 
-    # move the optimizer's states to cuda if loaded
-    if args.checkpoint != '':
+        # move the optimizer's states to cuda if loaded
         # https://github.com/pytorch/pytorch/issues/2830
         # when using gpu, need to move all the statistics of the optimizer to cuda
         # in addition to the model parameters
@@ -414,59 +553,24 @@ def main(args):
 
 
     ####################################################
-    #        ALGORITHM AND ALGORITHM TRAINER           #
+    #                ALGORITHM TRAINER                 #
     ####################################################
 
-    # start tboard from restart iter
-    init_global_iteration = 0
-    if args.restart_iter:
-        init_global_iteration = args.restart_iter * args.n_iters_per_epoch 
 
-    # algorithm
-    if args.algorithm == 'InitBasedAlgorithm':
-        algorithm = InitBasedAlgorithm(
-            model=model,
-            loss_func=torch.nn.CrossEntropyLoss(),
-            method=args.init_meta_algorithm,
-            alpha=args.alpha,
-            inner_loop_grad_clip=args.grad_clip_inner,
-            inner_update_method=args.inner_update_method,
-            device='cuda')
-    elif args.algorithm == 'ProtoNet':
-        algorithm = ProtoNet(
-            model=model,
-            inner_loss_func=torch.nn.CrossEntropyLoss(),
-            device='cuda',
-            scale=args.scale_factor,
-            metric=args.classifier_metric)
-    elif args.algorithm == 'SVM':
-        algorithm = SVM(
-            model=model,
-            inner_loss_func=torch.nn.CrossEntropyLoss(),
-            scale=args.scale_factor,
-            device='cuda')
-    elif args.algorithm == 'Ridge':
-        algorithm = Ridge(
-            model=model,
-            inner_loss_func=torch.nn.CrossEntropyLoss(),
-            scale=args.scale_factor,
-            device='cuda')
-    elif args.algorithm == 'TransferLearning':
-        """
-        We use the ProtoNet algorithm at test time.
-        """
-        algorithm = ProtoNet(
-            model=model,
-            inner_loss_func=torch.nn.CrossEntropyLoss(),
-            device='cuda',
-            scale=args.scale_factor,
-            metric=args.classifier_metric)
-    else:
-        raise ValueError(
-            'Unrecognized algorithm {}'.format(args.algorithm))
-
-
-    if args.algorithm == 'InitBasedAlgorithm':
+    if args.algorithm == 'InitBasedAlgorithm' and args.async_reptile_workers > 0:
+        trainer = Async_reptile_trainer(
+            algorithm=algorithm,
+            optimizer=optimizer,
+            writer=writer,
+            log_interval=args.log_interval, 
+            save_folder=save_folder, 
+            grad_clip=args.grad_clip,
+            num_updates_inner_train=args.num_updates_inner_train,
+            num_updates_inner_val=args.num_updates_inner_val,
+            init_global_iteration=init_global_iteration,
+            n_workers=args.async_reptile_workers,
+            max_staleness=args.async_reptile_max_staleness)
+    elif args.algorithm == 'InitBasedAlgorithm':
         trainer = Init_algorithm_trainer(
             algorithm=algorithm,
             optimizer=optimizer,
@@ -476,7 +580,8 @@ def main(args):
             grad_clip=args.grad_clip,
             num_updates_inner_train=args.num_updates_inner_train,
             num_updates_inner_val=args.num_updates_inner_val,
-            init_global_iteration=init_global_iteration)
+            init_global_iteration=init_global_iteration,
+            vectorize_tasks=str2bool(args.vectorize_tasks))
     elif args.algorithm == 'TransferLearning':
         trainer = TL_algorithm_trainer(
             algorithm=algorithm,
@@ -485,7 +590,8 @@ def main(args):
             log_interval=args.log_interval, 
             save_folder=save_folder, 
             grad_clip=args.grad_clip,
-            init_global_iteration=init_global_iteration
+            init_global_iteration=init_global_iteration,
+            embedding_cache=str2bool(args.eval_embedding_cache)
         )
     else:        
         trainer = Meta_algorithm_trainer(
@@ -495,7 +601,8 @@ def main(args):
             log_interval=args.log_interval, 
             save_folder=save_folder, 
             grad_clip=args.grad_clip,
-            init_global_iteration=init_global_iteration)
+            init_global_iteration=init_global_iteration,
+            embedding_cache=str2bool(args.eval_embedding_cache))
         
 
     ####################################################
@@ -515,6 +622,11 @@ def main(args):
             mt_loader=train_loader,
             is_training=True,
             epoch=iter_start + 1) # 1 based instead of 0 based
+        if train_classes.image_cache is not None:
+            cache_stats = train_classes.image_cache.stats()
+            print("train image cache:", pprint.pformat(cache_stats))
+            writer.add_scalar(
+                "train_image_cache_hit_rate", cache_stats['hit_rate'], iter_start + 1)
 
         if iter_start % args.val_frequency == 0:
             # On ML train objective
@@ -639,7 +751,7 @@ if __name__ == '__main__':
     parser.add_argument('--alpha', type=float, default=0.0,
         help='inner learning rate for init based methods')
     parser.add_argument('--init-meta-algorithm', type=str, default='MAML',
-        help='MAML/Reptile/FOMAML')
+        help='MAML/Reptile/FOMAML/iMAML')
     parser.add_argument('--grad-clip-inner', type=float, default=0.0,
         help='gradient clip value in inner loop')
     parser.add_argument('--num-updates-inner-train', type=int, default=1,
@@ -647,7 +759,77 @@ if __name__ == '__main__':
     parser.add_argument('--num-updates-inner-val', type=int, default=1,
         help='number of updates in inner loop val')
     parser.add_argument('--inner-update-method', type=str, default='sgd',
-        help='inner update method can be sgd or adam')
+        help='inner update method can be sgd, adam or metasgd (per parameter step sizes meta-learned with MAML)')
+    parser.add_argument('--imaml-lambda', type=float, default=1.0,
+        help='iMAML proximal regularization strength')
+    parser.add_argument('--imaml-cg-steps', type=int, default=5,
+        help='iMAML number of conjugate gradient steps for the meta-gradient')
+    parser.add_argument('--maml-checkpoint-segment', type=int, default=0,
+        help='MAML: number of inner steps between stored checkpoints, the inner loop is recomputed '
+             'segment by segment for the outer gradient (0 to keep the whole graph)')
+    parser.add_argument('--maml-hessian-vector-product', type=str, default='exact',
+        help='MAML: exact (second order graph of the inner loop) or finite_difference (two extra first order '
+             'gradients per inner step, FOMAML memory; noisy across the kinks of ReLU/max pool backbones)')
+    parser.add_argument('--maml-finite-difference-epsilon', type=float, default=0.01,
+        help='MAML finite_difference: norm of the parameter perturbation of the central difference')
+    parser.add_argument('--adapted-layers', type=str, default='all',
+        help='MAML/FOMAML: comma separated parameter name prefixes updated in the inner loop '
+             '(e.g. fc for ANIL, whose features are computed once per task, or layer4,fc for resnet_12, '
+             'whose frozen layer1-3 run once per task), all for every parameter')
+    parser.add_argument('--inner-loop-tol', type=float, default=0.,
+        help='MAML/Reptile/FOMAML/iMAML: stop the inner loop of a task before the maximum number of '
+             'inner steps once the convergence criterion falls below this tolerance (0 to always run every step)')
+    parser.add_argument('--inner-loop-criterion', type=str, default='grad_norm',
+        help='inner loop convergence criterion: decrease of the support loss in one step or norm of the support gradient')
+    parser.add_argument('--vectorize-tasks', type=str, default="False",
+        help='adapt all the tasks of a task batch at once (vmap over per task parameters and batch norm buffers), '
+            'not supported by resnet_12 with dropout/DropBlock')
+    parser.add_argument('--async-reptile-workers', type=int, default=0,
+        help='Reptile: number of processes updating the shared meta-parameters asynchronously '
+             '(plain SGD at the optimizer learning rate), 0 for synchronous task batches')
+    parser.add_argument('--async-reptile-max-staleness', type=int, default=4,
+        help='Reptile: asynchronous updates computed from meta-parameters older than this many updates are dropped')
+
+
+    # SVM head
+    parser.add_argument('--kernel', type=str, default='linear',
+        help='kernel of the SVM, Ridge and ProtoNet heads: linear, rbf or poly')
+    parser.add_argument('--kernel-gamma', type=float, default=None,
+        help='width of the rbf and poly kernels, 1 / (d * support feature variance) of each task if not set')
+    parser.add_argument('--kernel-degree', type=int, default=3,
+        help='degree of the poly kernel')
+    parser.add_argument('--kernel-approximation', type=str, default='exact',
+        help='exact kernel matrices or an explicit feature map of linear cost in the number of support examples: '
+             'exact, nystrom or random_features (rbf only)')
+    parser.add_argument('--kernel-n-components', type=int, default=256,
+        help='number of nystrom landmarks or random features of the kernel approximation')
+    parser.add_argument('--svm-solver', type=str, default='qpth',
+        help='solver for the SVM dual: qpth/fista')
+    parser.add_argument('--svm-solver-tol', type=float, default=1e-4,
+        help='convergence tolerance of the fista SVM solver')
+    parser.add_argument('--svm-solver-max-iter', type=int, default=1000,
+        help='maximum number of iterations of the fista SVM solver')
+    parser.add_argument('--svm-implicit-grad', type=str, default="False",
+        help='backpropagate through the qpth SVM solution with implicit differentiation of the KKT conditions '
+             '(always the case for fista)')
+    parser.add_argument('--logistic-regression-solver', type=str, default='newton',
+        help='LogisticRegression head solver, newton or lbfgs (batched over the tasks)')
+    parser.add_argument('--logistic-regression-lambda', type=float, default=0.1,
+        help='LogisticRegression head L2 regularization of the mean cross entropy')
+    parser.add_argument('--logistic-regression-max-iter', type=int, default=20,
+        help='LogisticRegression head maximum number of solver iterations')
+    parser.add_argument('--logistic-regression-hessian-solver', type=str, default='cg',
+        help='LogisticRegression head linear solves with the hessian (newton steps and implicit gradient): '
+             'cg (matrix-free conjugate gradient) or woodbury (direct N(C+1) x N(C+1) solve)')
+    parser.add_argument('--gda-shrinkage', type=float, default=0.5,
+        help='GDA head shrinkage in (0, 1] of the shared covariance towards a scaled identity')
+    parser.add_argument('--eval-embedding-cache', type=str, default="False",
+        help='cache the backbone features of (non-augmented) evaluation images and reuse them across tasks')
+    parser.add_argument('--eval-dedup-images', type=str, default="False",
+        help='run the backbone once per distinct (non-augmented) image of an evaluation task batch')
+    parser.add_argument('--train-dedup-images', type=str, default="False",
+        help='run the backbone once per distinct non-augmented image of a training task batch '
+             '(changes the batch norm statistics of the training batches)')
 
 
     # Dataset
@@ -699,6 +881,22 @@ if __name__ == '__main__':
     parser.add_argument('--randomize-query', type=str, default="False",
         help='random query pts per class')
     parser.add_argument('--preload-train', type=str, default="False")
+    parser.add_argument('--batched-augmentation', type=str, default="False",
+        help='transform the images of a whole task batch at once with tensor operations instead of per-image PIL transforms')
+    parser.add_argument('--preload-memory-gb', type=float, default=0.,
+        help='maximum GB of decoded images preloaded for each split, the rest is loaded lazily (0 for no limit)')
+    parser.add_argument('--encoded-in-memory', type=str, default="False",
+        help='keep the encoded bytes of every image file in memory and decode them from there instead of reading the disk')
+    parser.add_argument('--image-cache-gb', type=float, default=0.,
+        help='GB of lazily loaded images kept decoded in an LRU cache (per loader worker unless shared, the workers '
+             'then persist across epochs to keep their caches), 0 for no cache')
+    parser.add_argument('--image-cache-shared', type=str, default="False",
+        help='one decoded image cache in shared memory for all the loader workers')
+    parser.add_argument('--image-cache-slot-kb', type=float, default=0.,
+        help='KB of each slot of the shared image cache, larger images are not cached '
+             '(0 for the largest of a sample of the images)')
+    parser.add_argument('--packed-images', type=str, default="False",
+        help='read the images from the memory-mapped stores written by python -m src.data.image_store')
 
 
     # Miscellaneous
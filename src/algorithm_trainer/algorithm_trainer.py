@@ -1,5 +1,7 @@
 import os
 import sys
+import copy
+import queue as pyqueue
 from collections import defaultdict
 import numpy as np
 from tqdm import tqdm
@@ -14,6 +16,7 @@ import torch.nn as nn
 from src.algorithms.grad import quantile_marks, get_grad_norm_from_parameters
 from src.algorithm_trainer.utils import *
 from src.algorithms.utils import logistic_regression_grad_with_respect_to_w, logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X
+from src.algorithms.utils import EmbeddingCache
 
 import src.logger
 
@@ -21,7 +24,7 @@ import src.logger
 class Meta_algorithm_trainer(object):
 
     def __init__(self, algorithm, optimizer, writer, log_interval, 
-        save_folder, grad_clip, init_global_iteration=0):
+        save_folder, grad_clip, init_global_iteration=0, embedding_cache=False):
 
         self._algorithm = algorithm
         self._optimizer = optimizer
@@ -31,6 +34,8 @@ class Meta_algorithm_trainer(object):
         self._grad_clip = grad_clip # clip the meta (outer) loss's gradient
         self._global_iteration = init_global_iteration
         self._eps = 0.
+        # cache of backbone features shared by all evaluations of the same checkpoint
+        self._embedding_cache = EmbeddingCache() if embedding_cache else None
         
 
     def run(self, mt_loader, epoch=None, is_training=True):
@@ -40,6 +45,7 @@ class Meta_algorithm_trainer(object):
             self._algorithm._model.train()
         else:
             self._algorithm._model.eval()
+        set_embedding_cache(self._algorithm, self._embedding_cache, is_training)
 
         # loaders and iterators
         mt_iterator = tqdm(enumerate(mt_loader, start=1),
@@ -101,7 +107,8 @@ class Meta_algorithm_trainer(object):
                 n_shot=n_shot, n_query=n_query, batch_sz=mt_batch_sz, rp=rp)
             '''
 
-            shots_x, shots_y, query_x, query_y = mt_batch
+            shots_x, shots_y, query_x, query_y = mt_batch[:4]
+            task_batch_kwargs = get_task_batch_kwargs(mt_batch)
             
             assert shots_x.shape[0:2] == (mt_batch_sz, n_way*n_shot)
             assert query_x.shape[0:2] == (mt_batch_sz, n_way*n_query)
@@ -123,7 +130,8 @@ class Meta_algorithm_trainer(object):
                         query=query_x,
                         n_way=n_way,
                         n_shot=n_shot,
-                        n_query=n_query)
+                        n_query=n_query,
+                        **task_batch_kwargs)
 
             logits = logits.reshape(-1, logits.size(-1))
             query_y = query_y.reshape(-1)
@@ -166,6 +174,10 @@ class Meta_algorithm_trainer(object):
                            'optimizer': self._optimizer}, f)
 
 
+        if not is_training and self._embedding_cache is not None:
+            print(f"embedding cache: {len(self._embedding_cache)} images, "
+                  f"{self._embedding_cache.hits} hits, {self._embedding_cache.misses} misses")
+
         results = {
             'train_loss_trajectory': {
                 'loss': np.mean(aggregate['loss']), 
@@ -209,7 +221,7 @@ class Init_algorithm_trainer(object):
 
     def __init__(self, algorithm, optimizer, writer, log_interval, 
         save_folder, grad_clip, num_updates_inner_train, num_updates_inner_val,
-        label_offset=0, init_global_iteration=0):
+        label_offset=0, init_global_iteration=0, vectorize_tasks=False):
 
         self._algorithm = algorithm
         self._optimizer = optimizer
@@ -221,6 +233,9 @@ class Init_algorithm_trainer(object):
         self._num_updates_inner_val = num_updates_inner_val
         self._label_offset = label_offset
         self._global_iteration = init_global_iteration
+        self._vectorize_tasks = vectorize_tasks # adapt all tasks of a batch at once
+        if self._vectorize_tasks:
+            self._algorithm.check_vectorized_inner_loop()
         print("Starting tboard logs from iter", self._global_iteration)
         
 
@@ -289,7 +304,8 @@ class Init_algorithm_trainer(object):
                 n_shot=n_shot, n_query=n_query, batch_sz=mt_batch_sz, rp=rp)
             '''
 
-            shots_x, shots_y, query_x, query_y = mt_batch
+            shots_x, shots_y, query_x, query_y = mt_batch[:4]
+            assert len(mt_batch) < 8, 'InitBasedAlgorithm does not support deduplicated task batches'
 
             assert shots_x.shape[0:2] == (mt_batch_sz, n_way*n_shot)
             assert query_x.shape[0:2] == (mt_batch_sz, n_way*n_query)
@@ -302,28 +318,45 @@ class Init_algorithm_trainer(object):
             shots_y = shots_y.cuda()
             query_y = query_y.cuda()
             
-            for task_id in range(mt_batch_sz):
-                # compute outer gradients and populate model grad with it
-                # so that we can directly call optimizer.step()
-                measurements_trajectory = self._algorithm.inner_loop_adapt(
-                    query=query_x[task_id:task_id+1], 
-                    query_labels=query_y[task_id:task_id+1], 
-                    support=shots_x[task_id:task_id+1],  
-                    support_labels=shots_y[task_id:task_id+1],
+            if self._vectorize_tasks:
+                # the sum of the outer gradients of all tasks is populated in model grad
+                measurements_trajectory = self._algorithm.inner_loop_adapt_vectorized(
+                    query=query_x, 
+                    query_labels=query_y, 
+                    support=shots_x,  
+                    support_labels=shots_y,
                     n_way=n_way, n_shot=n_shot, n_query=n_query,
                     num_updates_inner=self._num_updates_inner_train\
                          if is_training else self._num_updates_inner_val)
 
-                # metrics accumulation
+                # metrics accumulation (one value per task)
                 for k in measurements_trajectory:
-                    aggregate[k].append(measurements_trajectory[k][-1])
+                    aggregate[k].extend(measurements_trajectory[k])
+            else:
+                for task_id in range(mt_batch_sz):
+                    # compute outer gradients and populate model grad with it
+                    # so that we can directly call optimizer.step()
+                    measurements_trajectory = self._algorithm.inner_loop_adapt(
+                        query=query_x[task_id:task_id+1], 
+                        query_labels=query_y[task_id:task_id+1], 
+                        support=shots_x[task_id:task_id+1],  
+                        support_labels=shots_y[task_id:task_id+1],
+                        n_way=n_way, n_shot=n_shot, n_query=n_query,
+                        num_updates_inner=self._num_updates_inner_train\
+                             if is_training else self._num_updates_inner_val)
+
+                    # metrics accumulation
+                    for k in measurements_trajectory:
+                        aggregate[k].append(measurements_trajectory[k][-1])
 
             # optimizer step
             if is_training:
-                for param in self._algorithm._model.parameters():
+                meta_parameters = list(self._algorithm._model.parameters()) + \
+                    self._algorithm.inner_update_parameters()
+                for param in meta_parameters:
                     param.grad /= mt_batch_sz
                 if self._grad_clip > 0.:
-                    clip_grad_norm_(self._algorithm._model.parameters(), 
+                    clip_grad_norm_(meta_parameters, 
                         max_norm=self._grad_clip, norm_type='inf')
                 self._optimizer.step()
 
@@ -341,7 +374,8 @@ class Init_algorithm_trainer(object):
             save_path = os.path.join(self._save_folder, save_name)
             with open(save_path, 'wb') as f:
                 torch.save({'model': self._algorithm._model.state_dict(),
-                           'optimizer': self._optimizer}, f)
+                           'optimizer': self._optimizer,
+                           'inner_lrs': self._algorithm.inner_update_parameters()}, f)
 
         results = {
             'train_loss_trajectory': {
@@ -356,6 +390,13 @@ class Init_algorithm_trainer(object):
         mean, i95 = (np.mean(aggregate['mt_outer_accu']), 
             1.96 * np.std(aggregate['mt_outer_accu']) / np.sqrt(len(aggregate['mt_outer_accu'])))
         results['val_task_acc'] = "{:.2f} ± {:.2f} %".format(mean, i95) 
+        # number of inner steps actually taken per task (fewer than the budget with early exit)
+        results['inner_steps'] = np.mean(aggregate['inner_steps'])
+        if self._algorithm._inner_loop_tol > 0:
+            prefix = 'train' if is_training else 'eval'
+            self.log_output(epoch, None, {
+                f'{prefix}_inner_steps': results['inner_steps'],
+                f'{prefix}_inner_steps_max': np.max(aggregate['inner_steps'])})
     
         return results
 
@@ -382,13 +423,190 @@ class Init_algorithm_trainer(object):
 
 
 
+def async_reptile_worker(rank, algorithm, mt_loader, n_batches, num_updates_inner, lr, grad_clip,
+        max_staleness, version, n_stale, lock, queue, seed, n_threads):
+    """Worker process of Async_reptile_trainer.
+    Repeatedly copies the shared meta-parameters into its own copy of the algorithm,
+    adapts to a task batch of its own mt_loader and, unless more than max_staleness updates were applied
+    by the other workers since the copy, moves the shared meta-parameters by -lr * (mean of the Reptile
+    parameter differences) and adds its change of the buffers (e.g. the batch norm running statistics)
+    to the shared buffers, so that the statistics of all the workers accumulate.
+    Sends the measurements of every task batch to queue.
+    """
+    torch.manual_seed(seed + rank)
+    np.random.seed(seed + rank)
+    torch.set_num_threads(n_threads)
+
+    shared_model = algorithm._model
+    # the algorithm's model is replaced by a private copy, the shared model is only read and written under lock
+    algorithm = copy.deepcopy(algorithm)
+    model = algorithm._model
+    device = next(model.parameters()).device
+    n_way, n_shot, n_query = mt_loader.n_way, mt_loader.n_shot, mt_loader.n_query
+
+    for i, mt_batch in enumerate(mt_loader):
+        if i == n_batches:
+            break
+        shots_x, shots_y, query_x, query_y = [x.to(device) for x in mt_batch[:4]]
+        mt_batch_sz = shots_x.size(0)
+
+        with lock:
+            model.load_state_dict(shared_model.state_dict())
+            read_version = version.value
+        read_buffers = [buffer.clone() for buffer in model.buffers()]
+        model.zero_grad()
+        aggregate = defaultdict(list)
+        for task_id in range(mt_batch_sz):
+            measurements_trajectory = algorithm.inner_loop_adapt(
+                query=query_x[task_id:task_id+1], 
+                query_labels=query_y[task_id:task_id+1], 
+                support=shots_x[task_id:task_id+1],  
+                support_labels=shots_y[task_id:task_id+1],
+                n_way=n_way, n_shot=n_shot, n_query=n_query,
+                num_updates_inner=num_updates_inner)
+            for k in measurements_trajectory:
+                aggregate[k].append(measurements_trajectory[k][-1])
+
+        for param in model.parameters():
+            param.grad /= mt_batch_sz
+        if grad_clip > 0.:
+            clip_grad_norm_(model.parameters(), max_norm=grad_clip, norm_type='inf')
+
+        with lock:
+            stale = version.value - read_version > max_staleness
+            if stale:
+                n_stale.value += 1
+            else:
+                with torch.no_grad():
+                    for shared_param, param in zip(shared_model.parameters(), model.parameters()):
+                        shared_param.add_(param.grad, alpha=-lr)
+                    for shared_buffer, buffer, read_buffer in zip(
+                            shared_model.buffers(), model.buffers(), read_buffers):
+                        shared_buffer.add_(buffer - read_buffer)
+                version.value += 1
+        queue.put(dict(aggregate))
+
+
+
+"""
+Trains Reptile asynchronously
+"""
+class Async_reptile_trainer(Init_algorithm_trainer):
+
+    def __init__(self, algorithm, optimizer, writer, log_interval, 
+        save_folder, grad_clip, num_updates_inner_train, num_updates_inner_val,
+        label_offset=0, init_global_iteration=0, n_workers=2, max_staleness=4):
+        """Reptile outer loop run by n_workers processes without synchronization (see async_reptile_worker):
+        the meta-parameters live in shared memory and are updated by each worker as soon as it has adapted
+        to a task batch with plain SGD at the learning rate of optimizer (the optimizer's own step and
+        state are not used). The learning rate is read once at the start of each epoch, and the optimizer
+        must have a single param group (no meta-learned inner learning rates, which Reptile does not train).
+        An update computed from parameters that are more than max_staleness updates old is dropped.
+        Evaluation runs synchronously in the parent as Init_algorithm_trainer.
+
+        Every worker iterates over its own copy of the training MetaDataLoader, which spawns its own
+        DataLoader workers (12 per MetaDataLoader), so the number of loading processes is
+        n_workers times that of synchronous training.
+        """
+        super().__init__(algorithm=algorithm, optimizer=optimizer, writer=writer, log_interval=log_interval,
+            save_folder=save_folder, grad_clip=grad_clip, num_updates_inner_train=num_updates_inner_train,
+            num_updates_inner_val=num_updates_inner_val, label_offset=label_offset,
+            init_global_iteration=init_global_iteration)
+        if self._algorithm._method != 'Reptile':
+            raise ValueError("asynchronous training is only implemented for Reptile.")
+        if len(self._optimizer.param_groups) > 1 or len(self._algorithm.inner_update_parameters()) > 0:
+            raise ValueError("asynchronous Reptile updates the model parameters with a single learning rate, "
+                "the optimizer must have a single param group (no metasgd inner learning rates).")
+        self._n_workers = n_workers
+        self._max_staleness = max_staleness
+        print(f"Asynchronous Reptile: {self._n_workers} workers, max staleness {self._max_staleness}")
+
+
+    def run(self, mt_loader, epoch=None, is_training=True):
+
+        if not is_training:
+            return super().run(mt_loader, epoch=epoch, is_training=False)
+
+        self._algorithm._model.train()
+        self._algorithm._model.share_memory()
+
+        # the task batches of the epoch are split between the workers
+        n_batches = int(np.ceil(mt_loader.n_batches / self._n_workers))
+        lr = self._optimizer.param_groups[0]['lr']
+        ctx = torch.multiprocessing.get_context('spawn')
+        version = ctx.Value('l', 0)
+        n_stale = ctx.Value('l', 0)
+        lock = ctx.Lock()
+        queue = ctx.Queue()
+        seed = int(torch.randint(2 ** 30, (1,)).item())
+        n_threads = max(1, torch.get_num_threads() // self._n_workers)
+        workers = [ctx.Process(target=async_reptile_worker, args=(
+                        rank, self._algorithm, mt_loader, n_batches, self._num_updates_inner_train, lr,
+                        self._grad_clip, self._max_staleness, version, n_stale, lock, queue, seed, n_threads))
+                    for rank in range(self._n_workers)]
+        for worker in workers:
+            worker.start()
+
+        # metrics aggregation, one message per task batch of any worker
+        aggregate = defaultdict(list)
+        n_received = 0
+        start_time = time.time()
+        for i in tqdm(range(1, n_batches * self._n_workers + 1),
+                        leave=False, file=src.logger.stdout, position=0):
+            while True:
+                try:
+                    measurements = queue.get(timeout=1.)
+                    break
+                except pyqueue.Empty:
+                    if any(worker.exitcode not in [None, 0] for worker in workers):
+                        raise RuntimeError("an asynchronous Reptile worker failed.")
+                    if all(worker.exitcode == 0 for worker in workers) and queue.empty():
+                        measurements = None
+                        break
+            if measurements is None:
+                break
+            n_received += 1
+            self._global_iteration += 1
+            for k in measurements:
+                aggregate[k].extend(measurements[k])
+
+            # logging
+            if i % self._log_interval == 0:
+                metrics = {}
+                for name, values in aggregate.items():
+                    metrics[name] = np.mean(values)
+                metrics['stale_updates'] = n_stale.value
+                metrics['task_batches_per_sec'] = n_received / (time.time() - start_time)
+                self.log_output(epoch, i, metrics)
+                aggregate = defaultdict(list)
+
+        for worker in workers:
+            worker.join()
+        print(f"Asynchronous Reptile: {version.value} updates, {n_stale.value} stale updates dropped, "
+              f"{n_received / (time.time() - start_time):.2f} task batches/s")
+
+        # save model
+        if self._save_folder is not None:
+            save_name = "chkpt_{0:03d}.pt".format(epoch)
+            save_path = os.path.join(self._save_folder, save_name)
+            with open(save_path, 'wb') as f:
+                torch.save({'model': self._algorithm._model.state_dict(),
+                           'optimizer': self._optimizer,
+                           'inner_lrs': self._algorithm.inner_update_parameters()}, f)
+        return {}
+
+
+
+
+
+
 """
 Trains the transfer learning baseline
 """
 class TL_algorithm_trainer(object):
 
     def __init__(self, algorithm, optimizer, writer, log_interval, 
-        save_folder, grad_clip, label_offset=0, init_global_iteration=0):
+        save_folder, grad_clip, label_offset=0, init_global_iteration=0, embedding_cache=False):
 
         self._algorithm = algorithm
         self._optimizer = optimizer
@@ -399,6 +617,7 @@ class TL_algorithm_trainer(object):
         self._label_offset = label_offset
         self._global_iteration = init_global_iteration
         self._eps = 0.
+        self._embedding_cache = EmbeddingCache() if embedding_cache else None
         
 
     def run(self, mt_loader, epoch=None, is_training=True, evaluate_supervised_classification=False):
@@ -407,6 +626,7 @@ class TL_algorithm_trainer(object):
             self._algorithm._model.train()
         else:
             self._algorithm._model.eval()
+        set_embedding_cache(self._algorithm, self._embedding_cache, is_training)
 
         # loaders and iterators
         mt_iterator = tqdm(enumerate(mt_loader, start=1),
@@ -464,7 +684,8 @@ class TL_algorithm_trainer(object):
                 """
                 Evaluate on the meta-learning objective
                 """
-                shots_x, shots_y, query_x, query_y = mt_batch
+                shots_x, shots_y, query_x, query_y = mt_batch[:4]
+                task_batch_kwargs = get_task_batch_kwargs(mt_batch)
                 
                 assert shots_x.shape[0:2] == (mt_batch_sz, n_way*n_shot)
                 assert query_x.shape[0:2] == (mt_batch_sz, n_way*n_query)
@@ -486,7 +707,8 @@ class TL_algorithm_trainer(object):
                             query=query_x,
                             n_way=n_way,
                             n_shot=n_shot,
-                            n_query=n_query)
+                            n_query=n_query,
+                            **task_batch_kwargs)
 
                 logits = logits.reshape(-1, logits.size(-1))
                 query_y = query_y.reshape(-1)
@@ -526,6 +748,10 @@ class TL_algorithm_trainer(object):
                 torch.save({'model': self._algorithm._model.state_dict(),
                            'optimizer': self._optimizer}, f)
                             # 'optimizer': self._optimizer.state_dict()}, f) # technically only need to save state_dict but not the actual optimizer
+        if not is_training and self._embedding_cache is not None:
+            print(f"embedding cache: {len(self._embedding_cache)} images, "
+                  f"{self._embedding_cache.hits} hits, {self._embedding_cache.misses} misses")
+
         results = {}
         if not is_training:
             results = {
@@ -203,6 +203,33 @@ def get_labels(y_batch, n_way, n_shot, n_query, batch_sz, mgr_n_query=None, rp=N
     return shots_y, query_y
 
 
+def get_task_batch_kwargs(mt_batch):
+    """return the optional keyword arguments of inner_loop_adapt carried by a task batch:
+    support_keys, query_keys if the loader was created with return_image_keys=True,
+    and unique_images, unique_keys if it was created with dedup_images=True
+    (in which case mt_batch[0] and mt_batch[2] are index tensors into unique_images)
+    """
+    kwargs = {}
+    if len(mt_batch) >= 6:
+        kwargs['support_keys'], kwargs['query_keys'] = mt_batch[4], mt_batch[5]
+    if len(mt_batch) == 8:
+        kwargs['unique_images'], kwargs['unique_keys'] = mt_batch[6].cuda(), mt_batch[7]
+    return kwargs
+
+
+def set_embedding_cache(algorithm, embedding_cache, is_training):
+    """attach embedding_cache to algorithm for evaluation runs.
+    Training changes the backbone, so the cached embeddings are dropped and the cache is detached.
+    """
+    if embedding_cache is None:
+        return
+    if is_training:
+        embedding_cache.clear()
+        algorithm._embedding_cache = None
+    else:
+        algorithm._embedding_cache = embedding_cache
+
+
 def update_sum_measurements(sum_measurements, measurements):
     for key in measurements.keys():
         sum_measurements[key] += np.sum(measurements[key])
@@ -9,10 +9,17 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 import torch.nn.functional as F
+from torch.func import functional_call, vmap
 
 from src.algorithms.grad import soft_clip, get_grad_norm, get_grad_quantiles
 from src.algorithm_trainer.utils import accuracy, spectral_norm
-from src.algorithms.utils import one_hot, computeGramMatrix, binv, batched_kronecker, copy_and_replace
+from src.models.resnet_12 import BasicBlock
+from src.algorithms.utils import one_hot, computeGramMatrix, Kernel, binv, batched_kronecker
+from src.algorithms.utils import ridge_dual_coefficients, ridge_primal_weights, crammer_singer_svm_dual
+from src.algorithms.utils import gda_discriminant_weights
+from src.algorithms.utils import ImplicitQPFunction, CrammerSingerImplicitFunction, batched_conjugate_gradient
+from src.algorithms.utils import qpth_solve_with_multipliers
+from src.algorithms.utils import batched_logistic_regression_fit, LogisticRegressionImplicitFunction
 from src.algorithms.utils import logistic_regression_hessian_pieces_with_respect_to_w, logistic_regression_hessian_with_respect_to_w, logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X, logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X_left_multiply
 from qpth.qp import QPFunction
 
@@ -33,12 +40,88 @@ class Algorithm(object):
     def predict_without_adapt(self, train_task, batch, param_dict=None):
         raise NotImplementedError()
 
+    def get_features(self, X, image_keys=None):
+        """
+        Computes the backbone features of a (tasks_per_batch, n, c, h, w) Tensor of images
+        and returns a (tasks_per_batch, n, d) Tensor.
+        If an EmbeddingCache is attached (self._embedding_cache), gradients are disabled and
+        image_keys (a list of tasks_per_batch lists of n keys) are given, features are
+        looked up in the cache and only unseen images go through self._model.
+        """
+        orig_X_shape = X.shape
+        X = X.reshape(-1, *orig_X_shape[2:])
+        embedding_cache = getattr(self, '_embedding_cache', None)
+        if image_keys is not None:
+            image_keys = [key for task_keys in image_keys for key in task_keys]
+
+        if embedding_cache is not None and image_keys is not None \
+                and not torch.is_grad_enabled() and None not in image_keys:
+            features = embedding_cache.lookup(
+                lambda x: self._model(x, only_features=True), X, image_keys)
+        else:
+            features = self._model(X, only_features=True)
+        return features.reshape(*orig_X_shape[:2], -1)
+
+    def get_task_features(self, support, query, support_keys=None, query_keys=None,
+            unique_images=None, unique_keys=None):
+        """
+        Computes the (tasks_per_batch, n_support, d) support and (tasks_per_batch, n_query, d) query features.
+        support and query are either (tasks_per_batch, n, c, h, w) Tensors of images, or, when unique_images
+        (a (n_unique, c, h, w) Tensor with its list of n_unique keys unique_keys) is given,
+        (tasks_per_batch, n) index Tensors into unique_images, in which case
+        every unique image goes through the backbone once.
+        """
+        if unique_images is None:
+            assert(query.dim() == 5)
+            assert(support.dim() == 5)
+            return self.get_features(support, support_keys), self.get_features(query, query_keys)
+
+        assert(query.dim() == 2)
+        assert(support.dim() == 2)
+        features = self.get_features(unique_images.unsqueeze(0), [unique_keys]).squeeze(0)
+        return features[support], features[query]
+
+
+
+class Unscattered(object):
+    # nn.DataParallel splits the tensors inside tuples, lists and dicts along the batch dimension
+    # but passes any other object to every replica as is
+    def __init__(self, value):
+        self.value = value
+
+
+
+class FunctionalModel(nn.Module):
+
+    def __init__(self, module):
+        """
+        Runs module statelessly with the parameters (and buffers) given to forward,
+        so that an nn.DataParallel of it splits the images of an inner loop step across the devices.
+        Each replica copies the parameters to its device (differentiably, the gradient flows back
+        to the tensors given on the output device).
+        """
+        super().__init__()
+        self.module = module
+
+    def forward(self, X, params, buffers, kwargs):
+        """
+        X: a (n, ...) Tensor, params, buffers (or None) and kwargs (or None) of functional_call
+        wrapped in Unscattered.
+        """
+        params = OrderedDict((name, param.to(X.device)) for name, param in params.value.items())
+        if buffers.value is not None:
+            params = (params, OrderedDict((name, buffer.to(X.device)) for name, buffer in buffers.value.items()))
+        return functional_call(self.module, params, (X,), kwargs.value)
+
 
 
 class InitBasedAlgorithm(Algorithm):
 
     def __init__(self, model, loss_func, device, alpha, method, 
-            inner_loop_grad_clip, inner_update_method):
+            inner_loop_grad_clip, inner_update_method, imaml_lambda=1.0, imaml_cg_steps=5,
+            checkpoint_segment_length=0, adapted_layers='all',
+            inner_loop_tol=0., inner_loop_criterion='grad_norm',
+            hessian_vector_product='exact', finite_difference_epsilon=0.01):
         
         self._model = model
         self._device = device
@@ -46,30 +129,188 @@ class InitBasedAlgorithm(Algorithm):
         self._alpha = alpha # inner loop lr
         self._inner_loop_grad_clip = inner_loop_grad_clip
         self._method = method
-        self._second_order = (self._method == 'MAML')
-        self._inner_update_method = inner_update_method
+        # MAML: the Hessian-vector products of the meta-gradient are either exact (second order graph
+        # of the inner loop) or finite differences of first order gradients (finite_difference)
+        self._hessian_vector_product = hessian_vector_product
+        self._finite_difference_epsilon = finite_difference_epsilon
+        self._second_order = (self._method == 'MAML' and self._hessian_vector_product == 'exact')
+        self._inner_update_method = inner_update_method # sgd, adam or metasgd
+        self._beta1 = 0.9
         self._beta2 = 0.999
+        self._adam_eps = 1e-8
+        # iMAML: strength of the proximal term lambda/2 ||param - init||^2 added to the inner loss
+        # and number of conjugate gradient steps used to solve for the meta-gradient
+        self._imaml_lambda = imaml_lambda
+        self._imaml_cg_steps = imaml_cg_steps
+        # MAML: if > 0, only the inner loop state every checkpoint_segment_length steps is stored
+        # and the inner steps are recomputed segment by segment for the outer gradient
+        self._checkpoint_segment_length = checkpoint_segment_length
+        # if > 0, the inner loop of each task stops (before num_updates_inner steps) once
+        # the support loss decreases by less than inner_loop_tol in a step (loss)
+        # or the norm of the support gradient falls below inner_loop_tol (grad_norm)
+        self._inner_loop_tol = inner_loop_tol
+        self._inner_loop_criterion = inner_loop_criterion
+        # the inner loop runs the unwrapped backbone with torch.func.functional_call
+        # (the parameters of a DataParallel replica cannot be substituted),
+        # on several devices through a DataParallel of a FunctionalModel
+        self._functional_model = model.module if isinstance(model, nn.DataParallel) else model
+        self._parallel_model = None
+        if isinstance(model, nn.DataParallel) and len(model.device_ids) > 1:
+            self._parallel_model = nn.DataParallel(FunctionalModel(self._functional_model),
+                device_ids=model.device_ids, output_device=model.output_device)
+        # names of the parameters updated in the inner loop, given as comma separated
+        # parameter name prefixes (e.g. fc for ANIL), all for every parameter.
+        # If only the classifier fc is adapted, the features are computed once per task.
+        # Otherwise the stages of the backbone (model.stages) before the first adapted one
+        # are computed once per task and the inner loop only runs the remaining stages.
+        self._adapted_names = [name for name, _ in self._functional_model.named_parameters()
+            if adapted_layers == 'all' or any(name == prefix or name.startswith(prefix + '.')
+                for prefix in adapted_layers.split(','))]
+        assert len(self._adapted_names) > 0, f"no parameter matches adapted layers {adapted_layers}"
+        self._adapt_all = len(self._adapted_names) == len(list(self._functional_model.parameters()))
+        self._adapt_head_only = all(name.startswith('fc.') for name in self._adapted_names)
+        self._n_frozen_stages = 0
+        if not self._adapt_all and not self._adapt_head_only:
+            stages = getattr(self._functional_model, 'stages', None)
+            if stages is None:
+                raise ValueError("adapting layers other than fc requires a backbone with stages (resnet_12 or conv).")
+            self._n_frozen_stages = min(
+                next((i for i, stage in enumerate(stages) if name == stage or name.startswith(stage + '.')), 0)
+                    for name in self._adapted_names)
         print("Init based Algorithm: ", self._method)
         print("Init based Algorithm update step type: ", self._inner_update_method)
+        if self._inner_update_method not in ['sgd', 'adam', 'metasgd']:
+            raise ValueError("inner-method not implemented.")
+        if self._inner_update_method == 'metasgd' and self._method != 'MAML':
+            raise ValueError("metasgd step sizes are only meta-learned by MAML.")
+        if self._inner_update_method == 'adam' and self._checkpoint_segment_length > 0:
+            raise ValueError("checkpointed MAML does not support the adam inner update.")
+        if not self._adapt_all:
+            print("Adapted parameters: ", self._adapted_names, "(head only)" if self._adapt_head_only else
+                f"(frozen stages {self._functional_model.stages[:self._n_frozen_stages]})")
+            if self._method not in ['MAML', 'FOMAML'] or self._checkpoint_segment_length > 0:
+                raise ValueError("partial adaptation is only implemented for MAML and FOMAML without checkpointing.")
+        if self._hessian_vector_product not in ['exact', 'finite_difference']:
+            raise ValueError("hessian vector product not implemented.")
+        if self._hessian_vector_product == 'finite_difference':
+            print("MAML finite difference epsilon: ", self._finite_difference_epsilon)
+            if self._method != 'MAML' or self._inner_update_method == 'adam' or self._checkpoint_segment_length > 0 \
+                    or not self._adapt_all or self._inner_loop_tol > 0:
+                raise ValueError("finite difference hessian vector products are only implemented for MAML "
+                                 "with the sgd or metasgd inner update, adapting every parameter for a fixed number of steps.")
+        if self._inner_loop_criterion not in ['loss', 'grad_norm']:
+            raise ValueError("inner loop convergence criterion not implemented.")
+        if self._inner_loop_tol > 0:
+            print(f"Inner loop early exit: {self._inner_loop_criterion} < {self._inner_loop_tol}")
+            if self._method == 'MAML' and self._checkpoint_segment_length > 0:
+                raise ValueError("checkpointed MAML does not support the inner loop early exit.")
+        if self._method == 'iMAML':
+            print(f"iMAML lambda: {self._imaml_lambda} cg steps: {self._imaml_cg_steps}")
+        if self._method == 'MAML' and self._checkpoint_segment_length > 0:
+            print("MAML checkpoint segment length: ", self._checkpoint_segment_length)
         self.to(self._device)
+        # Meta-SGD: learned per parameter inner step sizes, initialized at alpha
+        self._inner_lrs = None
+        if self._inner_update_method == 'metasgd':
+            self._inner_lrs = nn.ParameterList([nn.Parameter(torch.full_like(param, self._alpha))
+                                for name, param in self._functional_model.named_parameters()
+                                    if name in self._adapted_names])
         
         
 
-    def get_logits(self, model, X):
-        # compute loss on support set
+    def inner_update_parameters(self):
+        """meta-learned parameters of the inner update (besides the model's),
+        to be added to the outer optimizer
+        """
+        return list(self._inner_lrs) if self._inner_lrs is not None else []
+
+
+    def load_inner_update_parameters(self, tensors):
+        with torch.no_grad():
+            for param, tensor in zip(self.inner_update_parameters(), tensors):
+                param.copy_(tensor)
+
+
+    def forward_with_params(self, X, params, buffers=None, parallel=True):
+        """Computes the logits of a (n, c, h, w) Tensor X of images
+        with the backbone's parameters replaced by params (a dict name -> Tensor),
+        running the backbone statelessly instead of copying it,
+        or of a (n, d) Tensor X of features with the classifier fc only,
+        or, with frozen stages, of the (n, ...) activations X of the frozen stages (see get_frozen_prefix).
+        If buffers (a dict name -> Tensor) is given it is used instead of the model's buffers.
+        The backbone runs on all the devices of the DataParallel model unless parallel is False (under vmap).
+        """
+        if X.dim() == 2:
+            head_params = OrderedDict((name[len('fc.'):], param)
+                for name, param in params.items() if name.startswith('fc.'))
+            return functional_call(self._functional_model.fc, head_params, (X,))
+        kwargs = {'start_stage': self._n_frozen_stages} if self._n_frozen_stages > 0 else None
+        if parallel and self._parallel_model is not None:
+            return self._parallel_model(X, Unscattered(params), Unscattered(buffers), Unscattered(kwargs))
+        return functional_call(self._functional_model,
+            params if buffers is None else (params, buffers), (X,), kwargs)
+
+
+    def get_frozen_prefix(self, X):
+        """Computes the (tasks_per_batch, n, ...) output of the frozen stages
+        self._functional_model.stages[:self._n_frozen_stages] of a (tasks_per_batch, n, c, h, w) Tensor X of images.
+        """
         orig_X_shape = X.shape
-        logits = model(
-            X.reshape(-1, *orig_X_shape[2:])).reshape(*orig_X_shape[:2], -1)        
+        activations = self._model(X.reshape(-1, *orig_X_shape[2:]), end_stage=self._n_frozen_stages)
+        return activations.reshape(*orig_X_shape[:2], *activations.shape[1:])
+
+
+    def get_logits(self, X, params, buffers=None):
+        """Computes the logits of a (tasks_per_batch, n, c, h, w) Tensor X of images
+        or a (tasks_per_batch, n, d) Tensor X of features (see forward_with_params).
+        """
+        orig_X_shape = X.shape
+        logits = self.forward_with_params(
+            X.reshape(-1, *orig_X_shape[2:]), params, buffers).reshape(*orig_X_shape[:2], -1)
         return logits
 
 
-    def compute_gradient_wrt_model(self, X, y, model, params_wrt_grad_is_computed, create_graph):
-        """Compute gradient of self._loss_func(X, y; model),
-        based on support, support_labels set but with respect to parameters in model
+    def get_adapted_params(self, params):
+        """the entries of params updated in the inner loop
+        """
+        return OrderedDict((name, params[name]) for name in self._adapted_names)
+
+
+    def update_adapted_params(self, params, grad_list, state):
+        """returns a copy of params with its adapted entries updated with grad_list
+        (the gradient with respect to get_adapted_params(params))
+        """
+        updated_params = OrderedDict(params)
+        updated_params.update(self.get_updated_params(
+            params=self.get_adapted_params(params), grad_list=grad_list, state=state))
+        return updated_params
+
+
+    def get_inner_loop_converged(self, support_loss, prev_support_loss, grad_list):
+        """Returns a bool Tensor shaped as support_loss (one value per task in the vectorized
+        inner loop) which is True for the tasks whose inner loop has converged:
+        loss:      prev_support_loss - support_loss < self._inner_loop_tol
+                   (never at the first step, where prev_support_loss is None)
+        grad_norm: the norm of grad_list (over all parameters) < self._inner_loop_tol
+        """
+        with torch.no_grad():
+            if self._inner_loop_criterion == 'loss':
+                if prev_support_loss is None:
+                    return torch.zeros_like(support_loss, dtype=torch.bool)
+                return prev_support_loss - support_loss < self._inner_loop_tol
+            n_tasks = support_loss.numel()
+            grad_sq_norm = sum(grad.reshape(n_tasks, -1).pow(2).sum(dim=1) for grad in grad_list)
+            return grad_sq_norm.sqrt().reshape(support_loss.shape) < self._inner_loop_tol
+
+
+    def compute_gradient_wrt_params(self, X, y, params, params_wrt_grad_is_computed, create_graph,
+            buffers=None):
+        """Compute gradient of self._loss_func(X, y; params),
+        based on support, support_labels set but with respect to params_wrt_grad_is_computed
         """
         
-        # compute logits wrt param_dict if param_dict is not None
-        logits = self.get_logits(model=model, X=X)
+        # compute logits wrt params
+        logits = self.get_logits(X=X, params=params, buffers=buffers)
         logits = logits.reshape(-1, logits.size(-1))
         y = y.reshape(-1)
         loss = self._loss_func(logits, y)
@@ -81,35 +322,235 @@ class InitBasedAlgorithm(Algorithm):
         return loss, accu, grad_list
 
 
-    def perform_update(self, grad_list):
+    def init_inner_update_state(self, params):
+        """state of the inner update method for one inner loop (the adam moments)
+        """
+        if self._inner_update_method == 'adam':
+            return {'step': 0,
+                    'exp_avg': [torch.zeros_like(param) for param in params.values()],
+                    'exp_avg_sq': [torch.zeros_like(param) for param in params.values()]}
+        return {}
+
+
+    def perform_update(self, param_list, grad_list, state):
+        """returns the list of updated parameters, computed out of place with
+        fused multi-tensor (torch._foreach_*) ops so that it can be differentiated through.
+        sgd:     param - alpha * grad
+        metasgd: param - lr * grad with the learned per parameter step sizes lr
+        adam:    param - alpha * m_hat / sqrt(v_hat + eps^2), the eps inside the square root
+                 keeps the second order derivative finite where the gradient is 0.
+                 state (see init_inner_update_state) holds the moments across the inner steps.
+        """
 
         if self._inner_update_method == 'sgd':
-            return grad_list
+            return torch._foreach_add(param_list, grad_list, alpha=-self._alpha)
+        elif self._inner_update_method == 'metasgd':
+            return torch._foreach_sub(param_list, torch._foreach_mul(list(self._inner_lrs), grad_list))
+        elif self._inner_update_method == 'adam':
+            state['step'] += 1
+            state['exp_avg'] = torch._foreach_add(
+                torch._foreach_mul(state['exp_avg'], self._beta1), grad_list, alpha=1 - self._beta1)
+            state['exp_avg_sq'] = torch._foreach_add(
+                torch._foreach_mul(state['exp_avg_sq'], self._beta2),
+                torch._foreach_mul(grad_list, grad_list), alpha=1 - self._beta2)
+            bias_correction1 = 1 - self._beta1 ** state['step']
+            bias_correction2 = 1 - self._beta2 ** state['step']
+            denom = torch._foreach_sqrt(torch._foreach_add(
+                torch._foreach_div(state['exp_avg_sq'], bias_correction2), self._adam_eps ** 2))
+            return torch._foreach_sub(param_list, torch._foreach_div(
+                torch._foreach_mul(state['exp_avg'], self._alpha / bias_correction1), denom))
         else:
             raise ValueError("inner-method not implemented.")
 
 
 
-    def get_updated_model(self, model, grad_list):
-        """ model_param = model_param - alpha * grad_list
+    def get_updated_params(self, params, grad_list, state=None):
+        """ param = param - alpha * grad_list (or the update of self._inner_update_method)
+        returns a new dict name -> updated param, params is left unchanged
         """
-        updates = []
-        updated_grad_list = self.perform_update(grad_list=grad_list)
-        for (name, param), grad in zip(model.named_parameters(), updated_grad_list):
+        grad_list = list(grad_list)
+        for name, grad in zip(params, grad_list):
             # grad will be torch.Tensor
             assert grad is not None, f"Grad is None for {name}"
-            if self._inner_loop_grad_clip > 0:
-                grad = grad.clamp(min=-self._inner_loop_grad_clip,
-                    max=self._inner_loop_grad_clip)
-            update = param - self._alpha * grad
-            updates.append(update)
-        updates = dict(zip(model.parameters(), updates))
-        do_not_copy = [tensor for tensor in chain(model.parameters(), model.buffers())
-                if tensor not in updates]
-        return copy_and_replace(model, updates, do_not_copy=do_not_copy)
+        if self._inner_loop_grad_clip > 0:
+            grad_list = torch._foreach_clamp_max(torch._foreach_clamp_min(
+                grad_list, -self._inner_loop_grad_clip), self._inner_loop_grad_clip)
+        updates = self.perform_update(list(params.values()), grad_list, state)
+        if not self._second_order:
+            # first order methods never differentiate through the update
+            updates = [update.detach().requires_grad_() for update in updates]
+        return OrderedDict(zip(params.keys(), updates))
                 
 
 
+    def inner_loop_forward_checkpointed(self, X, y, num_updates_inner, segment_length=None):
+        """Runs the MAML inner loop without keeping its graph, storing at the start of every
+        segment of segment_length (default self._checkpoint_segment_length) steps the parameters,
+        a copy of the buffers and the random number generator states, so that the segment can be recomputed exactly.
+        Returns the last support loss and accuracy, the adapted parameters and the list of checkpoints.
+        """
+        if segment_length is None:
+            segment_length = self._checkpoint_segment_length
+        checkpoints = []
+        updated_params = OrderedDict((name, param.detach().requires_grad_())
+                            for name, param in self._functional_model.named_parameters())
+        for i in range(num_updates_inner):
+            if i % segment_length == 0:
+                checkpoints.append((
+                    updated_params,
+                    OrderedDict((name, buffer.clone())
+                        for name, buffer in self._functional_model.named_buffers()),
+                    torch.get_rng_state(),
+                    torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None))
+            support_loss, support_accu, grad_list = self.compute_gradient_wrt_params(
+                X=X, y=y, params=updated_params,
+                params_wrt_grad_is_computed=list(updated_params.values()),
+                create_graph=False)
+            with torch.no_grad():
+                updated_params = self.get_updated_params(params=updated_params, grad_list=grad_list)
+            updated_params = OrderedDict((name, param.requires_grad_())
+                                for name, param in updated_params.items())
+        return support_loss, support_accu, updated_params, checkpoints
+
+
+    def backward_through_checkpoints(self, checkpoints, grad_list, X, y, num_updates_inner):
+        """Backpropagates grad_list (the gradient with respect to the adapted parameters)
+        through the inner loop stored by inner_loop_forward_checkpointed, recomputing one segment
+        at a time with its second order graph, and returns the gradient with respect to
+        the model's parameters (followed by the gradient with respect to inner_update_parameters()).
+        Only one segment's graph is alive at any time.
+        """
+        inner_update_parameters = self.inner_update_parameters()
+        inner_update_grad_list = [torch.zeros_like(param) for param in inner_update_parameters]
+        for k in reversed(range(len(checkpoints))):
+            params, buffers, cpu_rng_state, cuda_rng_states = checkpoints[k]
+            n_steps = min(self._checkpoint_segment_length,
+                          num_updates_inner - k * self._checkpoint_segment_length)
+            segment_params = OrderedDict((name, param.detach().requires_grad_())
+                                for name, param in params.items())
+            # recompute with the rng and buffers of the first pass, whose state is left untouched
+            with torch.random.fork_rng(devices=range(torch.cuda.device_count())):
+                torch.set_rng_state(cpu_rng_state)
+                if cuda_rng_states is not None:
+                    torch.cuda.set_rng_state_all(cuda_rng_states)
+                segment_buffers = OrderedDict((name, buffer.clone()) for name, buffer in buffers.items())
+                updated_params = segment_params
+                for i in range(n_steps):
+                    _, _, inner_grad_list = self.compute_gradient_wrt_params(
+                        X=X, y=y, params=updated_params, buffers=segment_buffers,
+                        params_wrt_grad_is_computed=list(updated_params.values()),
+                        create_graph=True)
+                    updated_params = self.get_updated_params(params=updated_params,
+                        grad_list=inner_grad_list)
+            grad_list = torch.autograd.grad(list(updated_params.values()),
+                list(segment_params.values()) + inner_update_parameters, grad_outputs=grad_list)
+            grad_list, segment_inner_update_grad_list = \
+                grad_list[:len(segment_params)], grad_list[len(segment_params):]
+            if len(inner_update_parameters) > 0:
+                inner_update_grad_list = torch._foreach_add(inner_update_grad_list, segment_inner_update_grad_list)
+        return list(grad_list) + list(inner_update_grad_list)
+
+
+    def backward_through_finite_differences(self, checkpoints, grad_list, X, y):
+        """Backpropagates grad_list (the gradient with respect to the adapted parameters)
+        through the inner loop stored by inner_loop_forward_checkpointed with one checkpoint per step
+        without any second order graph. The vector-Jacobian product of the step param - lr * grad(param) is
+        v - H(param) (lr * v), where the Hessian-vector product H u is approximated by the central difference
+        (grad(param + eps * u) - grad(param - eps * u)) / (2 * eps), eps = finite_difference_epsilon / ||u||.
+        That is two first order gradient evaluations per inner step (three with gradient clipping or metasgd,
+        which also need the gradient at param). Returns the gradient with respect to the model's parameters
+        (followed by the gradient with respect to inner_update_parameters()).
+        """
+        inner_update_parameters = self.inner_update_parameters()
+        inner_update_grad_list = [torch.zeros_like(param) for param in inner_update_parameters]
+        grad_list = [grad.detach() for grad in grad_list]
+        for k in reversed(range(len(checkpoints))):
+            params, buffers, cpu_rng_state, cuda_rng_states = checkpoints[k]
+
+            def compute_gradient_at(param_list):
+                # recompute with the rng and buffers of the first pass, whose state is left untouched
+                with torch.random.fork_rng(devices=range(torch.cuda.device_count())):
+                    torch.set_rng_state(cpu_rng_state)
+                    if cuda_rng_states is not None:
+                        torch.cuda.set_rng_state_all(cuda_rng_states)
+                    step_params = OrderedDict((name, param.detach().requires_grad_())
+                                    for name, param in zip(params.keys(), param_list))
+                    _, _, step_grad_list = self.compute_gradient_wrt_params(
+                        X=X, y=y, params=step_params,
+                        buffers=OrderedDict((name, buffer.clone()) for name, buffer in buffers.items()),
+                        params_wrt_grad_is_computed=list(step_params.values()),
+                        create_graph=False)
+                return step_grad_list
+
+            # u = d(update)/d(grad)^T v
+            if self._inner_update_method == 'metasgd':
+                u = torch._foreach_mul(grad_list, [lr.detach() for lr in inner_update_parameters])
+            else:
+                u = torch._foreach_mul(grad_list, self._alpha)
+            if self._inner_loop_grad_clip > 0 or len(inner_update_parameters) > 0:
+                step_grad_list = compute_gradient_at(list(params.values()))
+                if self._inner_loop_grad_clip > 0:
+                    # the clamped entries of the gradient do not depend on param
+                    u = [u_i * (grad.abs() < self._inner_loop_grad_clip)
+                            for u_i, grad in zip(u, step_grad_list)]
+                    step_grad_list = torch._foreach_clamp_max(torch._foreach_clamp_min(
+                        step_grad_list, -self._inner_loop_grad_clip), self._inner_loop_grad_clip)
+                if len(inner_update_parameters) > 0:
+                    # param - lr * grad(param)
+                    inner_update_grad_list = torch._foreach_sub(
+                        inner_update_grad_list, torch._foreach_mul(grad_list, step_grad_list))
+
+            u_norm = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(u)))
+            if u_norm == 0:
+                continue
+            eps = self._finite_difference_epsilon / u_norm.item()
+            with torch.no_grad():
+                params_plus = torch._foreach_add(list(params.values()), u, alpha=eps)
+                params_minus = torch._foreach_sub(list(params.values()), u, alpha=eps)
+            grad_plus = compute_gradient_at(params_plus)
+            grad_minus = compute_gradient_at(params_minus)
+            hvp = torch._foreach_div(torch._foreach_sub(grad_plus, grad_minus), 2 * eps)
+            grad_list = torch._foreach_sub(grad_list, hvp)
+        return list(grad_list) + list(inner_update_grad_list)
+
+
+    def add_proximal_gradient(self, grad_list, params):
+        """ iMAML inner loss gradient: grad + lambda * (param - init)
+        """
+        return [grad + self._imaml_lambda * (param - init).detach() for grad, param, init
+                    in zip(grad_list, params.values(), self._functional_model.parameters())]
+
+
+    def get_implicit_meta_gradient(self, support_grad_list, params, grad_list, n_tasks):
+        """iMAML meta-gradient (Rajeswaran et al., NeurIPS 2019):
+        solves (I + H / lambda) x = grad_list with self._imaml_cg_steps steps of conjugate gradient,
+        H the Hessian of the support loss at params, using Hessian-vector products through
+        support_grad_list (the support loss gradient computed with create_graph=True).
+        Only the graph of that single gradient is kept, whatever the number of inner steps.
+        With task stacked params (leading dimension n_tasks) every task's system is solved separately.
+        """
+        params = list(params.values())
+        shapes = [grad.shape for grad in grad_list]
+        sizes = [grad.numel() // n_tasks for grad in grad_list]
+
+        def flatten(tensors):
+            return torch.cat([tensor.reshape(n_tasks, -1) for tensor in tensors], dim=1)
+
+        def unflatten(vec):
+            return [v.reshape(shape) for v, shape in zip(vec.split(sizes, dim=1), shapes)]
+
+        def matvec(vec):
+            hvp = torch.autograd.grad(support_grad_list, params, grad_outputs=unflatten(vec),
+                                      retain_graph=True)
+            return vec + flatten(hvp) / self._imaml_lambda
+
+        with torch.no_grad():
+            rhs = flatten(grad_list)
+        meta_grad = batched_conjugate_gradient(
+            lambda vec: matvec(vec).detach(), rhs, tol=1e-10, max_iter=self._imaml_cg_steps)
+        return unflatten(meta_grad)
+
+
     def get_param_diff(self, params_1, params_2):
         """ returns params_1 - params_2
         """
@@ -123,7 +564,8 @@ class InitBasedAlgorithm(Algorithm):
         """Take values in grad list and populate param.grad with it
         for param in model parameters.
         """
-        for param, calculated_grad in zip(self._model.parameters(), grad_list):
+        for param, calculated_grad in zip(chain(self._model.parameters(), self.inner_update_parameters()),
+                                          grad_list):
             if param.grad is not None: 
                 param.grad += calculated_grad.detach()
             else:
@@ -136,34 +578,86 @@ class InitBasedAlgorithm(Algorithm):
         
         # adapt means doing the complete inner loop update
         measurements_trajectory = defaultdict(list)
-        # copy every tenso's data in the original dictionary
-        updated_model = self._model         
+        # the adapted weights, starting from the model's own parameters
+        updated_params = OrderedDict(self._functional_model.named_parameters())
+        inner_update_state = self.init_inner_update_state(self.get_adapted_params(updated_params))
+        if self._adapt_head_only:
+            # the frozen feature extractor runs once per task
+            support = self.get_features(support)
+            query = self.get_features(query)
+        elif self._n_frozen_stages > 0:
+            # the frozen stages before the first adapted one run once per task
+            support = self.get_frozen_prefix(support)
+            query = self.get_frozen_prefix(query)
         
         assert num_updates_inner > 0
-        for i in range(num_updates_inner):
-            support_loss, support_accu, grad_list = self.compute_gradient_wrt_model(
-                X=support, y=support_labels, model=updated_model, params_wrt_grad_is_computed=updated_model.parameters(),
-                create_graph=self._second_order)
-            updated_model = self.get_updated_model(model=updated_model, 
-                grad_list=grad_list)
+        checkpointed = self._method == 'MAML' and self._checkpoint_segment_length > 0
+        finite_difference = self._method == 'MAML' and self._hessian_vector_product == 'finite_difference'
+        if checkpointed or finite_difference:
+            support_loss, support_accu, updated_params, checkpoints = \
+                self.inner_loop_forward_checkpointed(support, support_labels, num_updates_inner,
+                    segment_length=1 if finite_difference else None)
+            inner_steps = num_updates_inner
+        else:
+            inner_steps = 0
+            prev_support_loss = None
+            for i in range(num_updates_inner):
+                support_loss, support_accu, grad_list = self.compute_gradient_wrt_params(
+                    X=support, y=support_labels, params=updated_params,
+                    params_wrt_grad_is_computed=list(self.get_adapted_params(updated_params).values()),
+                    create_graph=self._second_order)
+                if self._method == 'iMAML':
+                    grad_list = self.add_proximal_gradient(grad_list, updated_params)
+                if self._inner_loop_tol > 0 and \
+                        self.get_inner_loop_converged(support_loss, prev_support_loss, grad_list):
+                    break
+                prev_support_loss = support_loss
+                updated_params = self.update_adapted_params(params=updated_params, 
+                    grad_list=grad_list, state=inner_update_state)
+                inner_steps += 1
             
 
         # Now compute loss on query set and from that the outer gradient
-        if self._method == 'MAML':
-            query_loss, query_accu, outer_grad_list = self.compute_gradient_wrt_model(
-                X=query, y=query_labels, model=updated_model, params_wrt_grad_is_computed=self._model.parameters(),
+        if checkpointed or finite_difference:
+            query_loss, query_accu, grad_list = self.compute_gradient_wrt_params(
+                X=query, y=query_labels, params=updated_params,
+                params_wrt_grad_is_computed=list(updated_params.values()),
+                create_graph=False)
+            if finite_difference:
+                outer_grad_list = self.backward_through_finite_differences(
+                    checkpoints, grad_list, support, support_labels)
+            else:
+                outer_grad_list = self.backward_through_checkpoints(
+                    checkpoints, grad_list, support, support_labels, num_updates_inner)
+        elif self._method == 'MAML':
+            query_loss, query_accu, outer_grad_list = self.compute_gradient_wrt_params(
+                X=query, y=query_labels, params=updated_params,
+                params_wrt_grad_is_computed=list(self._functional_model.parameters()) + self.inner_update_parameters(),
                 create_graph=False)
         elif self._method == 'FOMAML':
-            query_loss, query_accu, outer_grad_list = self.compute_gradient_wrt_model(
-                X=query, y=query_labels, model=updated_model, params_wrt_grad_is_computed=updated_model.parameters(),
+            query_loss, query_accu, outer_grad_list = self.compute_gradient_wrt_params(
+                X=query, y=query_labels, params=updated_params,
+                params_wrt_grad_is_computed=list(updated_params.values()),
                 create_graph=False)
         elif self._method == 'Reptile': 
-            query_loss, query_accu, grad_list = self.compute_gradient_wrt_model(
-                X=query, y=query_labels, model=updated_model, params_wrt_grad_is_computed=updated_model.parameters(),
+            query_loss, query_accu, grad_list = self.compute_gradient_wrt_params(
+                X=query, y=query_labels, params=updated_params,
+                params_wrt_grad_is_computed=list(updated_params.values()),
+                create_graph=False)
+            updated_params = self.get_updated_params(params=updated_params, 
+                grad_list=grad_list, state=inner_update_state)
+            outer_grad_list = self.get_param_diff(self._model.parameters(), updated_params.values())
+        elif self._method == 'iMAML':
+            query_loss, query_accu, grad_list = self.compute_gradient_wrt_params(
+                X=query, y=query_labels, params=updated_params,
+                params_wrt_grad_is_computed=list(updated_params.values()),
                 create_graph=False)
-            updated_model = self.get_updated_model(model=updated_model, 
-                grad_list=grad_list)
-            outer_grad_list = self.get_param_diff(self._model.parameters(), updated_model.parameters())
+            _, _, support_grad_list = self.compute_gradient_wrt_params(
+                X=support, y=support_labels, params=updated_params,
+                params_wrt_grad_is_computed=list(updated_params.values()),
+                create_graph=True)
+            outer_grad_list = self.get_implicit_meta_gradient(
+                support_grad_list, updated_params, grad_list, n_tasks=1)
         else:
             raise ValueError("Meta-alg not implemented.")
             
@@ -175,6 +669,176 @@ class InitBasedAlgorithm(Algorithm):
         measurements_trajectory['accu'].append(support_accu * 100.)
         measurements_trajectory['mt_outer_loss'].append(query_loss.item())
         measurements_trajectory['mt_outer_accu'].append(query_accu * 100.)
+        measurements_trajectory['inner_steps'].append(inner_steps)
+        return measurements_trajectory
+
+
+    def get_task_batch_logits(self, X, params, buffers):
+        """Computes the (tasks_per_batch, n, n_way) logits of a (tasks_per_batch, n, c, h, w) Tensor X,
+        task t using the backbone with parameters params[name][t] and buffers buffers[name][t].
+        The tasks are vectorized with torch.func.vmap, batch norm uses per task batch statistics
+        and updates the per task buffers in place.
+        """
+        return vmap(lambda task_X, task_params, task_buffers: self.forward_with_params(
+                    task_X, task_params, task_buffers, parallel=False),
+                    randomness='different')(X, params, buffers)
+
+
+    def get_task_batch_features(self, X, params, buffers, end_stage=None):
+        """Computes the (tasks_per_batch, n, d) features of a (tasks_per_batch, n, c, h, w) Tensor X,
+        or with end_stage the output of the stages before end_stage,
+        vectorized over the tasks as get_task_batch_logits.
+        """
+        kwargs = {'only_features': True} if end_stage is None else {'end_stage': end_stage}
+        return vmap(lambda task_X, task_params, task_buffers: functional_call(
+                    self._functional_model, (task_params, task_buffers), (task_X,), kwargs),
+                    randomness='different')(X, params, buffers)
+
+
+    def compute_task_batch_gradient_wrt_params(self, X, y, params, buffers,
+            params_wrt_grad_is_computed, create_graph):
+        """Compute the gradient of the sum over tasks of self._loss_func(X[t], y[t]; params[t]),
+        for params with a leading task dimension this is the per task gradient.
+        Returns the (tasks_per_batch,) losses, the list of per task accuracies and the gradient list.
+        """
+        logits = self.get_task_batch_logits(X=X, params=params, buffers=buffers)
+        loss = vmap(self._loss_func)(logits, y)
+        accu = [accuracy(task_logits, task_y) for task_logits, task_y in zip(logits, y)]
+        grad_list = torch.autograd.grad(loss.sum(), params_wrt_grad_is_computed,
+                                    create_graph=create_graph, allow_unused=False, only_inputs=True)
+        return loss, accu, grad_list
+
+
+    def check_vectorized_inner_loop(self):
+        """Raises a ValueError if the method or the backbone cannot be run by inner_loop_adapt_vectorized.
+        Under vmap the per task num_batches_tracked of a ResNet-12 block is a batched Tensor (its DropBlock
+        keep rate is data dependent control flow), DropBlock uses torch.nonzero and the block's dropout is
+        in place, so ResNet-12 blocks with drop_rate > 0 are rejected.
+        """
+        if self._method == 'MAML' and self._checkpoint_segment_length > 0:
+            raise ValueError("checkpointed MAML is not implemented for the vectorized inner loop.")
+        if self._method == 'MAML' and self._hessian_vector_product == 'finite_difference':
+            raise ValueError("finite difference MAML is not implemented for the vectorized inner loop.")
+        dropout_blocks = [name for name, module in self._functional_model.named_modules()
+            if isinstance(module, BasicBlock) and module.drop_rate > 0]
+        if len(dropout_blocks) > 0:
+            raise ValueError(f"the vectorized inner loop cannot run the dropout/DropBlock of {dropout_blocks}, "
+                             "use a backbone with drop_rate=0 or --vectorize-tasks False.")
+
+
+    def inner_loop_adapt_vectorized(self, support, support_labels, query, query_labels,
+        n_way, n_shot, n_query, num_updates_inner):
+        """Same as calling inner_loop_adapt on every task of the batch, with all tasks adapted at once:
+        every task gets its own copy of the parameters (stacked along a leading task dimension)
+        and of the batch norm buffers, and model.grad is populated with the sum of the outer gradients.
+        The running statistics of the model are set to the average of the per task running statistics.
+        Returns measurements_trajectory with one value per task.
+        """
+
+        self.check_vectorized_inner_loop()
+
+        measurements_trajectory = defaultdict(list)
+        tasks_per_batch = support.size(0)
+        # per task views of the parameters, the gradient flows back to the shared parameters
+        updated_params = OrderedDict(
+            (name, param.unsqueeze(0).expand(tasks_per_batch, *param.shape))
+                for name, param in self._functional_model.named_parameters())
+        inner_update_state = self.init_inner_update_state(self.get_adapted_params(updated_params))
+        # per task copies of the buffers
+        task_buffers = OrderedDict(
+            (name, buffer.unsqueeze(0).repeat(tasks_per_batch, *([1] * buffer.dim())))
+                for name, buffer in self._functional_model.named_buffers())
+        if self._adapt_head_only:
+            # the frozen feature extractor runs once per task
+            support = self.get_task_batch_features(support, updated_params, task_buffers)
+            query = self.get_task_batch_features(query, updated_params, task_buffers)
+        elif self._n_frozen_stages > 0:
+            # the frozen stages before the first adapted one run once per task
+            support = self.get_task_batch_features(support, updated_params, task_buffers,
+                end_stage=self._n_frozen_stages)
+            query = self.get_task_batch_features(query, updated_params, task_buffers,
+                end_stage=self._n_frozen_stages)
+
+        assert num_updates_inner > 0
+        # the tasks whose inner loop has not converged yet, the others keep their parameters
+        active = torch.ones(tasks_per_batch, dtype=torch.bool, device=support.device)
+        inner_steps = torch.zeros(tasks_per_batch, dtype=torch.long, device=support.device)
+        prev_support_loss = None
+        for i in range(num_updates_inner):
+            support_loss, support_accu, grad_list = self.compute_task_batch_gradient_wrt_params(
+                X=support, y=support_labels, params=updated_params, buffers=task_buffers,
+                params_wrt_grad_is_computed=list(self.get_adapted_params(updated_params).values()),
+                create_graph=self._second_order)
+            if self._method == 'iMAML':
+                grad_list = self.add_proximal_gradient(grad_list, updated_params)
+            if self._inner_loop_tol > 0:
+                active = active & ~self.get_inner_loop_converged(support_loss, prev_support_loss, grad_list)
+                if not active.any():
+                    break
+            prev_support_loss = support_loss
+            new_params = self.update_adapted_params(params=updated_params, 
+                grad_list=grad_list, state=inner_update_state)
+            if self._inner_loop_tol > 0:
+                for name in self._adapted_names:
+                    new_params[name] = torch.where(
+                        active.reshape(-1, *([1] * (new_params[name].dim() - 1))),
+                        new_params[name], updated_params[name])
+            updated_params = new_params
+            inner_steps += active
+
+        # Now compute loss on query set and from that the outer gradient (summed over tasks)
+        if self._method == 'MAML':
+            query_loss, query_accu, outer_grad_list = self.compute_task_batch_gradient_wrt_params(
+                X=query, y=query_labels, params=updated_params, buffers=task_buffers,
+                params_wrt_grad_is_computed=list(self._functional_model.parameters()) + self.inner_update_parameters(),
+                create_graph=False)
+        elif self._method == 'FOMAML':
+            query_loss, query_accu, grad_list = self.compute_task_batch_gradient_wrt_params(
+                X=query, y=query_labels, params=updated_params, buffers=task_buffers,
+                params_wrt_grad_is_computed=list(updated_params.values()),
+                create_graph=False)
+            outer_grad_list = [grad.sum(dim=0) for grad in grad_list]
+        elif self._method == 'Reptile': 
+            query_loss, query_accu, grad_list = self.compute_task_batch_gradient_wrt_params(
+                X=query, y=query_labels, params=updated_params, buffers=task_buffers,
+                params_wrt_grad_is_computed=list(updated_params.values()),
+                create_graph=False)
+            updated_params = self.get_updated_params(params=updated_params, 
+                grad_list=grad_list, state=inner_update_state)
+            outer_grad_list = [diff.sum(dim=0) for diff in
+                self.get_param_diff(self._model.parameters(), updated_params.values())]
+        elif self._method == 'iMAML':
+            query_loss, query_accu, grad_list = self.compute_task_batch_gradient_wrt_params(
+                X=query, y=query_labels, params=updated_params, buffers=task_buffers,
+                params_wrt_grad_is_computed=list(updated_params.values()),
+                create_graph=False)
+            _, _, support_grad_list = self.compute_task_batch_gradient_wrt_params(
+                X=support, y=support_labels, params=updated_params, buffers=task_buffers,
+                params_wrt_grad_is_computed=list(updated_params.values()),
+                create_graph=True)
+            outer_grad_list = [grad.sum(dim=0) for grad in self.get_implicit_meta_gradient(
+                support_grad_list, updated_params, grad_list, n_tasks=tasks_per_batch)]
+        else:
+            raise ValueError("Meta-alg not implemented.")
+
+        # populate model.grad with outer_grad_list
+        self.populate_grad(outer_grad_list)
+
+        # write back the running statistics
+        with torch.no_grad():
+            for name, buffer in self._functional_model.named_buffers():
+                if buffer.is_floating_point():
+                    buffer.copy_(task_buffers[name].mean(dim=0))
+                else:
+                    # counters (num_batches_tracked) advance once per task as in inner_loop_adapt
+                    buffer.add_((task_buffers[name] - buffer).sum(dim=0))
+
+        # metrics
+        measurements_trajectory['loss'].extend(support_loss.tolist())
+        measurements_trajectory['accu'].extend([accu * 100. for accu in support_accu])
+        measurements_trajectory['mt_outer_loss'].extend(query_loss.tolist())
+        measurements_trajectory['mt_outer_accu'].extend([accu * 100. for accu in query_accu])
+        measurements_trajectory['inner_steps'].extend(inner_steps.tolist())
         return measurements_trajectory
 
 
@@ -185,7 +849,7 @@ class InitBasedAlgorithm(Algorithm):
 
     def state_dict(self):
         # for model saving and reloading
-        return {'model': self._model.state_dict()}
+        return {'model': self._model.state_dict(), 'inner_lrs': self.inner_update_parameters()}
 
 
 
@@ -194,15 +858,26 @@ class InitBasedAlgorithm(Algorithm):
 class SVM(Algorithm):
 
     def __init__(self, model, inner_loss_func, device, scale,
-        C_reg=0.1, max_iter=15, double_precision=False):
+        C_reg=0.1, max_iter=15, double_precision=False,
+        solver='qpth', solver_tol=1e-4, solver_max_iter=1000, implicit_grad=False, kernel=None):
         
         self._model = model
         self._device = device
         self._inner_loss_func = inner_loss_func
         self._C_reg = C_reg
-        self._max_iter = max_iter
+        self._max_iter = max_iter # only used by qpth
         self._double_precision = double_precision
         self._scale = scale
+        self._embedding_cache = None # set by the trainer during evaluation
+        self._solver = solver # qpth or fista
+        self._solver_tol = solver_tol
+        self._solver_max_iter = solver_max_iter
+        # backpropagate from the KKT conditions of the solution instead of through the solver,
+        # always the case for fista whose unrolled iterations are too costly to backpropagate through
+        self._implicit_grad = implicit_grad or solver == 'fista'
+        self._kernel = kernel if kernel is not None else Kernel()
+        assert self._solver in ['qpth', 'fista'], "SVM solver not implemented"
+        print("SVM solver:", self._solver, "implicit grad:", self._implicit_grad)
         self.to(self._device)
 
         # scale
@@ -213,7 +888,8 @@ class SVM(Algorithm):
         print("Algorithm logits scale:", self._scale)
 
 
-    def inner_loop_adapt(self, support, support_labels, query, n_way, n_shot, n_query):
+    def inner_loop_adapt(self, support, support_labels, query, n_way, n_shot, n_query,
+        support_keys=None, query_keys=None, unique_images=None, unique_keys=None):
         """
         Fits the support set with multi-class SVM and 
         returns the classification score on the query set.
@@ -229,31 +905,23 @@ class SVM(Algorithm):
         n_way: a scalar. Represents the number of classes in a few-shot classification task.
         n_shot: a scalar. Represents the number of support examples given per class.
         C_reg: a scalar. Represents the cost parameter C in SVM.
+        support_keys, query_keys: optional per-image keys used to look up cached embeddings (see get_features).
+        unique_images, unique_keys: optional deduplicated images of the task batch, in which case
+            support and query are (tasks_per_batch, n) index Tensors into unique_images (see get_task_features).
         Returns: a (tasks_per_batch, n_query, n_way) Tensor.
         """
 
         measurements_trajectory = defaultdict(list)
 
-        assert(query.dim() == 5)
-        assert(support.dim() == 5)
-        
         # get features
-        orig_query_shape = query.shape
-        orig_support_shape = support.shape
-        support = self._model(
-            support.reshape(-1, *orig_support_shape[2:]), only_features=True).reshape(*orig_support_shape[:2], -1)
-        query = self._model(
-            query.reshape(-1, *orig_query_shape[2:]), only_features=True).reshape(*orig_query_shape[:2], -1)
-                
+        support, query = self.get_task_features(support, query,
+            support_keys, query_keys, unique_images, unique_keys)
 
         tasks_per_batch = query.size(0)
         total_n_support = support.size(1) # support samples across all classes in a task
         total_n_query = query.size(1)     # query samples across all classes in a task
         d = query.size(2)                 # dimension
 
-        C_reg = self._C_reg
-        maxIter = self._max_iter
-
         assert(query.dim() == 3)
         assert(support.dim() == 3)
         assert(query.size(0) == support.size(0) and query.size(2) == support.size(2))
@@ -272,7 +940,48 @@ class SVM(Algorithm):
         #This borrows the notation of liblinear.
         
         #\alpha is an (total_n_support, n_way) matrix
-        kernel_matrix = computeGramMatrix(support, support)
+        #with a kernel, x_i is replaced by its (exact or approximate) feature vector
+        kernel_matrix, compatibility_query = self._kernel.task_kernels(support, query)
+
+        if self._solver == 'fista':
+            qp_sol = self.solve_dual_fista(kernel_matrix, support_labels,
+                tasks_per_batch, total_n_support, n_way, measurements_trajectory)
+        else:
+            qp_sol = self.solve_dual_qpth(kernel_matrix, support_labels,
+                tasks_per_batch, total_n_support, n_way)
+
+        
+        # Compute the classification score for query.
+        compatibility_query = compatibility_query.float()
+        # (tasks_per_batch, total_n_query, total_n_support)
+        logits_query = torch.bmm(compatibility_query, qp_sol.float()) * self._scale
+
+        # Compute the classification score for support.
+        with torch.no_grad():
+            compatibility_support = kernel_matrix.float()
+            logits_support = torch.bmm(compatibility_support, qp_sol.float()) * self._scale
+            
+        # compute loss and acc on support
+        logits_support = logits_support.reshape(-1, logits_support.size(-1))
+        labels_support = support_labels.reshape(-1)
+        
+        loss = self._inner_loss_func(logits_support, labels_support)
+        accu = accuracy(logits_support, labels_support)
+        measurements_trajectory['loss'].append(loss.item())
+        measurements_trajectory['accu'].append(accu)
+
+
+        return logits_query, measurements_trajectory
+
+
+    def solve_dual_qpth(self, kernel_matrix, support_labels, tasks_per_batch, total_n_support, n_way):
+        """
+        Builds the (n_way * total_n_support)-dimensional QP for the SVM dual and solves it with qpth.
+        Returns: a (tasks_per_batch, total_n_support, n_way) Tensor.
+        """
+
+        C_reg = self._C_reg
+        maxIter = self._max_iter
 
         id_matrix_0 = torch.eye(n_way).expand(tasks_per_batch, n_way, n_way).cuda()
         block_kernel_matrix = batched_kronecker(kernel_matrix, id_matrix_0)
@@ -312,42 +1021,53 @@ class SVM(Algorithm):
         #        \hat z =   argmin_z 1/2 z^T G z + e^T z
         #                 subject to Cz <= h
         # We use detach() to prevent backpropagation to fixed variables.
-        qp_sol = QPFunction(verbose=False, maxIter=maxIter)(G, e.detach(), C.detach(), h.detach(), A.detach(), b.detach())
+        if self._implicit_grad:
+            # qpth only runs forward, the gradient w.r.t. G comes from the KKT conditions at qp_sol,
+            # with the active bounds identified from qpth's multipliers since qp_sol is only loosely converged.
+            # The solve is always in double precision, single precision iterates misidentify the active bounds.
+            qp_sol, lams, slacks = qpth_solve_with_multipliers(
+                *[x.detach().double() for x in [G, e, C, h, A, b]], max_iter=maxIter)
+            qp_sol = ImplicitQPFunction.apply(G, e.detach(), C.detach(), h.detach(), A.detach(), b.detach(), qp_sol, lams, slacks)
+        else:
+            qp_sol = QPFunction(verbose=False, maxIter=maxIter)(G, e.detach(), C.detach(), h.detach(), A.detach(), b.detach())
         # G is not detached, that is the only one that needs gradients, since its a function of phi(x).
 
         qp_sol = qp_sol.reshape(tasks_per_batch, total_n_support, n_way)
 
-        
-        # Compute the classification score for query.
-        compatibility_query = computeGramMatrix(support, query)
-        compatibility_query = compatibility_query.float()
-        compatibility_query = compatibility_query.unsqueeze(3).expand(tasks_per_batch, total_n_support, total_n_query, n_way)
-        logits_query = qp_sol.float().unsqueeze(2).expand(tasks_per_batch, total_n_support, total_n_query, n_way)
-        logits_query = logits_query * compatibility_query
-        logits_query = torch.sum(logits_query, 1) * self._scale
+        return qp_sol
 
-        # Compute the classification score for support.
+
+    def solve_dual_fista(self, kernel_matrix, support_labels, tasks_per_batch, total_n_support, n_way,
+        measurements_trajectory):
+        """
+        Solves the SVM dual directly on the (total_n_support, total_n_support) Gram matrix
+        with crammer_singer_svm_dual, which stops each task once it has converged,
+        and backpropagates with CrammerSingerImplicitFunction.
+        Returns: a (tasks_per_batch, total_n_support, n_way) Tensor.
+        """
+
+        support_labels_one_hot = one_hot(support_labels.view(tasks_per_batch * total_n_support), n_way)
+        support_labels_one_hot = support_labels_one_hot.view(tasks_per_batch, total_n_support, n_way)
+
+        if self._double_precision:
+            kernel_matrix = kernel_matrix.double()
+        else:
+            kernel_matrix = kernel_matrix.float()
+        # diag_reg=1.0 matches the 1.0 * I added to the block kernel matrix for qpth.
+        # The iterations are never recorded by autograd (up to solver_max_iter projections, each with a sort),
+        # the gradient always comes from the KKT conditions of the solution.
         with torch.no_grad():
-            compatibility_support = computeGramMatrix(support, support)
-            compatibility_support = compatibility_support.float()
-            compatibility_support = compatibility_support.unsqueeze(3).expand(tasks_per_batch, total_n_support, total_n_support, n_way)
-            logits_support = qp_sol.float().unsqueeze(2).expand(tasks_per_batch, total_n_support, total_n_support, n_way)
-            logits_support = logits_support * compatibility_support
-            logits_support = torch.sum(logits_support, 1) * self._scale
-            
-        # compute loss and acc on support
-        logits_support = logits_support.reshape(-1, logits_support.size(-1))
-        labels_support = support_labels.reshape(-1)
-        
-        loss = self._inner_loss_func(logits_support, labels_support)
-        accu = accuracy(logits_support, labels_support)
-        measurements_trajectory['loss'].append(loss.item())
-        measurements_trajectory['accu'].append(accu)
+            qp_sol, solver_info = crammer_singer_svm_dual(kernel_matrix.detach(), support_labels_one_hot, self._C_reg,
+                diag_reg=1.0, tol=self._solver_tol, max_iter=self._solver_max_iter)
+        qp_sol = CrammerSingerImplicitFunction.apply(kernel_matrix, support_labels_one_hot, qp_sol, self._C_reg, 1.0)
 
+        # per-task solver statistics
+        measurements_trajectory['svm_solver_iters'].append(solver_info['n_iter'].float().mean().item())
+        measurements_trajectory['svm_solver_converged'].append(solver_info['converged'].float().mean().item() * 100.)
+
+        return qp_sol
 
-        return logits_query, measurements_trajectory
 
-    
     def to(self, device, **kwargs):
         self._device = device
         self._model.to(device, **kwargs)
@@ -362,14 +1082,18 @@ class SVM(Algorithm):
 class ProtoNet(Algorithm):
 
     def __init__(self, model, inner_loss_func, device, 
-             metric, scale, normalize=True):
+             metric, scale, normalize=True, kernel=None):
         
         self._model = model
         self._device = device
         self._inner_loss_func = inner_loss_func
-        self._normalize = normalize
         self._scale = scale
         self._metric = metric # euc or cos
+        self._kernel = kernel if kernel is not None else Kernel()
+        # only the linear distances grow with the embedding dimension,
+        # the distances in the feature space of rbf (at most 2) or poly are not divided by it
+        self._normalize = normalize and self._kernel.name == 'linear'
+        self._embedding_cache = None # set by the trainer during evaluation
         self.to(self._device)
         
         # scale
@@ -380,7 +1104,8 @@ class ProtoNet(Algorithm):
         print("Algorithm logits scale:", self._scale)
 
    
-    def inner_loop_adapt(self, support, support_labels, query, n_way, n_shot, n_query):
+    def inner_loop_adapt(self, support, support_labels, query, n_way, n_shot, n_query,
+        support_keys=None, query_keys=None, unique_images=None, unique_keys=None):
         """
         Constructs the prototype representation of each class(=mean of support vectors of each class) and 
         returns the classification score (=L2 distance to each class prototype) on the query set.
@@ -396,23 +1121,19 @@ class ProtoNet(Algorithm):
         n_way: a scalar. Represents the number of classes in a few-shot classification task.
         n_shot: a scalar. Represents the number of support examples given per class.
         normalize: a boolean. Represents whether if we want to normalize the distances by the embedding dimension.
+        With a non-linear kernel the distances (or inner products) are taken in the feature space of the kernel
+        and are not normalized.
+        support_keys, query_keys: optional per-image keys used to look up cached embeddings (see get_features).
+        unique_images, unique_keys: optional deduplicated images of the task batch, in which case
+            support and query are (tasks_per_batch, n) index Tensors into unique_images (see get_task_features).
         Returns: a (tasks_per_batch, n_query, n_way) Tensor.
         """
 
         measurements_trajectory = defaultdict(list)
 
-        assert(query.dim() == 5)
-        assert(support.dim() == 5)
-        
         # get features
-        orig_query_shape = query.shape
-        orig_support_shape = support.shape
-
-        support = self._model(
-            support.reshape(-1, *orig_support_shape[2:]), only_features=True).reshape(*orig_support_shape[:2], -1)
-        query = self._model(
-            query.reshape(-1, *orig_query_shape[2:]), only_features=True).reshape(*orig_query_shape[:2], -1)
-        
+        support, query = self.get_task_features(support, query,
+            support_keys, query_keys, unique_images, unique_keys)
 
         tasks_per_batch = query.size(0)
         total_n_support = support.size(1) # support samples across all classes in a task
@@ -425,6 +1146,10 @@ class ProtoNet(Algorithm):
         assert(total_n_support == n_way * n_shot)
         assert(total_n_query == n_way * n_query)
 
+        if self._kernel.explicit:
+            # (approximate) kernel feature vectors, the identity for the linear kernel
+            support, query = self._kernel.feature_map(support, query)
+
         support_labels_one_hot = one_hot(support_labels.view(tasks_per_batch * total_n_support), n_way)
         support_labels_one_hot = support_labels_one_hot.view(tasks_per_batch, total_n_support, n_way)
     
@@ -441,7 +1166,11 @@ class ProtoNet(Algorithm):
         # Divide with the number of examples per novel category.
 
         
-        if self._metric == 'euclidean':
+        if not self._kernel.explicit:
+            logits_query, logits_support = self.kernel_prototype_scores(
+                support, query, labels_train_transposed, d)
+
+        elif self._metric == 'euclidean':
 
             ################################################
             # Compute the classification score for query
@@ -521,6 +1250,41 @@ class ProtoNet(Algorithm):
         return logits_query, measurements_trajectory
 
 
+    def kernel_prototype_scores(self, support, query, labels_train_transposed, d):
+        """
+        Computes the classification scores with the kernel trick when the prototypes
+        (=means of the support vectors in the feature space of the kernel) have no finite representation:
+        <phi(x), c_m> = mean_{i in m} k(x, x_i) and ||c_m||^2 = mean_{i, j in m} k(x_i, x_j).
+        Returns: a (tasks_per_batch, total_n_query, n_way) and a (tasks_per_batch, total_n_support, n_way) Tensor.
+        """
+
+        tasks_per_batch, n_way = labels_train_transposed.size(0), labels_train_transposed.size(1)
+        class_weights = labels_train_transposed / labels_train_transposed.sum(dim=2, keepdim=True)
+        # tasks_per_batch x n_way x total_n_support
+        kernel_matrix, compatibility_query = self._kernel.task_kernels(support, query)
+
+        AB_query = torch.bmm(compatibility_query, class_weights.transpose(1, 2))
+        AB_support = torch.bmm(kernel_matrix, class_weights.transpose(1, 2))
+        # batch_size x total_n x n_way
+
+        if self._metric == 'euclidean':
+            gamma = self._kernel.get_gamma(support)
+            BB = (torch.bmm(class_weights, kernel_matrix) * class_weights).sum(dim=2).reshape(tasks_per_batch, 1, n_way)
+            logits_query = -(self._kernel.diag(query, gamma) - 2 * AB_query + BB) * self._scale
+            logits_support = -(self._kernel.diag(support, gamma) - 2 * AB_support + BB) * self._scale
+            if self._normalize:
+                logits_query = logits_query / d
+                logits_support = logits_support / d
+        elif self._metric == 'cosine':
+            logits_query = AB_query * self._scale
+            with torch.no_grad():
+                logits_support = AB_support * self._scale
+        else:
+            raise ValueError("Metric not implemented")
+
+        return logits_query, logits_support
+
+
     def to(self, device, **kwargs):
         self._device = device
         self._model.to(device, **kwargs)
@@ -536,10 +1300,111 @@ class ProtoNet(Algorithm):
 
 
 
+class GDA(Algorithm):
+
+    def __init__(self, model, inner_loss_func, device,
+            scale, shrinkage=0.5, normalize=True, double_precision=False):
+
+        self._model = model
+        self._device = device
+        self._inner_loss_func = inner_loss_func
+        self._normalize = normalize
+        self._shrinkage = shrinkage
+        self._double_precision = double_precision
+        self._embedding_cache = None # set by the trainer during evaluation
+        self._scale = scale
+        self.to(self._device)
+
+        # scale
+        if isinstance(model, torch.nn.DataParallel) and hasattr(model.module, 'scale'):
+            self._scale = model.module.scale
+        elif hasattr(model, 'scale'):
+            self._scale = model.scale
+        print("Algorithm logits scale:", self._scale)
+
+
+    def inner_loop_adapt(self, support, support_labels, query, n_way, n_shot, n_query,
+        support_keys=None, query_keys=None, unique_images=None, unique_keys=None):
+        """
+        Fits a Gaussian discriminant analysis model (class means and a shrinkage-regularized
+        covariance shared by all classes) to the support set and
+        returns the classification score (=linear discriminant of each class) on the query set.
+        With shrinkage=1 it makes the same predictions as ProtoNet with the euclidean metric.
+
+        Parameters:
+        query:  a (n_tasks_per_batch, n_query, c, h, w) Tensor.
+        support:  a (n_tasks_per_batch, n_support, c, h, w) Tensor.
+        support_labels: a (n_tasks_per_batch, n_support) Tensor.
+        n_way: a scalar. Represents the number of classes in a few-shot classification task.
+        n_shot: a scalar. Represents the number of support examples given per class.
+        support_keys, query_keys: optional per-image keys used to look up cached embeddings (see get_features).
+        unique_images, unique_keys: optional deduplicated images of the task batch, in which case
+            support and query are (tasks_per_batch, n) index Tensors into unique_images (see get_task_features).
+        Returns: a (tasks_per_batch, n_query, n_way) Tensor.
+        """
+
+        measurements_trajectory = defaultdict(list)
+
+        # get features
+        support, query = self.get_task_features(support, query,
+            support_keys, query_keys, unique_images, unique_keys)
+
+        tasks_per_batch = query.size(0)
+        total_n_support = support.size(1) # support samples across all classes in a task
+        total_n_query = query.size(1)     # query samples across all classes in a task
+        d = query.size(2)                 # dimension
+
+        assert(query.dim() == 3)
+        assert(support.dim() == 3)
+        assert(query.size(0) == support.size(0) and query.size(2) == support.size(2))
+        assert(total_n_support == n_way * n_shot)
+        assert(total_n_query == n_way * n_query)
+
+        support_labels_one_hot = one_hot(support_labels.view(tasks_per_batch * total_n_support), n_way)
+        support_labels_one_hot = support_labels_one_hot.view(tasks_per_batch, total_n_support, n_way)
+
+        if self._double_precision:
+            support_solve, query_solve, support_labels_one_hot = [
+                x.double() for x in [support, query, support_labels_one_hot]]
+        else:
+            support_solve, query_solve, support_labels_one_hot = [
+                x.float() for x in [support, query, support_labels_one_hot]]
+
+        weights, biases = gda_discriminant_weights(support_solve, support_labels_one_hot, self._shrinkage)
+        # weights (tasks_per_batch, d, n_way), biases (tasks_per_batch, 1, n_way)
+
+        # Compute the classification score.
+        logits = (torch.bmm(query_solve, weights) + biases).float() * self._scale
+        if self._normalize:
+            logits = logits / d
+
+        # compute loss and acc on support
+        with torch.no_grad():
+            logits_support = (torch.bmm(support_solve, weights) + biases).float() * self._scale
+            if self._normalize:
+                logits_support = logits_support / d
+            logits_support = logits_support.reshape(-1, n_way)
+            loss = self._inner_loss_func(logits_support, support_labels.reshape(-1))
+            accu = accuracy(logits_support, support_labels.reshape(-1)) * 100.
+            measurements_trajectory['loss'].append(loss.item())
+            measurements_trajectory['accu'].append(accu)
+
+        return logits, measurements_trajectory
+
+    def to(self, device, **kwargs):
+        self._device = device
+        self._model.to(device, **kwargs)
+
+    def state_dict(self):
+        # for model saving and reloading
+        return {'model': self._model.state_dict()}
+
+
+
 class Ridge(Algorithm):
 
     def __init__(self, model, inner_loss_func, device, 
-            scale, normalize=True):
+            scale, normalize=True, kernel=None):
         
         self._model = model
         self._device = device
@@ -547,6 +1412,8 @@ class Ridge(Algorithm):
         self._normalize = normalize
         self._lambda_reg = 50.0
         self._double_precision = False
+        self._kernel = kernel if kernel is not None else Kernel()
+        self._embedding_cache = None # set by the trainer during evaluation
         self._scale = scale
         self.to(self._device)
 
@@ -559,7 +1426,8 @@ class Ridge(Algorithm):
 
 
 
-    def inner_loop_adapt(self, support, support_labels, query, n_way, n_shot, n_query):
+    def inner_loop_adapt(self, support, support_labels, query, n_way, n_shot, n_query,
+        support_keys=None, query_keys=None, unique_images=None, unique_keys=None):
 
         """
         Fits the support set with ridge regression and 
@@ -569,24 +1437,18 @@ class Ridge(Algorithm):
         support:  a (n_tasks_per_batch, n_support, c, h, w) Tensor.
         support_labels: a (tasks_per_batch, n_support) Tensor.
         lambda_reg: a scalar. Represents the strength of L2 regularization.
+        support_keys, query_keys: optional per-image keys used to look up cached embeddings (see get_features).
+        unique_images, unique_keys: optional deduplicated images of the task batch, in which case
+            support and query are (tasks_per_batch, n) index Tensors into unique_images (see get_task_features).
         Returns: a (tasks_per_batch, n_query, n_way) Tensor.
         """
 
 
         measurements_trajectory = defaultdict(list)
 
-        assert(query.dim() == 5)
-        assert(support.dim() == 5)
-        
         # get features
-        orig_query_shape = query.shape
-        orig_support_shape = support.shape
-        
-        support = self._model(
-            support.reshape(-1, *orig_support_shape[2:]), only_features=True).reshape(*orig_support_shape[:2], -1)
-        query = self._model(
-            query.reshape(-1, *orig_query_shape[2:]), only_features=True).reshape(*orig_query_shape[:2], -1)
-        
+        support, query = self.get_task_features(support, query,
+            support_keys, query_keys, unique_images, unique_keys)
         
         lambda_reg = self._lambda_reg
         double_precision = self._double_precision
@@ -603,70 +1465,165 @@ class Ridge(Algorithm):
 
         #Here we solve the dual problem:
         #Note that the classes are indexed by m & samples are indexed by i.
-        #min_{\alpha}  0.5 \sum_m ||w_m(\alpha)||^2 + \sum_i \sum_m e^m_i alpha^m_i
+        #min_{\alpha}  0.5 \sum_m ||w_m(\alpha)||^2 + 0.5 \lambda ||\alpha||^2 + \sum_i \sum_m e^m_i alpha^m_i
 
-        #where w_m(\alpha) = \sum_i \alpha^m_i x_i,
-        
-        #\alpha is an (total_n_support, n_way) matrix
-        kernel_matrix = computeGramMatrix(support, support)
-        kernel_matrix += lambda_reg * torch.eye(total_n_support).expand(tasks_per_batch, total_n_support, total_n_support).cuda()
+        #where w_m(\alpha) = \sum_i \alpha^m_i x_i and e^m_i = -2 if m = y_i, 0 otherwise.
+        #There are no constraints, so the minimizer is \alpha = 2 (K + \lambda I)^{-1} Y
+        #with Y the one-hot support labels; we get it with a batched Cholesky solve.
+        #When d < total_n_support we solve the equivalent d x d primal system instead
+        #for W = \sum_i x_i \alpha_i = 2 (X^T X + \lambda I)^{-1} X^T Y.
+        #With an approximated kernel x_i is its D-dimensional feature vector and d = D,
+        #with an exact non-linear kernel only the dual applies.
 
-        block_kernel_matrix = kernel_matrix.repeat(n_way, 1, 1) #(n_way * tasks_per_batch, total_n_support, total_n_support)
-        
         support_labels_one_hot = one_hot(support_labels.view(tasks_per_batch * total_n_support), n_way) # (tasks_per_batch * total_n_support, n_way)
-        support_labels_one_hot = support_labels_one_hot.transpose(0, 1) # (n_way, tasks_per_batch * total_n_support)
-        support_labels_one_hot = support_labels_one_hot.reshape(n_way * tasks_per_batch, total_n_support)     # (n_way*tasks_per_batch, total_n_support)
-        
-        G = block_kernel_matrix
-        e = -2.0 * support_labels_one_hot
-        
-        #This is a fake inequlity constraint as qpth does not support QP without an inequality constraint.
-        id_matrix_1 = torch.zeros(tasks_per_batch*n_way, total_n_support, total_n_support)
-        C = Variable(id_matrix_1)
-        h = Variable(torch.zeros((tasks_per_batch*n_way, total_n_support)))
-        dummy = Variable(torch.Tensor()).cuda()      # We want to ignore the equality constraint.
+        support_labels_one_hot = support_labels_one_hot.view(tasks_per_batch, total_n_support, n_way)
+        targets = 2.0 * support_labels_one_hot
 
         if double_precision:
-            G, e, C, h = [x.double().cuda() for x in [G, e, C, h]]
+            support_solve, query_solve, targets = [x.double() for x in [support, query, targets]]
+        else:
+            support_solve, query_solve, targets = [x.float() for x in [support, query, targets]]
 
+        if self._kernel.explicit:
+            support_solve, query_solve = self._kernel.feature_map(support_solve, query_solve)
+            d = support_solve.size(2)
+
+        if self._kernel.explicit and d < total_n_support:
+            weights = ridge_primal_weights(support_solve, targets, lambda_reg)
+            #weights (tasks_per_batch, d, n_way)
+            logits = torch.bmm(query_solve, weights)
+            with torch.no_grad():
+                logits_support = torch.bmm(support_solve, weights)
         else:
-            G, e, C, h = [x.float().cuda() for x in [G, e, C, h]]
+            if self._kernel.explicit:
+                kernel_matrix = computeGramMatrix(support_solve, support_solve)
+                compatibility = computeGramMatrix(query_solve, support_solve)
+            else:
+                kernel_matrix, compatibility = self._kernel.task_kernels(support_solve, query_solve)
+            dual_sol = ridge_dual_coefficients(kernel_matrix, targets, lambda_reg)
+            #dual_sol (tasks_per_batch, total_n_support, n_way)
+            #compatibility (tasks_per_batch, total_n_query, total_n_support)
+            logits = torch.bmm(compatibility, dual_sol)
+            with torch.no_grad():
+                logits_support = torch.bmm(kernel_matrix, dual_sol)
 
-        # Solve the following QP to fit SVM:
-        #        \hat z =   argmin_z 1/2 z^T G z + e^T z
-        #                 subject to Cz <= h
-        # We use detach() to prevent backpropagation to fixed variables.
-        qp_sol = QPFunction(verbose=False)(G, e.detach(), C.detach(), h.detach(), dummy.detach(), dummy.detach())
-        #qp_sol = QPFunction(verbose=False)(G, e.detach(), dummy.detach(), dummy.detach(), dummy.detach(), dummy.detach())
-
-        #qp_sol (n_way*tasks_per_batch, total_n_support)
-        qp_sol = qp_sol.reshape(n_way, tasks_per_batch, total_n_support)
-        #qp_sol (n_way, tasks_per_batch, total_n_support)
-        qp_sol = qp_sol.permute(1, 2, 0)
-        #qp_sol (tasks_per_batch, total_n_support, n_way)
+        # Compute the classification score.
+        logits = logits.float() * self._scale
+
+        # compute loss and acc on support
+        with torch.no_grad():
+            logits_support = logits_support.float().reshape(-1, n_way) * self._scale
+            loss = self._inner_loss_func(logits_support, support_labels.reshape(-1))
+            accu = accuracy(logits_support, support_labels.reshape(-1)) * 100.
+            measurements_trajectory['loss'].append(loss.item())
+            measurements_trajectory['accu'].append(accu)
+
+        return logits, measurements_trajectory
+
+    def to(self, device, **kwargs):
+        self._device = device
+        self._model.to(device, **kwargs)
+
+    def state_dict(self):
+        # for model saving and reloading
+        return {'model': self._model.state_dict()}
+
+
+
+class LogisticRegressionHead(Algorithm):
+
+    def __init__(self, model, inner_loss_func, device, scale,
+        lambda_reg=0.1, solver='newton', max_iter=20, tol=1e-5, double_precision=False,
+        hessian_solver='cg'):
         
+        self._model = model
+        self._device = device
+        self._inner_loss_func = inner_loss_func
+        self._lambda_reg = lambda_reg
+        self._solver = solver # newton or lbfgs
+        self._max_iter = max_iter
+        self._tol = tol
+        self._double_precision = double_precision
+        # (H + lambda I)^{-1} of the Newton steps and of the implicit gradient, cg or woodbury
+        self._hessian_solver = hessian_solver
+        self._embedding_cache = None # set by the trainer during evaluation
+        self._scale = scale
+        assert self._solver in ['newton', 'lbfgs'], "logistic regression solver not implemented"
+        print("Logistic regression solver:", self._solver, "lambda:", self._lambda_reg, "hessian solver:", self._hessian_solver)
+        self.to(self._device)
+
+        # scale
+        if isinstance(model, torch.nn.DataParallel) and hasattr(model.module, 'scale'):
+            self._scale = model.module.scale
+        elif hasattr(model, 'scale'):
+            self._scale = model.scale
+        print("Algorithm logits scale:", self._scale)
+
+
+
+    def inner_loop_adapt(self, support, support_labels, query, n_way, n_shot, n_query,
+        support_keys=None, query_keys=None, unique_images=None, unique_keys=None):
+
+        """
+        Fits the support set of every task with L2 regularized multinomial logistic regression
+        (with a bias) and returns the classification score on the query set.
+        All tasks are fitted at once with batched Newton or L-BFGS (batched_logistic_regression_fit),
+        the gradient with respect to the support features comes from the implicit function theorem
+        at the solution (LogisticRegressionImplicitFunction), not from the solver iterations.
+        Parameters:
+        query:  a (tasks_per_batch, n_query, c, h, w) Tensor.
+        support:  a (tasks_per_batch, n_support, c, h, w) Tensor.
+        support_labels: a (tasks_per_batch, n_support) Tensor.
+        support_keys, query_keys: optional per-image keys used to look up cached embeddings (see get_features).
+        unique_images, unique_keys: optional deduplicated images of the task batch, in which case
+            support and query are (tasks_per_batch, n) index Tensors into unique_images (see get_task_features).
+        Returns: a (tasks_per_batch, n_query, n_way) Tensor.
+        """
+
+        measurements_trajectory = defaultdict(list)
+
+        # get features
+        support, query = self.get_task_features(support, query,
+            support_keys, query_keys, unique_images, unique_keys)
+
+        tasks_per_batch = query.size(0)
+        total_n_support = support.size(1) # support samples across all classes in a task
+        total_n_query = query.size(1)     # query samples across all classes in a task
+
+        assert(query.dim() == 3)
+        assert(support.dim() == 3)
+        assert(query.size(0) == support.size(0) and query.size(2) == support.size(2))
+        assert(total_n_support == n_way * n_shot)      # total_n_support must equal to n_way * n_shot
+        assert(total_n_query == n_way * n_query)      # total_n_query must equal to n_way * n_query
+
+        if self._double_precision:
+            support, query = support.double(), query.double()
+        else:
+            support, query = support.float(), query.float()
+        # the last feature is the bias
+        support = torch.cat([support, support.new_ones(tasks_per_batch, total_n_support, 1)], dim=2)
+        query = torch.cat([query, query.new_ones(tasks_per_batch, total_n_query, 1)], dim=2)
+
+        with torch.no_grad():
+            weights, n_iter = batched_logistic_regression_fit(support.detach(), support_labels, n_way,
+                lambda_reg=self._lambda_reg, solver=self._solver, max_iter=self._max_iter, tol=self._tol,
+                hessian_solver=self._hessian_solver)
+        if torch.is_grad_enabled():
+            weights = LogisticRegressionImplicitFunction.apply(support, support_labels, weights,
+                self._lambda_reg, self._hessian_solver)
+        #weights (tasks_per_batch, n_way, d+1)
+
         # Compute the classification score.
-        compatibility = computeGramMatrix(support, query)
-        compatibility = compatibility.float()
-        compatibility = compatibility.unsqueeze(3).expand(tasks_per_batch, total_n_support, total_n_query, n_way)
-        qp_sol = qp_sol.reshape(tasks_per_batch, total_n_support, n_way)
-        logits = qp_sol.float().unsqueeze(2).expand(tasks_per_batch, total_n_support, total_n_query, n_way)
-        logits = logits * compatibility
-        logits = torch.sum(logits, 1) * self._scale
+        logits = torch.bmm(query, weights.transpose(1, 2)).float() * self._scale
 
         # compute loss and acc on support
         with torch.no_grad():
-            compatibility = computeGramMatrix(support, support)
-            compatibility = compatibility.float()
-            compatibility = compatibility.unsqueeze(3).expand(tasks_per_batch, total_n_support, total_n_support, n_way)
-            logits_support = qp_sol.float().unsqueeze(2).expand(tasks_per_batch, total_n_support, total_n_support, n_way)
-            logits_support = logits_support * compatibility
-            logits_support = torch.sum(logits_support, 1)
-            logits_support = logits_support.reshape(-1, logits_support.size(-1)) * self._scale
+            logits_support = torch.bmm(support, weights.transpose(1, 2)).float().reshape(-1, n_way) * self._scale
             loss = self._inner_loss_func(logits_support, support_labels.reshape(-1))
             accu = accuracy(logits_support, support_labels.reshape(-1)) * 100.
             measurements_trajectory['loss'].append(loss.item())
             measurements_trajectory['accu'].append(accu)
+            measurements_trajectory['solver_iterations'].append(n_iter)
 
         return logits, measurements_trajectory
 
@@ -2,18 +2,23 @@ import time
 import numpy as np
 from scipy.special import softmax
 import torch
+import torch.nn.functional as F
 from copy import deepcopy
+from qpth.solvers.pdipm import batch as pdipm_b
 
 DEFAULT_MEMO = dict()
 
-def computeGramMatrix(A, B):
+def computeGramMatrix(A, B, kernel='linear', gamma=1., degree=3, coef0=1.):
     """
-    Constructs a linear kernel matrix between A and B.
+    Constructs a kernel matrix between A and B.
     We assume that each row in A and B represents a d-dimensional feature vector.
     
     Parameters:
       A:  a (n_batch, n, d) Tensor.
       B:  a (n_batch, m, d) Tensor.
+      kernel: linear (a^T b), rbf (exp(-gamma * ||a - b||^2)) or poly ((gamma * a^T b + coef0)^degree).
+      gamma: a scalar or a (n_batch, 1, 1) Tensor. Not used by the linear kernel.
+      degree, coef0: scalars. Only used by the poly kernel.
     Returns: a (n_batch, n, m) Tensor.
     """
     
@@ -21,7 +26,565 @@ def computeGramMatrix(A, B):
     assert(B.dim() == 3)
     assert(A.size(0) == B.size(0) and A.size(2) == B.size(2))
 
-    return torch.bmm(A, B.transpose(1,2))
+    AB = torch.bmm(A, B.transpose(1,2))
+    if kernel == 'linear':
+        return AB
+    elif kernel == 'rbf':
+        AA = (A * A).sum(dim=2, keepdim=True)
+        BB = (B * B).sum(dim=2).unsqueeze(1)
+        return torch.exp(-gamma * (AA - 2 * AB + BB).clamp(min=0.))
+    elif kernel == 'poly':
+        return (gamma * AB + coef0) ** degree
+    else:
+        raise ValueError("Kernel not implemented")
+
+
+class Kernel(object):
+    """
+    The kernel used by the SVM, Ridge and ProtoNet heads, either computed exactly
+    or approximated with an explicit n_components-dimensional feature map:
+      nystrom: phi(x) = k(x, Z) L^{-T} with K_ZZ = L L^T, for n_components landmarks Z
+               sampled from the support set of each task (any kernel).
+      random_features: random Fourier features phi(x) = sqrt(2 / D) cos(x W + b)
+               with W ~ N(0, 2 gamma I) (Rahimi and Recht, NIPS 2007, rbf kernel only).
+    With a feature map the heads work in the D-dimensional feature space, which costs
+    O(n * D) kernel evaluations per task instead of the O(n^2) of the exact kernel matrix.
+    The linear kernel is always exact (its feature map is the identity).
+
+    gamma=None uses 1 / (d * variance of the support features) for each task.
+    """
+
+    def __init__(self, name='linear', gamma=None, degree=3, coef0=1.,
+            approximation='exact', n_components=256, jitter=1e-6):
+        if name not in ['linear', 'rbf', 'poly']:
+            raise ValueError("Kernel not implemented")
+        if approximation not in ['exact', 'nystrom', 'random_features']:
+            raise ValueError("Kernel approximation not implemented")
+        if approximation == 'random_features' and name == 'poly':
+            raise ValueError("random_features only approximates the rbf kernel, use nystrom")
+        self.name = name
+        self.gamma = gamma
+        self.degree = degree
+        self.coef0 = coef0
+        self.approximation = approximation
+        self.n_components = n_components
+        self.jitter = jitter
+
+    @property
+    def explicit(self):
+        # True when the heads can work with (possibly approximate) feature vectors
+        return self.name == 'linear' or self.approximation != 'exact'
+
+    def get_gamma(self, support):
+        """
+        Returns the kernel width for every task, a scalar or a (n_batch, 1, 1) Tensor.
+        """
+        if self.gamma is not None:
+            return self.gamma
+        with torch.no_grad():
+            variance = support.reshape(support.size(0), -1).var(dim=1).clamp(min=1e-12)
+        return (1. / (support.size(2) * variance)).view(-1, 1, 1)
+
+    def __call__(self, A, B, gamma):
+        return computeGramMatrix(A, B, self.name, gamma, self.degree, self.coef0)
+
+    def diag(self, A, gamma):
+        """
+        Returns k(a, a) for every row of A, a (n_batch, n, 1) Tensor.
+        """
+        AA = (A * A).sum(dim=2, keepdim=True)
+        if self.name == 'linear':
+            return AA
+        elif self.name == 'rbf':
+            return torch.ones_like(AA)
+        else:
+            return (gamma * AA + self.coef0) ** self.degree
+
+    def task_kernels(self, support, query):
+        """
+        Returns the (n_batch, n_support, n_support) support kernel matrix and
+        the (n_batch, n_query, n_support) query-support kernel matrix.
+        """
+        if self.explicit:
+            support, query = self.feature_map(support, query)
+            return computeGramMatrix(support, support), computeGramMatrix(query, support)
+        gamma = self.get_gamma(support)
+        return self(support, support, gamma), self(query, support, gamma)
+
+    def feature_map(self, support, query):
+        """
+        Maps the support and query features of every task to the feature space of the
+        approximation, a (n_batch, n_support, D) and a (n_batch, n_query, D) Tensor.
+        """
+        if self.name == 'linear':
+            return support, query
+        assert self.approximation != 'exact', "the exact rbf and poly kernels have no finite feature map"
+
+        n_batch, n, d = support.size()
+        gamma = self.get_gamma(support)
+        if self.approximation == 'random_features':
+            # a fresh draw for every task, shared by its support and query sets
+            W = torch.randn(n_batch, d, self.n_components, dtype=support.dtype, device=support.device)
+            W = W * torch.sqrt(2. * torch.as_tensor(gamma, dtype=support.dtype, device=support.device))
+            b = 2 * np.pi * torch.rand(n_batch, 1, self.n_components, dtype=support.dtype, device=support.device)
+            scale = np.sqrt(2. / self.n_components)
+            return scale * torch.cos(torch.bmm(support, W) + b), scale * torch.cos(torch.bmm(query, W) + b)
+
+        # nystrom, landmarks are the whole support set when it is small enough
+        if n <= self.n_components:
+            landmarks = support
+        else:
+            index = torch.rand(n_batch, n, device=support.device).argsort(dim=1)[:, :self.n_components]
+            landmarks = torch.gather(support, 1, index.unsqueeze(2).expand(-1, -1, d))
+        K_landmarks = self(landmarks, landmarks, gamma)
+        m = K_landmarks.size(1)
+        jitter = self.jitter * K_landmarks.diagonal(dim1=1, dim2=2).mean(dim=1).detach().view(n_batch, 1, 1)
+        L = torch.linalg.cholesky(K_landmarks + jitter * torch.eye(m, dtype=support.dtype, device=support.device))
+        # phi(x)^T = L^{-1} k(Z, x)
+        def phi(X):
+            return torch.linalg.solve_triangular(L, self(landmarks, X, gamma), upper=False).transpose(1, 2)
+        return phi(support), phi(query)
+
+
+def ridge_dual_coefficients(kernel_matrix, targets, lambda_reg):
+    """
+    Solves the dual ridge regression system (K + lambda_reg * I) alpha = targets
+    for every task in the batch with a Cholesky factorization.
+    The solve is differentiable with respect to kernel_matrix.
+
+    Parameters:
+      kernel_matrix:  a (n_batch, n, n) Tensor.
+      targets:  a (n_batch, n, m) Tensor.
+      lambda_reg: a scalar. Represents the strength of L2 regularization.
+    Returns: a (n_batch, n, m) Tensor of dual coefficients.
+    """
+
+    assert(kernel_matrix.dim() == 3)
+    assert(targets.dim() == 3)
+    assert(kernel_matrix.size(1) == kernel_matrix.size(2) == targets.size(1))
+
+    n = kernel_matrix.size(1)
+    id_matrix = torch.eye(n, dtype=kernel_matrix.dtype, device=kernel_matrix.device)
+    L = torch.linalg.cholesky(kernel_matrix + lambda_reg * id_matrix)
+    return torch.cholesky_solve(targets, L)
+
+
+def ridge_primal_weights(support, targets, lambda_reg):
+    """
+    Solves the primal ridge regression system (X^T X + lambda_reg * I) W = X^T targets
+    for every task in the batch with a Cholesky factorization.
+    This gives the same predictor as ridge_dual_coefficients (W = X^T alpha)
+    and is cheaper whenever the feature dimension d is smaller than n.
+
+    Parameters:
+      support:  a (n_batch, n, d) Tensor.
+      targets:  a (n_batch, n, m) Tensor.
+      lambda_reg: a scalar. Represents the strength of L2 regularization.
+    Returns: a (n_batch, d, m) Tensor of weights.
+    """
+
+    assert(support.dim() == 3)
+    assert(targets.dim() == 3)
+    assert(support.size(0) == targets.size(0) and support.size(1) == targets.size(1))
+
+    d = support.size(2)
+    id_matrix = torch.eye(d, dtype=support.dtype, device=support.device)
+    covariance = torch.bmm(support.transpose(1, 2), support)
+    L = torch.linalg.cholesky(covariance + lambda_reg * id_matrix)
+    return torch.cholesky_solve(torch.bmm(support.transpose(1, 2), targets), L)
+
+
+def gda_discriminant_weights(support, support_labels_one_hot, shrinkage, jitter=1e-6):
+    """
+    Fits a Gaussian discriminant analysis model with a shared covariance
+    to every task in the batch and returns its linear discriminant functions.
+
+    The covariance is the within-class covariance S_w shrunk towards a scaled identity,
+        Sigma = (1 - shrinkage) * S_w + shrinkage * (tr(S_t) / d) * I,
+    where S_t is the total covariance of the support set around its mean, which unlike S_w
+    is non-zero in the 1-shot case. The discriminant of class c is
+        x^T Sigma^{-1} mu_c - 0.5 * mu_c^T Sigma^{-1} mu_c (uniform class priors).
+    Like ridge_primal_weights / ridge_dual_coefficients, Sigma^{-1} is applied with a
+    Cholesky factorization of the d x d covariance when d < n, and otherwise with the
+    Woodbury identity through a Cholesky factorization of an n x n matrix.
+    Everything is differentiable with respect to support.
+
+    Parameters:
+      support:  a (n_batch, n, d) Tensor.
+      support_labels_one_hot:  a (n_batch, n, n_way) Tensor.
+      shrinkage: a scalar in (0, 1]. 1 gives nearest class mean with a Euclidean metric.
+      jitter: a scalar added to the identity target for numerical stability.
+    Returns: a (n_batch, d, n_way) Tensor of weights and a (n_batch, 1, n_way) Tensor of biases.
+    """
+
+    assert(support.dim() == 3)
+    assert(support_labels_one_hot.dim() == 3)
+    assert(support.size(0) == support_labels_one_hot.size(0) and support.size(1) == support_labels_one_hot.size(1))
+    assert(0. < shrinkage <= 1.)
+
+    n_batch, n, d = support.size()
+    labels_transposed = support_labels_one_hot.transpose(1, 2)
+    # class means (n_batch, n_way, d)
+    means = torch.bmm(labels_transposed, support) / labels_transposed.sum(dim=2, keepdim=True)
+    # support centered around its own class mean (n_batch, n, d)
+    centered = support - torch.bmm(support_labels_one_hot, means)
+    total_centered = support - support.mean(dim=1, keepdim=True)
+    # tr(S_t) / d, the scale of the identity target (n_batch, 1, 1)
+    identity_scale = (total_centered * total_centered).sum(dim=(1, 2)).view(n_batch, 1, 1) / (n * d)
+    identity_scale = shrinkage * identity_scale + jitter
+    scatter_scale = (1. - shrinkage) / n
+
+    if d < n:
+        id_matrix = torch.eye(d, dtype=support.dtype, device=support.device)
+        covariance = scatter_scale * torch.bmm(centered.transpose(1, 2), centered) + identity_scale * id_matrix
+        L = torch.linalg.cholesky(covariance)
+        weights = torch.cholesky_solve(means.transpose(1, 2), L)
+    else:
+        # Sigma^{-1} = (I - Xc^T (Xc Xc^T + (t / s) I)^{-1} Xc) / t, with s = scatter_scale, t = identity_scale
+        id_matrix = torch.eye(n, dtype=support.dtype, device=support.device)
+        means_transposed = means.transpose(1, 2)
+        if scatter_scale > 0.:
+            L = torch.linalg.cholesky(computeGramMatrix(centered, centered) + (identity_scale / scatter_scale) * id_matrix)
+            correction = torch.bmm(centered.transpose(1, 2),
+                torch.cholesky_solve(torch.bmm(centered, means_transposed), L))
+            weights = (means_transposed - correction) / identity_scale
+        else:
+            weights = means_transposed / identity_scale
+
+    biases = -0.5 * (means * weights.transpose(1, 2)).sum(dim=2).unsqueeze(1)
+    return weights, biases
+
+
+def crammer_singer_projection(V, upper):
+    """
+    Euclidean projection of every row v of V onto the set {a : a <= u, sum(a) = 0},
+    where u is the matching row of upper (all entries of u must be nonnegative).
+    The solution is a = min(u, v - theta) with the scalar theta found exactly by sorting.
+
+    Parameters:
+      V:  a (n_batch, n, m) Tensor.
+      upper:  a (n_batch, n, m) Tensor.
+    Returns: a (n_batch, n, m) Tensor.
+    """
+
+    m = V.size(-1)
+    # entries with the largest v - u are the first ones to be clamped at u
+    breakpoints, order = torch.sort(V - upper, dim=-1, descending=True)
+    V_sorted = torch.gather(V, -1, order)
+    upper_sorted = torch.gather(upper, -1, order)
+
+    # theta_k assumes the first k sorted entries are clamped and the rest are free
+    zeros = V.new_zeros(V.shape[:-1] + (1,))
+    clamped_upper = torch.cat([zeros, torch.cumsum(upper_sorted, dim=-1)[..., :-1]], dim=-1)
+    clamped_v = torch.cat([zeros, torch.cumsum(V_sorted, dim=-1)[..., :-1]], dim=-1)
+    n_free = torch.arange(m, 0, -1, dtype=V.dtype, device=V.device)
+    thetas = (V.sum(dim=-1, keepdim=True) - clamped_v + clamped_upper) / n_free
+
+    # the right k is the first one whose first free entry is indeed below the threshold
+    valid = thetas >= breakpoints
+    k = torch.argmax(valid.to(torch.uint8), dim=-1, keepdim=True)
+    theta = torch.gather(thetas, -1, k)
+
+    return torch.min(upper, V - theta)
+
+
+def crammer_singer_svm_dual(kernel_matrix, support_labels_one_hot, C_reg,
+        diag_reg=1.0, tol=1e-4, max_iter=1000):
+    """
+    Solves the dual of the multi-class SVM of Crammer and Singer for every task in the batch:
+        min_alpha  0.5 tr(alpha^T K alpha) + 0.5 diag_reg ||alpha||^2 - tr(Y^T alpha)
+        s.t.  alpha^m_i <= C_reg Y^m_i,  sum_m alpha^m_i = 0.
+    This is the same QP as the (n m) x (n m) one built for qpth in SVM.inner_loop_adapt,
+    but we work on the n x n Gram matrix directly with accelerated projected gradient
+    (FISTA with adaptive restart), projecting each sample onto its own constraint set.
+
+    A task stops updating once the infinity norm of its gradient mapping falls below tol,
+    so tasks converge independently and the loop exits as soon as all of them have.
+
+    Parameters:
+      kernel_matrix:  a (n_batch, n, n) Tensor.
+      support_labels_one_hot:  a (n_batch, n, m) Tensor.
+      C_reg: a scalar. Represents the cost parameter C in SVM.
+      diag_reg: a scalar added to the diagonal of the kernel (keeps the problem strongly convex).
+      tol: a scalar. Convergence tolerance on the gradient mapping.
+      max_iter: maximum number of iterations.
+    Returns:
+      a (n_batch, n, m) Tensor alpha,
+      a dict with 'n_iter' (n_batch,) LongTensor and 'converged' (n_batch,) BoolTensor.
+    """
+
+    assert(kernel_matrix.dim() == 3)
+    assert(support_labels_one_hot.dim() == 3)
+
+    n_batch = kernel_matrix.size(0)
+    Y = support_labels_one_hot.to(kernel_matrix.dtype)
+    upper = C_reg * Y
+
+    # step size from the largest eigenvalue of K + diag_reg * I
+    with torch.no_grad():
+        lipschitz = torch.linalg.eigvalsh(kernel_matrix.detach())[:, -1] + diag_reg
+    step = (1. / lipschitz).reshape(n_batch, 1, 1)
+
+    def grad(alpha):
+        return torch.bmm(kernel_matrix, alpha) + diag_reg * alpha - Y
+
+    alpha = torch.zeros_like(Y) # feasible since upper >= 0
+    extrapolated = alpha
+    t = Y.new_ones(n_batch, 1, 1)
+    n_iter = torch.zeros(n_batch, dtype=torch.long, device=Y.device)
+    converged = torch.zeros(n_batch, dtype=torch.bool, device=Y.device)
+
+    for _ in range(max_iter):
+        alpha_new = crammer_singer_projection(extrapolated - step * grad(extrapolated), upper)
+        with torch.no_grad():
+            residual = (extrapolated - alpha_new).abs().amax(dim=(1, 2)) / step.reshape(-1)
+            # restart momentum when it points uphill
+            restart = ((extrapolated - alpha_new) * (alpha_new - alpha)).sum(dim=(1, 2)) > 0
+
+        active = (~converged).reshape(n_batch, 1, 1)
+        alpha_next = torch.where(active, alpha_new, alpha)
+        t_next = torch.where(restart.reshape(n_batch, 1, 1), torch.ones_like(t), (1 + torch.sqrt(1 + 4 * t * t)) / 2)
+        momentum = torch.where(restart.reshape(n_batch, 1, 1), torch.zeros_like(t), (t - 1) / t_next)
+        extrapolated = alpha_next + momentum * (alpha_next - alpha)
+        alpha, t = alpha_next, t_next
+
+        n_iter += (~converged).long()
+        converged = converged | (residual <= tol)
+        if bool(converged.all()):
+            break
+
+    return alpha, {'n_iter': n_iter, 'converged': converged}
+
+
+def qpth_solve_with_multipliers(G, e, C, h, A, b, max_iter=15):
+    """
+    Solves the batched QP
+        min_z 1/2 z^T G z + e^T z   s.t.  Cz <= h, Az = b
+    with the batched interior point method of qpth (the one behind QPFunction),
+    also returning the multipliers and slacks of the inequalities at the last iterate.
+    Nothing is differentiated, all the inputs must be (n_batch, ...) Tensors.
+
+    Returns:
+      z: a (n_batch, n) Tensor,
+      lams: a (n_batch, n_ineq) Tensor of inequality multipliers,
+      slacks: a (n_batch, n_ineq) Tensor, h - Cz.
+    """
+
+    with torch.no_grad():
+        Q_LU, S_LU, R = pdipm_b.pre_factor_kkt(G, C, A)
+        z, _, lams, slacks = pdipm_b.forward(G, e, C, h, A, b, Q_LU, S_LU, R,
+            eps=1e-12, verbose=0, notImprovedLim=3, maxIter=max_iter)
+    return z, lams, slacks
+
+
+class ImplicitQPFunction(torch.autograd.Function):
+    """
+    Differentiates the solution z of the batched QP
+        min_z 1/2 z^T G z + e^T z   s.t.  Cz <= h, Az = b
+    from the KKT conditions at z alone, whatever solver produced z.
+    The backward pass is a single linear solve whose memory does not depend
+    on how many solver iterations were run.
+
+    The active inequalities are treated as equalities and the rest as inactive.
+    If the KKT matrix of a task is singular (e.g. a wrongly identified active set),
+    its system is solved in the least squares sense.
+    When the solver gives the inequality multipliers and slacks (e.g. qpth_solve_with_multipliers),
+    the active ones are those whose multiplier exceeds their slack, which still identifies them
+    at the loosely converged iterates of an interior point method. Otherwise the inequalities
+    with slack h - Cz <= active_tol * (1 + |h|) are active, which needs a tightly converged z.
+
+    Usage: z = ImplicitQPFunction.apply(G, e, C, h, A, b, z_solution, lams, slacks)
+    or     z = ImplicitQPFunction.apply(G, e, C, h, A, b, z_solution, None, None, active_tol)
+    Gradients are returned for G and e only; C, h, A, b are treated as constants.
+    Pass empty tensors for C, h (or A, b) when there are no such constraints.
+    """
+
+    @staticmethod
+    def forward(ctx, G, e, C, h, A, b, z, lams=None, slacks=None, active_tol=1e-6):
+        z = z.detach().to(G.dtype)
+        if C.numel() > 0 and lams is not None:
+            active = (lams > slacks).to(G.dtype)
+        elif C.numel() > 0:
+            slack = h - torch.bmm(C, z.unsqueeze(2)).squeeze(2)
+            active = (slack <= active_tol * (1 + h.abs())).to(G.dtype)
+        else:
+            active = G.new_zeros(G.size(0), 0)
+        ctx.save_for_backward(G, C, A, z, active)
+        return z.clone()
+
+
+    @staticmethod
+    def backward(ctx, grad_z):
+        G, C, A, z, active = ctx.saved_tensors
+        n_batch, n = z.shape
+        n_ineq = C.size(1) if C.numel() > 0 else 0
+        n_eq = A.size(1) if A.numel() > 0 else 0
+
+        # symmetric KKT matrix: inactive inequalities only pin their multiplier to 0
+        #  [ G       C^T D    A^T ]
+        #  [ D C     I - D    0   ]
+        #  [ A       0        0   ]
+        kkt = G.new_zeros(n_batch, n + n_ineq + n_eq, n + n_ineq + n_eq)
+        kkt[:, :n, :n] = G
+        if n_ineq > 0:
+            DC = active.unsqueeze(2) * C
+            kkt[:, n:n + n_ineq, :n] = DC
+            kkt[:, :n, n:n + n_ineq] = DC.transpose(1, 2)
+            kkt[:, n:n + n_ineq, n:n + n_ineq] = torch.diag_embed(1 - active)
+        if n_eq > 0:
+            kkt[:, n + n_ineq:, :n] = A
+            kkt[:, :n, n + n_ineq:] = A.transpose(1, 2)
+
+        rhs = G.new_zeros(n_batch, n + n_ineq + n_eq, 1)
+        rhs[:, :n, 0] = grad_z.to(G.dtype)
+        solution, info = torch.linalg.solve_ex(kkt, rhs)
+        # a wrongly identified active set (e.g. linearly dependent active constraints) can make
+        # the KKT matrix singular, those systems get the minimum norm least squares solution
+        # (pseudo-inverse of the symmetric KKT matrix) instead of inf/nan gradients
+        singular = (info > 0) | ~torch.isfinite(solution).flatten(1).all(dim=1)
+        if singular.any():
+            solution[singular] = torch.linalg.pinv(kkt[singular], hermitian=True) @ rhs[singular]
+        d_z = -solution[:, :n, 0]
+
+        grad_G = 0.5 * (d_z.unsqueeze(2) * z.unsqueeze(1) + z.unsqueeze(2) * d_z.unsqueeze(1))
+        grad_e = d_z
+        return grad_G, grad_e, None, None, None, None, None, None, None, None
+
+
+class CrammerSingerImplicitFunction(torch.autograd.Function):
+    """
+    Backward pass of crammer_singer_svm_dual from the KKT conditions of its solution,
+    without building the (n m) x (n m) Kronecker system used by ImplicitQPFunction.
+
+    Entries with alpha^m_i = C_reg Y^m_i are the active bounds. The gradient restricted to
+    {v : v_active = 0, sum_m v^m_i = 0} solves P (K v + diag_reg v) = P grad_alpha,
+    which we get with batched conjugate gradient using only bmm's with the n x n kernel.
+
+    Usage: alpha = CrammerSingerImplicitFunction.apply(kernel_matrix, Y, alpha_solution, C_reg, diag_reg)
+    Gradients are returned for kernel_matrix only.
+    """
+
+    @staticmethod
+    def forward(ctx, kernel_matrix, support_labels_one_hot, alpha, C_reg, diag_reg=1.0,
+            cg_tol=1e-6, cg_max_iter=200):
+        alpha = alpha.detach().to(kernel_matrix.dtype)
+        upper = C_reg * support_labels_one_hot.to(kernel_matrix.dtype)
+        active = alpha >= upper - 1e-7 * (1 + upper.abs())
+        ctx.save_for_backward(kernel_matrix, alpha, active)
+        ctx.diag_reg = diag_reg
+        ctx.cg_tol = cg_tol
+        ctx.cg_max_iter = cg_max_iter
+        return alpha.clone()
+
+
+    @staticmethod
+    def backward(ctx, grad_alpha):
+        kernel_matrix, alpha, active = ctx.saved_tensors
+        free = (~active).to(kernel_matrix.dtype)
+        n_free = free.sum(dim=2, keepdim=True).clamp(min=1)
+
+        def project(v):
+            # zero the active entries and center the free entries of every sample
+            v = v * free
+            return v - free * v.sum(dim=2, keepdim=True) / n_free
+
+        def hessian(v):
+            return project(torch.bmm(kernel_matrix, v) + ctx.diag_reg * v)
+
+        u = batched_conjugate_gradient(hessian, project(grad_alpha.to(kernel_matrix.dtype)),
+            tol=ctx.cg_tol, max_iter=ctx.cg_max_iter)
+        d_alpha = -u
+
+        # G = K kron I + diag_reg I, so dL/dK_ij = sum_m dL/dG_(i,m),(j,m)
+        grad_kernel = 0.5 * (torch.bmm(d_alpha, alpha.transpose(1, 2)) + torch.bmm(alpha, d_alpha.transpose(1, 2)))
+        return grad_kernel, None, None, None, None, None, None
+
+
+def batched_conjugate_gradient(matvec, rhs, tol=1e-6, max_iter=200):
+    """
+    Solves matvec(x) = rhs for every task in the batch with conjugate gradient,
+    where matvec is a symmetric positive (semi-)definite linear operator on tensors shaped like rhs.
+    Each task stops updating once its residual norm is below tol * ||rhs||.
+
+    Parameters:
+      matvec: a callable mapping a (n_batch, ...) Tensor to a Tensor of the same shape.
+      rhs:  a (n_batch, ...) Tensor.
+    Returns: a (n_batch, ...) Tensor.
+    """
+
+    n_batch = rhs.size(0)
+    view = (n_batch,) + (1,) * (rhs.dim() - 1)
+
+    def dot(a, b):
+        return (a * b).reshape(n_batch, -1).sum(dim=1)
+
+    x = torch.zeros_like(rhs)
+    r = rhs.clone()
+    p = r.clone()
+    rr = dot(r, r)
+    threshold = (tol ** 2) * rr
+    for _ in range(max_iter):
+        active = rr > threshold
+        if not bool(active.any()):
+            break
+        Ap = matvec(p)
+        pAp = dot(p, Ap)
+        step = torch.where(active & (pAp > 0), rr / pAp.clamp(min=1e-30), torch.zeros_like(rr))
+        x = x + step.reshape(view) * p
+        r = r - step.reshape(view) * Ap
+        rr_new = dot(r, r)
+        beta = torch.where(active, rr_new / rr.clamp(min=1e-30), torch.zeros_like(rr))
+        p = r + beta.reshape(view) * p
+        rr = torch.where(active, rr_new, rr)
+
+    return x
+
+
+class EmbeddingCache(object):
+    """
+    Stores backbone features of individual images, keyed by the image keys emitted by
+    MetaDataLoader(return_image_keys=True), i.e. (class, image path, transform identity).
+    It is only valid while the backbone does not change and runs deterministically
+    (eval mode, no grad), so the trainers clear it whenever the model is trained.
+    """
+
+    def __init__(self):
+        self._features = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def clear(self):
+        self._features = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self._features)
+
+
+    def lookup(self, compute_features, X, keys):
+        """
+        Returns the features of X, only running compute_features on the images whose key is not cached.
+
+        Parameters:
+          compute_features: a callable mapping a (k, c, h, w) Tensor to a (k, d) Tensor.
+          X:  a (n, c, h, w) Tensor.
+          keys: a list of n hashable keys, one per image of X.
+        Returns: a (n, d) Tensor.
+        """
+
+        assert len(keys) == X.size(0)
+        missing = [i for i, key in enumerate(keys) if key not in self._features]
+        if len(missing) > 0:
+            missing_features = compute_features(X[missing])
+            for i, feature in zip(missing, missing_features):
+                self._features[keys[i]] = feature.detach()
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+
+        return torch.stack([self._features[key] for key in keys], dim=0)
 
 
 def binv(b_mat):
@@ -100,10 +663,9 @@ def logistic_regression_grad_with_respect_to_w(X, y, w):
     C = w.shape[0]
     N = X.shape[0]
 
-    result = np.zeros((C * X.shape[1], 1), dtype=np.float32)
-    I = np.eye(C, dtype=np.float32)
-    for i in range(X.shape[0]):
-        result += np.kron(p[i].reshape(-1, 1) - I[:, y[i]: y[i]+1], X[i].reshape(-1, 1))
+    # sum_i kron(p_i - e_{y_i}, x_i) = vec((P - Y)^T X)
+    p[np.arange(N), y] -= 1
+    result = np.matmul(p.T, X).reshape(-1, 1).astype(np.float32)
     result /= N
     
     return result
@@ -129,16 +691,12 @@ def logistic_regression_hessian_pieces_with_respect_to_w(X, y, w):
     N = X.shape[0]
     d = X.shape[1] - 1
     
-    Xbar = np.zeros(shape=(N * (C+1), C * (d+1)), dtype=np.float32)
-    diag = []
-    
-    for i in range(N):
-        for j in range(C):
-            Xbar[i * C + j, j * (d+1): (j+1) * (d+1)] = X[i]        
-        diag.extend(p[i] / N)
-    for i in range(N):
-        Xbar[N * C + i, :] = np.kron(p[i], X[i])
-        diag.append(-1 / N)
+    # row i * C + j holds X[i] in the j-th block of d+1 columns
+    Xbar_top = np.einsum('jc,ik->ijck', np.eye(C, dtype=np.float32), X).reshape(N * C, C * (d+1))
+    # row N * C + i is kron(p[i], X[i])
+    Xbar_bottom = (p[:, :, None] * X[:, None, :]).reshape(N, C * (d+1))
+    Xbar = np.concatenate([Xbar_top, Xbar_bottom], axis=0).astype(np.float32)
+    diag = list(p.reshape(-1) / N) + [-1 / N] * N
 
     return diag, Xbar
 
@@ -154,7 +712,8 @@ def logistic_regression_hessian_with_respect_to_w(X, y, w):
     return hessian matrix C*(d+1), C*(d+1)
     '''
     diag, Xbar = logistic_regression_hessian_pieces_with_respect_to_w(X, y, w)
-    result = np.matmul(np.matmul(Xbar.T, np.diag(diag)), Xbar)
+    # Xbar.T @ np.diag(diag) @ Xbar without the N(C+1) x N(C+1) diagonal matrix
+    result = np.matmul(Xbar.T, np.asarray(diag, dtype=np.float32)[:, None] * Xbar)
 
     return result
 
@@ -206,10 +765,9 @@ def logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X(X, y, w):
 
     result = np.kron((p - I_C[y]).T, I_dp1)
     
-    for i in range(N):
-        weighted_w = np.matmul(np.diag(p[i]), np.matmul(I_C - p[i], w)) # broadcasting
-        for j in range(C):
-            result[j*(d+1):(j+1)*(d+1), i*(d+1): (i+1)*(d+1)] += np.outer(X[i], weighted_w[j])
+    # block (j, i) += outer(X[i], p[i, j] * (w[j] - p[i] @ w))
+    weighted_w = p[:, :, None] * (w[None, :, :] - np.matmul(p, w)[:, None, :]) # N, C, (d+1)
+    result += np.einsum('ik,ijl->jkil', X, weighted_w).reshape(C * (d+1), N * (d+1))
     result /= N
 
     return result
@@ -238,11 +796,367 @@ def logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X_left_multi
     Xapw = np.matmul(Xap, w) # N, (d+1)
     Xap_row_sum = np.sum(Xap, axis=1, keepdims=False) # shape N
     weighted_w = np.matmul(p, w) # shape N, (d+1)
-    result = weighted_a.reshape(-1)
-
-    for i in range(N):
-        result[i*(d+1): (i+1)*(d+1)] += -a_reshape[y[i]] + Xapw[i] - Xap_row_sum[i] * weighted_w[i]
 
-    result /= N
+    result = weighted_a - a_reshape[y] + Xapw - Xap_row_sum[:, None] * weighted_w
+    result = result.reshape(-1) / N
     return result
 
+
+def batched_logistic_regression_probabilities(X, w):
+    """
+    Softmax probabilities of a batch of linear classifiers.
+
+    Parameters:
+      X:  a (n_batch, N, d+1) Tensor, the last feature is the bias.
+      w:  a (n_batch, C, d+1) Tensor.
+    Returns: a (n_batch, N, C) Tensor.
+    """
+
+    return torch.softmax(torch.bmm(X, w.transpose(1, 2)), dim=2)
+
+
+def batched_logistic_regression_grad_with_respect_to_w(X, y, w):
+    """
+    Batched torch version of logistic_regression_grad_with_respect_to_w,
+    the gradient of the mean cross entropy with respect to w.
+
+    Parameters:
+      X:  a (n_batch, N, d+1) Tensor, the last feature is the bias.
+      y:  a (n_batch, N) Tensor of class indices.
+      w:  a (n_batch, C, d+1) Tensor.
+    Returns: a (n_batch, C*(d+1)) Tensor.
+    """
+
+    N = X.size(1)
+    p = batched_logistic_regression_probabilities(X, w)
+    residual = p - F.one_hot(y, num_classes=w.size(1)).to(p.dtype)
+    return torch.bmm(residual.transpose(1, 2), X).reshape(X.size(0), -1) / N
+
+
+def batched_logistic_regression_hessian_pieces_with_respect_to_w(X, y, w):
+    """
+    Batched torch version of logistic_regression_hessian_pieces_with_respect_to_w.
+
+    Parameters:
+      X:  a (n_batch, N, d+1) Tensor, the last feature is the bias.
+      y:  a (n_batch, N) Tensor of class indices.
+      w:  a (n_batch, C, d+1) Tensor.
+    Returns: diag, a (n_batch, N(C+1)) Tensor, and Xbar, a (n_batch, N(C+1), C(d+1)) Tensor
+    with hessian = Xbar^T @ diag(diag) @ Xbar.
+    """
+
+    n_batch, N, d_plus_1 = X.size()
+    C = w.size(1)
+    p = batched_logistic_regression_probabilities(X, w)
+    eye = torch.eye(C, dtype=X.dtype, device=X.device)
+    Xbar_top = torch.einsum('jc,bik->bijck', eye, X).reshape(n_batch, N * C, C * d_plus_1)
+    Xbar_bottom = (p.unsqueeze(3) * X.unsqueeze(2)).reshape(n_batch, N, C * d_plus_1)
+    Xbar = torch.cat([Xbar_top, Xbar_bottom], dim=1)
+    diag = torch.cat([p.reshape(n_batch, N * C), p.new_full((n_batch, N), -1.)], dim=1) / N
+    return diag, Xbar
+
+
+def batched_logistic_regression_hessian_with_respect_to_w(X, y, w):
+    """
+    Batched torch version of logistic_regression_hessian_with_respect_to_w:
+    1/N sum_i kron(diag(p_i) - p_i p_i^T, x_i x_i^T), computed as the block diagonal
+    X^T diag(p_j) X / N minus A^T A / N with A_i = kron(p_i, x_i).
+
+    Parameters:
+      X:  a (n_batch, N, d+1) Tensor, the last feature is the bias.
+      y:  a (n_batch, N) Tensor of class indices.
+      w:  a (n_batch, C, d+1) Tensor.
+    Returns: a (n_batch, C(d+1), C(d+1)) Tensor.
+    """
+
+    n_batch, N, d_plus_1 = X.size()
+    C = w.size(1)
+    p = batched_logistic_regression_probabilities(X, w)
+    # (n_batch, C, d+1, d+1) diagonal blocks
+    blocks = torch.einsum('bij,bik,bil->bjkl', p, X, X)
+    hessian = torch.zeros(n_batch, C, d_plus_1, C, d_plus_1, dtype=X.dtype, device=X.device)
+    hessian[:, torch.arange(C), :, torch.arange(C), :] = blocks.transpose(0, 1)
+    A = (p.unsqueeze(3) * X.unsqueeze(2)).reshape(n_batch, N, C * d_plus_1)
+    hessian = hessian.reshape(n_batch, C * d_plus_1, C * d_plus_1) - torch.bmm(A.transpose(1, 2), A)
+    return hessian / N
+
+
+def batched_logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X(X, y, w):
+    """
+    Batched torch version of logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X.
+    The result has C(d+1) x N(d+1) entries per task, prefer the _left_multiply version when only
+    its product with a vector is needed.
+
+    Parameters:
+      X:  a (n_batch, N, d+1) Tensor, the last feature is the bias.
+      y:  a (n_batch, N) Tensor of class indices.
+      w:  a (n_batch, C, d+1) Tensor.
+    Returns: a (n_batch, C(d+1), N(d+1)) Tensor.
+    """
+
+    n_batch, N, d_plus_1 = X.size()
+    C = w.size(1)
+    p = batched_logistic_regression_probabilities(X, w)
+    residual = p - F.one_hot(y, num_classes=C).to(p.dtype)
+    eye = torch.eye(d_plus_1, dtype=X.dtype, device=X.device)
+    # (n_batch, N, C, d+1): p[i, j] * (w[j] - p[i] @ w)
+    weighted_w = p.unsqueeze(3) * (w.unsqueeze(1) - torch.bmm(p, w).unsqueeze(2))
+    result = torch.einsum('bij,kl->bjkil', residual, eye) + torch.einsum('bik,bijl->bjkil', X, weighted_w)
+    return result.reshape(n_batch, C * d_plus_1, N * d_plus_1) / N
+
+
+def batched_logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X_left_multiply(X, y, w, a):
+    """
+    Batched torch version of logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X_left_multiply.
+
+    Parameters:
+      X:  a (n_batch, N, d+1) Tensor, the last feature is the bias.
+      y:  a (n_batch, N) Tensor of class indices.
+      w:  a (n_batch, C, d+1) Tensor.
+      a:  a (n_batch, C(d+1)) Tensor.
+    Returns: a^T @ mixed partial matrix, a (n_batch, N(d+1)) Tensor.
+    """
+
+    n_batch, N, d_plus_1 = X.size()
+    C = w.size(1)
+    p = batched_logistic_regression_probabilities(X, w)
+    a = a.reshape(n_batch, C, d_plus_1)
+    Xap = torch.bmm(X, a.transpose(1, 2)) * p # n_batch, N, C
+    result = torch.bmm(p, a) - torch.gather(a, 1, y.unsqueeze(2).expand(-1, -1, d_plus_1)) \
+        + torch.bmm(Xap, w) - Xap.sum(dim=2, keepdim=True) * torch.bmm(p, w)
+    return result.reshape(n_batch, N * d_plus_1) / N
+
+
+def batched_logistic_regression_objective(X, y, w, lambda_reg):
+    """
+    Mean cross entropy of a batch of linear classifiers plus lambda_reg / 2 ||w||^2, and its gradient.
+
+    Parameters:
+      X:  a (n_batch, N, d+1) Tensor, the last feature is the bias.
+      y:  a (n_batch, N) Tensor of class indices.
+      w:  a (n_batch, C, d+1) Tensor.
+    Returns: a (n_batch,) Tensor of objective values and a (n_batch, C, d+1) Tensor of gradients.
+    """
+
+    logits = torch.bmm(X, w.transpose(1, 2))
+    loss = -torch.gather(torch.log_softmax(logits, dim=2), 2, y.unsqueeze(2)).squeeze(2).mean(dim=1)
+    value = loss + 0.5 * lambda_reg * w.pow(2).sum(dim=(1, 2))
+    grad = batched_logistic_regression_grad_with_respect_to_w(X, y, w).reshape(w.shape) + lambda_reg * w
+    return value, grad
+
+
+def batched_logistic_regression_hessian_solve(X, y, w, v, lambda_reg):
+    """
+    Solves (H + lambda_reg I) u = v with H the hessian of the mean cross entropy at w
+    (batched_logistic_regression_hessian_with_respect_to_w), never forming the C(d+1) x C(d+1) matrix:
+    with H = Xbar^T D Xbar (batched_logistic_regression_hessian_pieces_with_respect_to_w), the Woodbury identity gives
+    u = (v - Xbar^T D (lambda_reg I + Xbar Xbar^T D)^{-1} Xbar v) / lambda_reg, an N(C+1) x N(C+1) solve.
+    Xbar is not formed either: Xbar Xbar^T and the products with Xbar only involve X X^T, X and p.
+
+    Parameters:
+      X:  a (n_batch, N, d+1) Tensor, the last feature is the bias.
+      y:  a (n_batch, N) Tensor of class indices.
+      w:  a (n_batch, C, d+1) Tensor.
+      v:  a (n_batch, C, d+1) Tensor.
+    Returns: a (n_batch, C, d+1) Tensor.
+    """
+
+    n_batch, N, _ = X.size()
+    C = w.size(1)
+    p = batched_logistic_regression_probabilities(X, w)
+    kernel_matrix = torch.bmm(X, X.transpose(1, 2))
+    eye_C = torch.eye(C, dtype=X.dtype, device=X.device)
+    # Xbar Xbar^T, the rows of Xbar being x_i kron e_j (i, j) then p_i kron x_i (i)
+    top_top = torch.einsum('bik,jl->bijkl', kernel_matrix, eye_C).reshape(n_batch, N * C, N * C)
+    top_bottom = (kernel_matrix.unsqueeze(2) * p.transpose(1, 2).unsqueeze(1)).reshape(n_batch, N * C, N)
+    bottom_bottom = kernel_matrix * torch.bmm(p, p.transpose(1, 2))
+    gram = torch.cat([torch.cat([top_top, top_bottom], dim=2),
+                      torch.cat([top_bottom.transpose(1, 2), bottom_bottom], dim=2)], dim=1)
+    diag = torch.cat([p.reshape(n_batch, N * C), p.new_full((n_batch, N), -1.)], dim=1) / N
+
+    def Xbar_matmul(v):
+        Xv = torch.bmm(X, v.transpose(1, 2)) # N, C
+        return torch.cat([Xv.reshape(n_batch, N * C), (p * Xv).sum(dim=2)], dim=1)
+
+    def Xbar_transpose_matmul(z):
+        z_top, z_bottom = z[:, :N * C].reshape(n_batch, N, C), z[:, N * C:]
+        return torch.bmm((z_top + z_bottom.unsqueeze(2) * p).transpose(1, 2), X)
+
+    inner = lambda_reg * torch.eye(N * (C + 1), dtype=X.dtype, device=X.device) + gram * diag.unsqueeze(1)
+    z = torch.linalg.solve(inner, Xbar_matmul(v).unsqueeze(2)).squeeze(2)
+    return (v - Xbar_transpose_matmul(diag * z)) / lambda_reg
+
+
+class LogisticRegressionHessianOperator(object):
+    """
+    Matrix-free second derivatives of batched_logistic_regression_objective(X, y, w, lambda_reg) at w,
+    in O(n_batch N C d) each, without forming the C(d+1) x C(d+1) hessian nor the C(d+1) x N(d+1) mixed derivative:
+    hvp(v):       (H + lambda_reg I) v, H = 1/N sum_i kron(diag(p_i) - p_i p_i^T, x_i x_i^T)
+    mixed_vjp(a): a^T M, M the derivative of the mean cross entropy gradient with respect to X
+                  (batched_logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X)
+    solve(v):     (H + lambda_reg I)^{-1} v, with batched_conjugate_gradient on hvp (cg)
+                  or with batched_logistic_regression_hessian_solve (woodbury, an N(C+1) x N(C+1) direct solve)
+
+    Parameters:
+      X:  a (n_batch, N, d+1) Tensor, the last feature is the bias.
+      y:  a (n_batch, N) Tensor of class indices.
+      w:  a (n_batch, C, d+1) Tensor.
+    v and a are (n_batch, C, d+1) Tensors, mixed_vjp returns a (n_batch, N, d+1) Tensor.
+    """
+
+    def __init__(self, X, y, w, lambda_reg, solver='cg', cg_tol=1e-6, cg_max_iter=100):
+        self.X = X
+        self.y = y
+        self.w = w
+        self.lambda_reg = lambda_reg
+        self.solver = solver
+        self.cg_tol = cg_tol
+        self.cg_max_iter = cg_max_iter
+        assert self.solver in ['cg', 'woodbury'], "hessian solver not implemented"
+        self.p = batched_logistic_regression_probabilities(X, w)
+
+
+    def hvp(self, v):
+        Xv = torch.bmm(self.X, v.transpose(1, 2)) # n_batch, N, C
+        r = self.p * (Xv - (self.p * Xv).sum(dim=2, keepdim=True))
+        return torch.bmm(r.transpose(1, 2), self.X) / self.X.size(1) + self.lambda_reg * v
+
+
+    def mixed_vjp(self, a):
+        n_batch, N, d_plus_1 = self.X.size()
+        return batched_logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X_left_multiply(
+            self.X, self.y, self.w, a.reshape(n_batch, -1)).reshape(n_batch, N, d_plus_1)
+
+
+    def solve(self, v):
+        if self.solver == 'woodbury':
+            return batched_logistic_regression_hessian_solve(self.X, self.y, self.w, v, self.lambda_reg)
+        return batched_conjugate_gradient(self.hvp, v, tol=self.cg_tol, max_iter=self.cg_max_iter)
+
+
+def batched_backtracking_line_search(objective, x, direction, value, grad, c=1e-4, max_halvings=20):
+    """
+    Armijo backtracking from step 1 along direction, halving the step independently for every task.
+
+    Parameters:
+      objective: a callable mapping a (n_batch, ...) Tensor x to (values (n_batch,), grads shaped like x).
+      x, direction, grad:  (n_batch, ...) Tensors, value a (n_batch,) Tensor (objective at x).
+    Returns: the new x, its values and its grads.
+    """
+
+    n_batch = x.size(0)
+    view = (n_batch,) + (1,) * (x.dim() - 1)
+    slope = (grad * direction).reshape(n_batch, -1).sum(dim=1)
+    step = torch.ones_like(value)
+    new_x, new_value, new_grad = x, value, grad
+    accepted = torch.zeros_like(value, dtype=torch.bool)
+    for _ in range(max_halvings):
+        trial_x = x + step.reshape(view) * direction
+        trial_value, trial_grad = objective(trial_x)
+        ok = ~accepted & (trial_value <= value + c * step * slope)
+        new_x = torch.where(ok.reshape(view), trial_x, new_x)
+        new_value = torch.where(ok, trial_value, new_value)
+        new_grad = torch.where(ok.reshape(view), trial_grad, new_grad)
+        accepted = accepted | ok
+        if bool(accepted.all()):
+            break
+        step = torch.where(accepted, step, step / 2)
+    return new_x, new_value, new_grad
+
+
+def batched_logistic_regression_fit(X, y, n_classes, lambda_reg, solver='newton', max_iter=20,
+        tol=1e-5, history_size=10, hessian_solver='cg'):
+    """
+    Minimizes batched_logistic_regression_objective for every task of the batch at once,
+    starting from w = 0, with damped Newton steps (solved by LogisticRegressionHessianOperator
+    with hessian_solver) or L-BFGS, both with batched_backtracking_line_search.
+    A task stops updating once its gradient norm is below tol or its objective stops decreasing.
+
+    Parameters:
+      X:  a (n_batch, N, d+1) Tensor, the last feature is the bias.
+      y:  a (n_batch, N) Tensor of class indices.
+    Returns: w, a (n_batch, n_classes, d+1) Tensor, and the number of iterations run.
+    """
+
+    n_batch = X.size(0)
+    objective = lambda w: batched_logistic_regression_objective(X, y, w, lambda_reg)
+    w = X.new_zeros(n_batch, n_classes, X.size(2))
+    value, grad = objective(w)
+    s_history, y_history = [], []
+
+    def dot(a, b):
+        return (a * b).reshape(n_batch, -1).sum(dim=1)
+
+    def view(a):
+        return a.reshape(n_batch, 1, 1)
+
+    n_iter = 0
+    # tasks whose line search made no progress (converged up to the precision of X) stop as well
+    stalled = torch.zeros_like(value, dtype=torch.bool)
+    for n_iter in range(1, max_iter + 1):
+        active = (grad.reshape(n_batch, -1).norm(dim=1) > tol) & ~stalled
+        if not bool(active.any()):
+            break
+        if solver == 'newton':
+            direction = -LogisticRegressionHessianOperator(X, y, w, lambda_reg, solver=hessian_solver).solve(grad)
+        elif solver == 'lbfgs':
+            # two-loop recursion
+            q = grad
+            alphas = []
+            for s_k, y_k in reversed(list(zip(s_history, y_history))):
+                rho = 1. / dot(y_k, s_k).clamp(min=1e-30)
+                alpha = rho * dot(s_k, q)
+                q = q - view(alpha) * y_k
+                alphas.append((rho, alpha))
+            if len(s_history) > 0:
+                gamma = dot(s_history[-1], y_history[-1]) / dot(y_history[-1], y_history[-1]).clamp(min=1e-30)
+                q = view(gamma) * q
+            else:
+                q = q / (1. + lambda_reg)
+            for (s_k, y_k), (rho, alpha) in zip(zip(s_history, y_history), reversed(alphas)):
+                beta = rho * dot(y_k, q)
+                q = q + view(alpha - beta) * s_k
+            direction = -q
+        else:
+            raise ValueError("logistic regression solver not implemented.")
+        direction = direction * view(active.to(direction.dtype))
+        new_w, new_value, new_grad = batched_backtracking_line_search(objective, w, direction, value, grad)
+        if solver == 'lbfgs':
+            s_history.append(new_w - w)
+            y_history.append(new_grad - grad)
+            if len(s_history) > history_size:
+                s_history.pop(0)
+                y_history.pop(0)
+        stalled = stalled | (active & (new_value >= value))
+        w, value, grad = new_w, new_value, new_grad
+
+    return w, n_iter
+
+
+class LogisticRegressionImplicitFunction(torch.autograd.Function):
+    """
+    Differentiates the minimizer w of batched_logistic_regression_objective(X, y, w, lambda_reg)
+    with respect to X through the implicit function theorem, whatever solver produced w:
+    dL/dX = -M^T (H + lambda_reg I)^{-1} dL/dw, with H the hessian and M the mixed derivative of
+    the mean cross entropy gradient, both applied matrix-free by LogisticRegressionHessianOperator
+    (the solve with hessian_solver, cg or woodbury).
+
+    Usage: w = LogisticRegressionImplicitFunction.apply(X, y, w_solution, lambda_reg, hessian_solver)
+    Gradients are returned for X only.
+    """
+
+    @staticmethod
+    def forward(ctx, X, y, w, lambda_reg, hessian_solver='cg'):
+        w = w.detach().to(X.dtype)
+        ctx.save_for_backward(X, y, w)
+        ctx.lambda_reg = lambda_reg
+        ctx.hessian_solver = hessian_solver
+        return w.clone()
+
+
+    @staticmethod
+    def backward(ctx, grad_w):
+        X, y, w = ctx.saved_tensors
+        operator = LogisticRegressionHessianOperator(X, y, w, ctx.lambda_reg, solver=ctx.hessian_solver)
+        grad_X = -operator.mixed_vjp(operator.solve(grad_w.to(X.dtype)))
+        return grad_X, None, None, None, None
@@ -6,6 +6,7 @@ from abc import abstractmethod
 import torch
 from PIL import ImageEnhance
 
+import functools
 from collections import defaultdict
 
 
@@ -23,7 +24,9 @@ class MetaDataLoader:
                 n_shot,
                 n_query,
                 randomize_query,
-                p_dict=None):        
+                p_dict=None,
+                return_image_keys=False,
+                dedup_images=False):        
         """object to create the dataloader
 
         Args:
@@ -35,6 +38,11 @@ class MetaDataLoader:
             n_query (int): average number of query examples per class
             randomize_query (bool): whether to use exactly the same number of examples per class.
             p_dict (dict): maps a class to its probability of being selected, defaults to None (uniform prob.)
+            return_image_keys (bool): also return, for each task, the list of keys identifying
+                                      its support and query images (used for embedding caching)
+            dedup_images (bool): return every distinct image of the task batch only once,
+                                 with support and query given as indices into the unique images
+                                 (implies return_image_keys, see collate_fn)
         """        
         # super(MetaDataLoader, self).__init__()
         self.dataset = dataset
@@ -44,6 +52,8 @@ class MetaDataLoader:
         self.n_shot = n_shot
         self.n_query = n_query
         self.randomize_query = randomize_query
+        self.return_image_keys = return_image_keys
+        self.dedup_images = dedup_images
 
         print("Size of Support:", self.n_shot)
         print("Size of Query:", self.n_query, "randomize query", self.randomize_query)
@@ -64,10 +74,15 @@ class MetaDataLoader:
             batch_sampler=self.sampler,
             num_workers=12,
             pin_memory=True,
-            collate_fn=lambda ls: collate_fn(
-                                    ls=ls,
+            # a per-worker decoded image cache lives as long as its worker
+            persistent_workers=(dataset.support_class_images_set.has_per_worker_image_cache()
+                                or dataset.query_class_images_set.has_per_worker_image_cache()),
+            # a partial (unlike a lambda) can be pickled, e.g. to send the loader to another process
+            collate_fn=functools.partial(collate_fn,
                                     has_support=(self.n_shot != 0),
-                                    has_query=(self.n_query != 0))
+                                    has_query=(self.n_query != 0),
+                                    return_image_keys=self.return_image_keys,
+                                    dedup_images=self.dedup_images)
         )
 
     def __iter__(self):
@@ -148,7 +163,7 @@ class EpisodicBatchSampler(torch.utils.data.Sampler):
             yield yield_result
 
 
-def collate_fn(ls, has_support, has_query):
+def collate_fn(ls, has_support, has_query, return_image_keys=False, dedup_images=False):
     result = defaultdict(lambda: defaultdict(list))
 
     for task_cl_dict in ls:
@@ -156,9 +171,11 @@ def collate_fn(ls, has_support, has_query):
         if has_support:
             result[task_idx]['support_x'].append(task_cl_dict['support_x_cl'])
             result[task_idx]['support_y'].append(task_cl_dict['support_y_cl'])
+            result[task_idx]['support_keys'].extend(task_cl_dict['support_keys_cl'])
         if has_query:
             result[task_idx]['query_x'].append(task_cl_dict['query_x_cl'])
             result[task_idx]['query_y'].append(task_cl_dict['query_y_cl'])
+            result[task_idx]['query_keys'].extend(task_cl_dict['query_keys_cl'])
 
     task_indices = sorted(result.keys())
 
@@ -182,6 +199,24 @@ def collate_fn(ls, has_support, has_query):
                 for task_idx in task_indices],
             dim=0)
 
+    if dedup_images:
+        # (support_index_tb, support_y_tb, query_index_tb, query_y_tb,
+        #  support_keys_tb, query_keys_tb, unique_x, unique_keys)
+        assert has_support and has_query, 'deduplication needs both support and query'
+        support_keys_tb = [result[task_idx]['support_keys'] for task_idx in task_indices]
+        query_keys_tb = [result[task_idx]['query_keys'] for task_idx in task_indices]
+        unique_x, unique_keys, (support_index_tb, query_index_tb) = dedup_task_images(
+            x_tbs=[support_x_tb, query_x_tb], keys_tbs=[support_keys_tb, query_keys_tb])
+        return (support_index_tb, support_y_tb, query_index_tb, query_y_tb,
+                support_keys_tb, query_keys_tb, unique_x, unique_keys)
+
+    if return_image_keys:
+        # lists of length batch_size, each a list of per-image keys in the same order as x
+        assert has_support and has_query, 'image keys need both support and query'
+        support_keys_tb = [result[task_idx]['support_keys'] for task_idx in task_indices]
+        query_keys_tb = [result[task_idx]['query_keys'] for task_idx in task_indices]
+        return (support_x_tb, support_y_tb, query_x_tb, query_y_tb, support_keys_tb, query_keys_tb)
+
     if has_support and has_query:
         return (support_x_tb, support_y_tb, query_x_tb, query_y_tb)
     elif has_support and (not has_query):
@@ -190,4 +225,41 @@ def collate_fn(ls, has_support, has_query):
         return query_x_tb, query_y_tb
     else:
         assert False, 'no support and no query'
-        
\ No newline at end of file
+        
+
+def dedup_task_images(x_tbs, keys_tbs):
+    """keep a single copy of the images that appear several times in a task batch
+
+    Images are identified by their keys (see MetaDataset.get_image_keys); images with
+    a None key (randomly transformed) are never merged with any other image.
+
+    Args:
+        x_tbs (list of tensors): each of shape (batch_size, n, c, h, w)
+        keys_tbs (list of list of lists): the image keys of x_tbs, keys_tbs[j][t][i] for x_tbs[j][t, i]
+
+    Returns:
+        3-element tuple: unique_x, unique_keys, index_tbs
+                         unique_x of shape (n_unique, c, h, w)
+                         unique_keys the list of n_unique keys of unique_x
+                         index_tbs list of tensors of shape (batch_size, n) such that
+                                   unique_x[index_tbs[j]] == x_tbs[j]
+    """
+    key_to_index = {}
+    unique_x = []
+    unique_keys = []
+    index_tbs = []
+    for x_tb, keys_tb in zip(x_tbs, keys_tbs):
+        index_tb = torch.empty(x_tb.shape[:2], dtype=torch.long)
+        for task_idx, task_keys in enumerate(keys_tb):
+            for i, key in enumerate(task_keys):
+                if key is None or key not in key_to_index:
+                    if key is not None:
+                        key_to_index[key] = len(unique_x)
+                    index_tb[task_idx, i] = len(unique_x)
+                    unique_x.append(x_tb[task_idx, i])
+                    unique_keys.append(key)
+                else:
+                    index_tb[task_idx, i] = key_to_index[key]
+        index_tbs.append(index_tb)
+
+    return torch.stack(unique_x, dim=0), unique_keys, index_tbs
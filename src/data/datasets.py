@@ -1,25 +1,359 @@
 import torch
+import torch.multiprocessing as mp
 from PIL import Image
 import json
+import hashlib
+import io
 import numpy as np
 import torchvision.transforms as transforms
 import concurrent.futures
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import tqdm
 import os
+import time
 from copy import deepcopy
 
 from src.data.transforms import TransformLoader
+from src.data.image_store import PackedImageStore
 
 
 # for transform
-identity = lambda x:x
+def identity(x):
+    return x
 
 def load_image(image_path):
     img = Image.open(image_path).convert('RGB')
     return img
 
 
+def load_image_array(image_path):
+    # decoded uint8 (h, w, 3) pixels, much cheaper to send between processes than a PIL image
+    return np.asarray(load_image(image_path), dtype=np.uint8)
+
+
+class PreloadedImages:
+
+    def __init__(self, image_paths=None, memory_budget=0, max_workers=8, block_bytes=256 * 2 ** 20,
+                 images=None):
+        """decodes images with one bounded process pool and keeps their uint8 pixels
+        packed back to back in large contiguous blocks of shared memory
+
+        The blocks are shared memory tensors, so every DataLoader worker (forked or spawned) and every
+        loader over the same ClassImagesSet reads one physical copy. Besides the blocks, the images are
+        described only by integer arrays (block, offset, shape), so there are no per-image Python objects
+        whose reference counts would make forked workers copy the pages they live in.
+        The i-th image is the i-th of image_paths (or images); only the first len(self) are preloaded.
+
+        Args:
+            image_paths (list of str, optional): paths of the images to decode, in loading order
+            memory_budget (int, optional): maximum number of bytes of pixels to keep in memory, the images
+                                           that do not fit are not preloaded (0 for no limit). Defaults to 0.
+            max_workers (int, optional): number of decoding processes. Defaults to 8.
+            block_bytes (int, optional): size of each block of pixels. Defaults to 256MB.
+            images (iterable of np.array, optional): already decoded uint8 images to copy instead of image_paths.
+        """
+        self.memory_budget = memory_budget
+        self.block_bytes = block_bytes
+        self.blocks = []
+        self.block_used = 0
+        self.nbytes = 0
+        n_images = len(image_paths) if images is None else len(images)
+        self.block_ids = np.zeros(n_images, dtype=np.int64)
+        self.offsets = np.zeros(n_images, dtype=np.int64)
+        self.shapes = np.zeros((n_images, 3), dtype=np.int64)
+        self.n_loaded = 0
+
+        start_time = time.time()
+        if images is not None:
+            for image in images:
+                if not self.add(image):
+                    break
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+            try:
+                with tqdm.tqdm(total=n_images, unit='img', desc='preloading') as pbar:
+                    for image in executor.map(load_image_array, image_paths, chunksize=32):
+                        if not self.add(image):
+                            break
+                        pbar.update(1)
+            finally:
+                # drops the images that were not decoded yet once the budget is exhausted
+                executor.shutdown(wait=True, cancel_futures=True)
+        elapsed = time.time() - start_time
+
+        print(f"Preloaded {self.n_loaded}/{n_images} images ({self.nbytes / 2 ** 20:.1f}MB) "
+              f"in {elapsed:.1f}s ({self.n_loaded / max(elapsed, 1e-6):.1f} img/s)")
+        if self.n_loaded < n_images:
+            print(f"Memory budget of {memory_budget / 2 ** 20:.1f}MB reached, "
+                  f"the other {n_images - self.n_loaded} images are loaded lazily")
+
+
+    def add(self, image):
+        """copy the pixels of the next image into the blocks
+
+        Returns:
+            bool: False if the image does not fit in the memory budget
+        """
+        if self.memory_budget > 0 and self.nbytes + image.nbytes > self.memory_budget:
+            return False
+        if not self.blocks or self.block_used + image.nbytes > self.blocks[-1].numel():
+            # images larger than a block get a block of their own
+            self.blocks.append(torch.empty(max(self.block_bytes, image.nbytes), dtype=torch.uint8).share_memory_())
+            self.block_used = 0
+        self.blocks[-1][self.block_used:self.block_used + image.nbytes] = torch.from_numpy(image.reshape(-1))
+        self.block_ids[self.n_loaded] = len(self.blocks) - 1
+        self.offsets[self.n_loaded] = self.block_used
+        self.shapes[self.n_loaded] = image.shape
+        self.n_loaded += 1
+        self.block_used += image.nbytes
+        self.nbytes += image.nbytes
+        return True
+
+
+    def __contains__(self, i):
+        return 0 <= i < self.n_loaded
+
+
+    def __getitem__(self, i):
+        # the i-th preloaded image as a PIL image
+        return Image.fromarray(self.get_array(i))
+
+
+    def get_array(self, i):
+        # the i-th preloaded image as a uint8 (h, w, 3) array (a view of the shared block)
+        shape = self.shapes[i]
+        offset = self.offsets[i]
+        pixels = self.blocks[self.block_ids[i]][offset:offset + shape.prod()]
+        return pixels.numpy().reshape(shape)
+
+
+    def __len__(self):
+        return self.n_loaded
+
+
+class EncodedImages:
+
+    def __init__(self, image_paths, max_workers=16):
+        """reads the encoded bytes (e.g. jpeg) of image files back to back into one buffer of shared memory,
+        so that the images are decoded from memory instead of read from disk on every access
+
+        Encoded images are several times smaller than their decoded pixels (see PreloadedImages).
+        As in PreloadedImages, the buffer is a shared memory tensor and the images are described only by
+        an array of offsets, so all the DataLoader workers read one physical copy.
+
+        Args:
+            image_paths (list of str): paths of the image files, the i-th image is the i-th path
+            max_workers (int, optional): number of reading threads (reading is I/O bound). Defaults to 16.
+        """
+        start_time = time.time()
+        sizes = np.array([os.path.getsize(path) for path in image_paths], dtype=np.int64)
+        # the bytes of the i-th image are buffer[offsets[i]:offsets[i + 1]]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self.buffer = torch.empty(int(self.offsets[-1]), dtype=torch.uint8).share_memory_()
+        buffer = self.buffer.numpy()
+
+        def read(i):
+            with open(image_paths[i], 'rb') as f:
+                n_read = f.readinto(memoryview(buffer[self.offsets[i]:self.offsets[i + 1]]))
+            assert n_read == sizes[i], f"{image_paths[i]} changed size while being read"
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            with tqdm.tqdm(total=len(image_paths), unit='img', desc='reading encoded images') as pbar:
+                for _ in executor.map(read, range(len(image_paths))):
+                    pbar.update(1)
+        elapsed = time.time() - start_time
+
+        print(f"Read {len(self)} encoded images ({self.nbytes / 2 ** 20:.1f}MB) "
+              f"in {elapsed:.1f}s ({len(self) / max(elapsed, 1e-6):.1f} img/s)")
+
+
+    @property
+    def nbytes(self):
+        return self.buffer.numel()
+
+
+    def get_bytes(self, i):
+        # the encoded bytes of the i-th image (a view of the shared buffer)
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].numpy()
+
+
+    def __getitem__(self, i):
+        # the i-th image decoded from memory as a PIL image
+        return Image.open(io.BytesIO(self.get_bytes(i))).convert('RGB')
+
+
+    def get_array(self, i):
+        # the i-th image decoded from memory as a uint8 (h, w, 3) array
+        return np.asarray(self[i], dtype=np.uint8)
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def max_image_nbytes(image_paths, n_samples=256, seed=0):
+    # the largest decoded uint8 size of a random sample of the images, read from the file headers only
+    sample = np.random.RandomState(seed).choice(len(image_paths), min(n_samples, len(image_paths)), replace=False)
+    max_nbytes = 0
+    for i in sample:
+        with Image.open(image_paths[i]) as img:
+            max_nbytes = max(max_nbytes, img.size[0] * img.size[1] * 3)
+    return max_nbytes
+
+
+class DecodedImageCache:
+
+    def __init__(self, budget_bytes, shared=False, slot_bytes=None, ways=8, max_processes=256):
+        """LRU cache of decoded uint8 images for lazily loaded images, keyed by image path
+
+        Per-worker (shared=False): every DataLoader worker keeps its own ordered dict of up to
+        budget_bytes of images and evicts the least recently used ones.
+        Shared (shared=True): one cache of budget_bytes in shared memory for all the workers and loaders,
+        made of slots of slot_bytes organized in sets of `ways` slots, with LRU eviction within each set.
+        Images larger than slot_bytes are not cached.
+
+        The hit, miss and eviction counters are in shared memory, so the main process sees the totals
+        of all the workers (see stats). In per-worker mode every process claims its own row of counters
+        once and updates it without locking.
+
+        Args:
+            budget_bytes (int): maximum number of bytes of cached pixels (per worker if not shared)
+            shared (bool, optional): one cache shared by all processes. Defaults to False.
+            slot_bytes (int, optional): size of each slot of the shared cache. Required if shared.
+            ways (int, optional): number of slots in each set of the shared cache. Defaults to 8.
+            max_processes (int, optional): number of per-process rows of counters, the processes beyond
+                                           share the last row under the lock. Defaults to 256.
+        """
+        self.budget_bytes = budget_bytes
+        self.shared = shared
+        self.lock = mp.Lock()
+        # hits, misses, evictions and uncached (misses too large to cache) of each process,
+        # the last row is updated under the lock
+        self.counters = torch.zeros(max_processes + 1, 4, dtype=torch.int64).share_memory_()
+        self.next_row = torch.zeros(1, dtype=torch.int64).share_memory_()
+        # (pid, numpy view of its counters row, whether the row is shared) of the process, set by its first count
+        self._row = None
+
+        if shared:
+            assert slot_bytes is not None and slot_bytes > 0, "the shared cache needs a slot size"
+            self.slot_bytes = slot_bytes
+            self.ways = ways
+            self.n_sets = max(budget_bytes // (slot_bytes * ways), 1)
+            n_slots = self.n_sets * ways
+            self.slots = torch.empty(n_slots * slot_bytes, dtype=torch.uint8).share_memory_()
+            # 0 marks an empty slot
+            self.slot_keys = torch.zeros(n_slots, dtype=torch.int64).share_memory_()
+            self.slot_shapes = torch.zeros(n_slots, 3, dtype=torch.int64).share_memory_()
+            self.slot_last_used = torch.zeros(n_slots, dtype=torch.int64).share_memory_()
+            self.clock = torch.zeros(1, dtype=torch.int64).share_memory_()
+            print(f"Shared decoded image cache of {n_slots} slots of {slot_bytes / 2 ** 10:.1f}KB")
+        else:
+            self.images = OrderedDict()
+            self.nbytes = 0
+
+
+    def __getstate__(self):
+        # the counters row is claimed again in the receiving process
+        state = self.__dict__.copy()
+        state['_row'] = None
+        return state
+
+
+    def get(self, path, load=load_image_array):
+        """the decoded uint8 (h, w, 3) image at path, from the cache or decoded by load(path) (and cached)"""
+        if self.shared:
+            return self.get_shared(path, load)
+
+        image = self.images.get(path)
+        if image is not None:
+            self.images.move_to_end(path)
+            self.count(hits=1)
+            return image
+
+        image = load(path)
+        evictions = 0
+        uncached = 1
+        if image.nbytes <= self.budget_bytes:
+            while self.nbytes + image.nbytes > self.budget_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                evictions += 1
+            self.images[path] = image
+            self.nbytes += image.nbytes
+            uncached = 0
+        self.count(misses=1, evictions=evictions, uncached=uncached)
+        return image
+
+
+    def get_shared(self, path, load=load_image_array):
+        key = self.key(path)
+        first = (key % self.n_sets) * self.ways
+        ways = slice(first, first + self.ways)
+        with self.lock:
+            self.clock += 1
+            found = torch.nonzero(self.slot_keys[ways] == key)
+            if len(found) > 0:
+                slot = first + found[0, 0].item()
+                self.slot_last_used[slot] = self.clock[0]
+                self.counters[-1, 0] += 1
+                # copied while holding the lock, the slot could be overwritten afterwards
+                return self.read_slot(slot).copy()
+
+        image = load(path)
+        with self.lock:
+            self.counters[-1, 1] += 1
+            if image.nbytes > self.slot_bytes:
+                self.counters[-1, 3] += 1
+            elif not (self.slot_keys[ways] == key).any():
+                # the least recently used (or an empty) slot of the set
+                slot = first + torch.argmin(self.slot_last_used[ways]).item()
+                if self.slot_keys[slot] != 0:
+                    self.counters[-1, 2] += 1
+                offset = slot * self.slot_bytes
+                self.slots[offset:offset + image.nbytes].numpy()[:] = image.reshape(-1)
+                self.slot_keys[slot] = key
+                self.slot_shapes[slot] = torch.tensor(image.shape)
+                self.slot_last_used[slot] = self.clock[0]
+        return image
+
+
+    def read_slot(self, slot):
+        shape = self.slot_shapes[slot].tolist()
+        offset = slot * self.slot_bytes
+        return self.slots[offset:offset + shape[0] * shape[1] * shape[2]].numpy().reshape(shape)
+
+
+    @staticmethod
+    def key(path):
+        # stable across processes (unlike hash), never 0
+        key = int.from_bytes(hashlib.blake2b(path.encode(), digest_size=8).digest(), 'little', signed=True)
+        return key if key != 0 else 1
+
+
+    def count(self, hits=0, misses=0, evictions=0, uncached=0):
+        pid = os.getpid()
+        if self._row is None or self._row[0] != pid:
+            # first count of this process (a worker inherits the _row of its parent)
+            with self.lock:
+                row = min(self.next_row.item(), len(self.counters) - 1)
+                self.next_row += 1
+            self._row = (pid, self.counters[row].numpy(), row == len(self.counters) - 1)
+        _, counters, locked = self._row
+        if locked:
+            with self.lock:
+                counters += (hits, misses, evictions, uncached)
+        else:
+            counters += (hits, misses, evictions, uncached)
+
+
+    def stats(self):
+        """hits, misses, evictions and uncached misses (too large to cache) of all the processes,
+        and the hit rate in %"""
+        hits, misses, evictions, uncached = self.counters.sum(dim=0).tolist()
+        return {'hits': hits, 'misses': misses, 'evictions': evictions, 'uncached': uncached,
+                'hit_rate': 100. * hits / max(hits + misses, 1)}
+
+
 class MetaDataset(torch.utils.data.Dataset):
 
     def __init__(self, dataset_name,
@@ -30,7 +364,8 @@ class MetaDataset(torch.utils.data.Dataset):
                        fix_support,
                        save_folder,
                        fix_support_path='',
-                       verbose=True):
+                       verbose=True,
+                       batched_transforms=False):
         """[summary]
 
         Args:
@@ -48,6 +383,9 @@ class MetaDataset(torch.utils.data.Dataset):
                                               information is saved at. Load this support set
                                               when this path is not the empty string. Defaults to ''.
             verbose (bool, optional): print the configuration. Defaults to True.
+            batched_transforms (bool, optional): transform the support (query) images of all the classes
+                                                 of a task batch together with a BatchedTransform instead of
+                                                 one PIL transform per image (see __getitems__). Defaults to False.
         """
         self.dataset_name = dataset_name
         self.support_class_images_set = support_class_images_set
@@ -71,6 +409,8 @@ class MetaDataset(torch.utils.data.Dataset):
                 query: {self.query_class_images_set.keys()}"""
 
         self.classes = list(support_class_images_set.keys())
+        self.support_class_images_set.check_image_size(image_size)
+        self.query_class_images_set.check_image_size(image_size)
         # logs
         if verbose:
             print(f"No. of classes in set support {len(self.support_class_images_set)} \
@@ -84,6 +424,13 @@ class MetaDataset(torch.utils.data.Dataset):
         self.trans_loader = TransformLoader(image_size)
         support_transform = self.trans_loader.get_composed_transform(dataset_name, aug=support_aug)
         query_transform = self.trans_loader.get_composed_transform(dataset_name, aug=query_aug)
+        self.batched_transforms = batched_transforms
+        if batched_transforms:
+            self.support_batch_transform = self.trans_loader.get_batched_transform(dataset_name, aug=support_aug)
+            self.query_batch_transform = self.trans_loader.get_batched_transform(dataset_name, aug=query_aug)
+        # identifies the (deterministic) transform in image keys, None when the transform is random
+        self.support_transform_key = None if support_aug else (dataset_name, image_size)
+        self.query_transform_key = None if query_aug else (dataset_name, image_size)
     
         # support
         self.support_sub_dataloader = {} 
@@ -144,32 +491,98 @@ class MetaDataset(torch.utils.data.Dataset):
                     'support_y': tensor of shape (task_class_info['n_shot])
                     'query_x_cl': tensor of shape (task_class_info['n_shot], c, h, w)
                     'query_y': tensor of shape (task_class_info['n_shot])
+                    'support_keys_cl', 'query_keys_cl': list of image keys (see get_image_keys)
                     'cl': the unique cl identifier (for debugging)
         """
+        if self.batched_transforms:
+            return self.__getitems__([task_class_info])[0]
+        return self.sample_class(task_class_info)
+
+
+    def __getitems__(self, task_class_infos):
+        """return the support, query tuples of a batch of classes (see __getitem__),
+        the DataLoader calls it with all the classes of a task batch at once
+
+        With batched transforms, the support images of all the classes are transformed
+        in one call of the support BatchedTransform, and likewise for the query images.
+
+        Args:
+            task_class_infos (list of dict): the information of each class requested (see __getitem__)
+
+        Returns:
+            list of dict: one per class, as returned by __getitem__
+        """
+        if not self.batched_transforms:
+            return [self.sample_class(task_class_info) for task_class_info in task_class_infos]
+
+        results = [self.sample_class(task_class_info, raw=True) for task_class_info in task_class_infos]
+        for key, batch_transform in [('support_x_cl', self.support_batch_transform),
+                                     ('query_x_cl', self.query_batch_transform)]:
+            requested = [result for result in results if key in result]
+            if len(requested) == 0:
+                continue
+            images = [image for result in requested for image in result[key]]
+            transformed = batch_transform(images).split([len(result[key]) for result in requested])
+            for result, x in zip(requested, transformed):
+                result[key] = x
+        return results
+
+
+    def sample_class(self, task_class_info, raw=False):
+        """sample the support and query images of a class (see __getitem__)
+
+        Args:
+            task_class_info (dict): the information of the class requested (see __getitem__)
+            raw (bool, optional): leave the images untransformed, as lists of uint8 (h, w, 3) arrays. Defaults to False.
+        """
         cl = task_class_info['cl']
         result = {'task_idx': task_class_info['task_idx'],
                   'cl': cl}
 
         if task_class_info['n_shot'] > 0:
-            support_x, support_y = self.support_sub_dataloader[cl].get_random_batch(
+            support_x, support_y, support_indices = self.support_sub_dataloader[cl].get_random_batch(
                                         class_info={
                                             'num': task_class_info['n_shot'],
                                             'cl_label': task_class_info['cl_label'],
-                                        })
+                                        },
+                                        return_indices=True,
+                                        raw=raw)
             result['support_x_cl'] = support_x
             result['support_y_cl'] = support_y
+            result['support_keys_cl'] = self.get_image_keys(
+                self.support_class_images_set[cl], support_indices, self.support_transform_key)
         if task_class_info['n_query'] > 0:
-            query_x, query_y = self.query_sub_dataloader[cl].get_random_batch(
+            query_x, query_y, query_indices = self.query_sub_dataloader[cl].get_random_batch(
                                         class_info={
                                             'num': task_class_info['n_query'],
                                             'cl_label': task_class_info['cl_label'],
-                                        })
+                                        },
+                                        return_indices=True,
+                                        raw=raw)
             result['query_x_cl'] = query_x
             result['query_y_cl'] = query_y
+            result['query_keys_cl'] = self.get_image_keys(
+                self.query_class_images_set[cl], query_indices, self.query_transform_key)
 
         return result
 
 
+    def get_image_keys(self, class_images, indices, transform_key):
+        """keys that identify the transformed images, used to cache their embeddings
+
+        Args:
+            class_images (ClassImages): the class the images were drawn from
+            indices (list of int): indices of the images within class_images
+            transform_key (tuple): identity of the transform applied, None if it is random
+
+        Returns:
+            list: one (cl, image path, transform_key) tuple per image, or None for randomly transformed images
+        """
+        if transform_key is None:
+            return [None] * len(indices)
+        return [(class_images.cl, class_images.sub_meta[idx], transform_key) for idx in indices]
+
+
     def __len__(self):
         return len(self.support_class_images_set)
 
@@ -272,35 +685,44 @@ class SubMetadataset(torch.utils.data.Dataset):
         return img, target
 
 
-    def get_random_batch(self, class_info):
+    def get_random_batch(self, class_info, return_indices=False, raw=False):
         """get a random batch of data from this submetadataset
 
         Args:
             class_info (dict): a dictionary containing information of the class requested
                                 ['num']: number of examples requested
                                 ['cl_label']: the label to be used for this class
+            return_indices (bool, optional): also return the indices (within class_images)
+                                             of the sampled images. Defaults to False.
+            raw (bool, optional): return the untransformed images as a list of uint8 (h, w, 3) arrays
+                                  (to be transformed later as a batch). Defaults to False.
 
         Returns:
             2-element tuple: inputs, labels
                              inputs of shape (class_info['num'], c, h, w)
                              labels of shape (class_info['num']) of integer labels specific by
                                         class_info['cl_label']
+            (3-element tuple inputs, labels, indices if return_indices)
         """        
 
         if class_info['num'] == 0:
             # return None if not requesting
-            return None, None
-
-        inputs = \
-            [self.transform(self.class_images[idx])
-                for idx in np.random.choice(
-                                a=self.indices,
-                                size=class_info['num'],
-                                replace=False)] # class_info['num'] must be <= len(self.indices)
+            return (None, None, None) if return_indices else (None, None)
+
+        indices = np.random.choice(
+                        a=self.indices,
+                        size=class_info['num'],
+                        replace=False) # class_info['num'] must be <= len(self.indices)
+        if raw:
+            inputs = [self.class_images.get_array(idx) for idx in indices]
+        else:
+            inputs = torch.stack(tensors=[self.transform(self.class_images[idx]) for idx in indices], dim=0)
 
         labels = [self.target_transform(class_info['cl_label'])] * class_info['num']
 
-        return torch.stack(tensors=inputs, dim=0), torch.tensor(labels)
+        if return_indices:
+            return inputs, torch.tensor(labels), indices.tolist()
+        return inputs, torch.tensor(labels)
 
 
     def __len__(self):
@@ -309,21 +731,44 @@ class SubMetadataset(torch.utils.data.Dataset):
 
 class ClassImagesSet:
 
-    def __init__(self, *data_files, preload=False):
+    def __init__(self, *data_files, preload=False, packed=False, preload_memory_budget=0,
+                 image_cache_budget=0, image_cache_shared=False, image_cache_slot_bytes=0, encoded_in_memory=False):
         """data structure that holds each class's image dataset in the dictionary support_class_images_set/query_class_images_set
 
         Args:
             data_files (str): variable len argument to paths of the json files.
             preload (bool, optional): whether preload the images into memory. Defaults to False.
+            packed (bool, optional): read the images from the packed store of each json file
+                                     (see src/data/image_store.py) instead of decoding the image files. Defaults to False.
+            preload_memory_budget (int, optional): maximum number of bytes of decoded images to preload,
+                                                   the rest is loaded lazily (0 for no limit). Defaults to 0.
+            image_cache_budget (int, optional): if > 0, the lazily loaded images are kept in a DecodedImageCache
+                                                of this many bytes. Defaults to 0.
+            image_cache_shared (bool, optional): one cache shared by all the loader workers instead of
+                                                 one per worker. Defaults to False.
+            image_cache_slot_bytes (int, optional): size of each slot of the shared cache, 0 for the largest
+                                                    decoded size of a sample of the images. Defaults to 0.
+            encoded_in_memory (bool, optional): read the encoded bytes of all the image files into memory
+                                                (see EncodedImages), so that the images that are not preloaded
+                                                are decoded from memory instead of read from disk. Defaults to False.
         """
 
         # read json file
         self.meta = {}
+        # packed store holding the images of each class
+        self.class_stores = {}
         # merge multiple json files (this requires that 'image_labels' to be distinct for different classes)
         for data_file in data_files:
-            print("loading image paths, labels from json ", data_file)
-            with open(data_file, 'r') as f:
-                self.update_meta(json.load(f))
+            if packed:
+                store = PackedImageStore(data_file)
+                # the index lists the images in the order of the store
+                self.update_meta({k: list(store.meta[k]) for k in ['image_names', 'image_labels']})
+                for cl in store.class_offsets:
+                    self.class_stores[cl] = store
+            else:
+                print("loading image paths, labels from json ", data_file)
+                with open(data_file, 'r') as f:
+                    self.update_meta(json.load(f))
 
         # map class labels to unique integers in 0, ..., num_unique_classes - 1
         self.label2target = {v:k for k,v in enumerate(np.unique(self.meta['image_labels']))}
@@ -336,10 +781,70 @@ class ClassImagesSet:
         for path, cl in zip(self.meta['image_names'], self.meta['image_labels']):
             self.per_class_image_paths[cl].append(path)
         
+        # index of the first image of each class in the class-ordered list of all images
+        class_starts = np.cumsum([0] + [len(self.per_class_image_paths[cl]) for cl in self.classes])
+
+        # preload the images of all the classes at once, in a buffer shared by all loaders and their workers
+        self.preloaded_images = None
+        if preload and packed:
+            self.preloaded_images = PreloadedImages(
+                images=_ClassOrderedStoreImages(self.classes, self.class_stores),
+                memory_budget=preload_memory_budget)
+        elif preload:
+            self.preloaded_images = PreloadedImages(
+                [path for cl in self.classes for path in self.per_class_image_paths[cl]],
+                memory_budget=preload_memory_budget)
+
+        # encoded bytes of all the images, class after class like the preloaded images
+        self.encoded_images = None
+        if encoded_in_memory and not packed and not (preload and preload_memory_budget == 0):
+            self.encoded_images = EncodedImages(
+                [path for cl in self.classes for path in self.per_class_image_paths[cl]])
+
+        # cache of the images decoded lazily
+        self.image_cache = None
+        if image_cache_budget > 0 and not packed and not (preload and preload_memory_budget == 0):
+            slot_bytes = None
+            if image_cache_shared:
+                # larger images are not cached (see the uncached count of the cache stats)
+                slot_bytes = image_cache_slot_bytes if image_cache_slot_bytes > 0 else \
+                    max_image_nbytes(self.meta['image_names'])
+            self.image_cache = DecodedImageCache(image_cache_budget, shared=image_cache_shared, slot_bytes=slot_bytes)
+
         # create class images set
         self.class_images_set = {}
-        for cl in self.classes:
-            self.class_images_set[cl] = ClassImages(self.per_class_image_paths[cl], cl, preload)
+        for i, cl in enumerate(self.classes):
+            preloaded_indices = np.arange(class_starts[i], class_starts[i + 1])
+            if cl in self.class_stores:
+                store = self.class_stores[cl]
+                start, end = store.class_offsets[cl]
+                assert end - start == len(self.per_class_image_paths[cl])
+                self.class_images_set[cl] = ClassImages(self.per_class_image_paths[cl], cl,
+                    store=store, store_indices=np.arange(start, end),
+                    preloaded_images=self.preloaded_images, preloaded_indices=preloaded_indices)
+            else:
+                self.class_images_set[cl] = ClassImages(self.per_class_image_paths[cl], cl,
+                    preloaded_images=self.preloaded_images, preloaded_indices=preloaded_indices,
+                    encoded_images=self.encoded_images, image_cache=self.image_cache)
+
+
+    def check_image_size(self, image_size):
+        """
+        asserts that the packed stores hold image_size x image_size images,
+        a store packed at another side length would be resized again by every transform
+        """
+        for store in set(self.class_stores.values()):
+            assert store.images.shape[1:3] == (image_size, image_size), \
+                f"packed images {store.array_path} are {store.images.shape[1]} x {store.images.shape[2]}, " \
+                f"expected {image_size} x {image_size}, repack them with --img-side-len {image_size}"
+
+
+    def has_per_worker_image_cache(self):
+        """
+        whether the lazily loaded images are cached in every loader worker (see DecodedImageCache),
+        in which case the workers should persist across epochs to keep their caches
+        """
+        return self.image_cache is not None and not self.image_cache.shared
 
 
     def update_meta(self, json_obj):
@@ -390,21 +895,52 @@ class ClassImagesSet:
         return self.classes
 
 
+class _ClassOrderedStoreImages:
+
+    def __init__(self, classes, class_stores):
+        # the images of the packed stores of classes, class after class, read one class block at a time
+        self.classes = classes
+        self.class_stores = class_stores
+
+    def __len__(self):
+        return sum(end - start for start, end in
+                   (self.class_stores[cl].class_offsets[cl] for cl in self.classes))
+
+    def __iter__(self):
+        for cl in self.classes:
+            start, end = self.class_stores[cl].class_offsets[cl]
+            yield from np.array(self.class_stores[cl].images[start:end])
+
+
 class ClassImages:
 
-    def __init__(self, sub_meta, cl, preload=False):
+    def __init__(self, sub_meta, cl, preload=False, store=None, store_indices=None,
+                 preloaded_images=None, preloaded_indices=None, encoded_images=None, image_cache=None):
         """the dataset containing all the images of a specific class cl, examples obtainable by __getitem__(i):
 
         Args:
             sub_meta (list of str): a list of image paths of class name cl
             cl (int): a unique integer identifying the class
             preload (bool, optional): whether to load all the images into memory. Defaults to False.
+            store (PackedImageStore, optional): packed store to read the images from instead of the image files.
+            store_indices (np.array, optional): index in store of each image of sub_meta.
+            preloaded_images (PreloadedImages, optional): images preloaded by ClassImagesSet.
+            preloaded_indices (np.array, optional): index in preloaded_images of each image of sub_meta,
+                                                    also its index in encoded_images.
+            encoded_images (EncodedImages, optional): encoded bytes of the images, read by ClassImagesSet.
+            image_cache (DecodedImageCache, optional): cache of the images that are not preloaded.
         """
         self.sub_meta = sub_meta
         self.inv_sub_meta = {v:k for k,v in enumerate(self.sub_meta)} # maps the unique file path to an index
         self.images = []
         self.cl = cl 
         self.preload = preload
+        self.store = store
+        self.store_indices = store_indices
+        self.preloaded_images = preloaded_images
+        self.preloaded_indices = preloaded_indices
+        self.encoded_images = encoded_images
+        self.image_cache = image_cache
         
         if preload:
             print(f"Attempt loading class {cl} into memory")
@@ -418,17 +954,49 @@ class ClassImages:
 
         self.original_sub_meta = self.sub_meta
         self.original_images = self.images
+        self.original_store_indices = self.store_indices
+        self.original_preloaded_indices = self.preloaded_indices
 
 
     def __getitem__(self, i):
         # load the i-th image of this class
         if self.preload:
             img = self.images[i]
+        elif self.preloaded_images is not None and self.preloaded_indices[i] in self.preloaded_images:
+            img = self.preloaded_images[self.preloaded_indices[i]]
+        elif self.store is not None:
+            img = self.store[self.store_indices[i]]
+        elif self.image_cache is not None:
+            img = Image.fromarray(self.image_cache.get(self.sub_meta[i], lambda path: self.load_array(i)))
+        elif self.encoded_images is not None:
+            img = self.encoded_images[self.preloaded_indices[i]]
         else:
             img = load_image(self.sub_meta[i])
         return img
 
 
+    def get_array(self, i):
+        # load the i-th image of this class as a uint8 (h, w, 3) array, without going through PIL when possible
+        if self.preload:
+            img = np.asarray(self.images[i])
+        elif self.preloaded_images is not None and self.preloaded_indices[i] in self.preloaded_images:
+            img = self.preloaded_images.get_array(self.preloaded_indices[i])
+        elif self.store is not None:
+            img = self.store.get_array(self.store_indices[i])
+        elif self.image_cache is not None:
+            img = self.image_cache.get(self.sub_meta[i], lambda path: self.load_array(i))
+        else:
+            img = self.load_array(i)
+        return img
+
+
+    def load_array(self, i):
+        # decode the i-th image, from its encoded bytes in memory when they were read
+        if self.encoded_images is not None:
+            return self.encoded_images.get_array(self.preloaded_indices[i])
+        return load_image_array(self.sub_meta[i])
+
+
     def __len__(self):
         return len(self.sub_meta)
 
@@ -443,6 +1011,10 @@ class ClassImages:
         self.sub_meta = [self.original_sub_meta[x] for x in selected_indices]
         if self.preload:
             self.images = [self.original_images[x] for x in selected_indices]
+        if self.store is not None:
+            self.store_indices = self.original_store_indices[selected_indices]
+        if self.preloaded_images is not None or self.encoded_images is not None:
+            self.preloaded_indices = self.original_preloaded_indices[selected_indices]
         print(f"No. of samples in class {self.cl}: {len(self.sub_meta)}")
 
 
@@ -473,6 +1045,7 @@ class SimpleDataset(torch.utils.data.Dataset):
         
         # list of classes
         self.classes = list(class_images_set.keys())
+        self.class_images_set.check_image_size(image_size)
         
         # logs
         if verbose:
@@ -0,0 +1,150 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import numpy as np
+from PIL import Image
+
+
+"""
+Packed image store.
+Each split filelist (base.json, val.json, ...) is decoded and resized once into a single
+uint8 (N, H, W, 3) .npy file, with the images of every class stored contiguously, and an index
+.json file with the image names and labels in that order and the (start, end) offsets of each class.
+The .npy file is opened as a read-only memory map, so reads need no file open or decode and
+the pages are shared by all dataloader workers through the OS page cache.
+"""
+
+
+def packed_store_paths(data_file):
+    """the paths of the packed store of a split filelist
+
+    Args:
+        data_file (str): path to the json filelist, e.g. base.json
+
+    Returns:
+        tuple: (path of the .npy image array, path of the .json index), e.g. base.packed.npy, base.packed.json
+    """
+    root = os.path.splitext(data_file)[0]
+    return root + '.packed.npy', root + '.packed.json'
+
+
+def load_resized_image(image_path, image_size):
+    """decode an image to a uint8 (image_size, image_size, 3) array"""
+    img = Image.open(image_path).convert('RGB')
+    if img.size != (image_size, image_size):
+        # same interpolation as transforms.Resize
+        img = img.resize((image_size, image_size), Image.BILINEAR)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def pack_images(data_file, image_size, max_workers=8):
+    """decode and resize all the images of a json filelist into a packed store
+
+    Args:
+        data_file (str): path to the json filelist with 'image_names' and 'image_labels'
+        image_size (int): the side length the images are resized to
+        max_workers (int, optional): number of decoding processes. Defaults to 8.
+
+    Returns:
+        tuple: the paths of the written .npy image array and .json index
+    """
+    with open(data_file, 'r') as f:
+        meta = json.load(f)
+
+    # group the images by class, keeping the filelist order within each class
+    per_class_image_names = {}
+    for path, cl in zip(meta['image_names'], meta['image_labels']):
+        per_class_image_names.setdefault(cl, []).append(path)
+
+    image_names, image_labels, class_offsets = [], [], []
+    for cl, paths in per_class_image_names.items():
+        class_offsets.append([cl, len(image_names), len(image_names) + len(paths)])
+        image_names.extend(paths)
+        image_labels.extend([cl] * len(paths))
+
+    array_path, index_path = packed_store_paths(data_file)
+    print(f"packing {len(image_names)} images of {len(class_offsets)} classes from {data_file} into {array_path}")
+    images = np.lib.format.open_memmap(array_path, mode='w+', dtype=np.uint8,
+        shape=(len(image_names), image_size, image_size, 3))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for i, image in enumerate(executor.map(load_resized_image, image_names,
+                [image_size] * len(image_names), chunksize=64)):
+            images[i] = image
+    images.flush()
+    del images
+
+    index = {'image_names': image_names, 'image_labels': image_labels, 'class_offsets': class_offsets}
+    if 'label_names' in meta:
+        index['label_names'] = meta['label_names']
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+
+    return array_path, index_path
+
+
+class PackedImageStore:
+
+    def __init__(self, data_file):
+        """read-only access to the packed store of a json filelist (see pack_images)
+
+        Args:
+            data_file (str): path to the json filelist the store was packed from
+        """
+        self.array_path, self.index_path = packed_store_paths(data_file)
+        with open(self.index_path, 'r') as f:
+            self.meta = json.load(f)
+        # maps each class label to the (start, end) offsets of its images
+        self.class_offsets = {cl: (start, end) for cl, start, end in self.meta['class_offsets']}
+        self._images = None
+        print(f"using packed images {self.array_path} of shape {self.images.shape}")
+
+
+    @property
+    def images(self):
+        # opened lazily so that every dataloader worker maps the file itself
+        if self._images is None:
+            self._images = np.load(self.array_path, mmap_mode='r')
+        return self._images
+
+
+    def __getstate__(self):
+        # never pickle the memory map, that would copy the whole array to the worker
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+
+    def __getitem__(self, i):
+        # the i-th image of the store as a PIL image
+        return Image.fromarray(self.get_array(i))
+
+
+    def get_array(self, i):
+        # the i-th image of the store as a uint8 (h, w, 3) array
+        return np.asarray(self.images[i])
+
+
+    def __len__(self):
+        return len(self.meta['image_names'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Pack the images of each split into a memory-mapped store')
+    parser.add_argument('--dataset-path', type=str, required=True,
+        help='folder with the json filelists of the dataset')
+    parser.add_argument('--img-side-len', type=int, default=84,
+        help='side length the images are resized to')
+    parser.add_argument('--splits', type=str, nargs='+', default=['base', 'val', 'novel', 'base_test'],
+        help='json filelists to pack (the missing ones are skipped)')
+    parser.add_argument('--num-workers', type=int, default=8,
+        help='number of decoding processes')
+    args = parser.parse_args()
+
+    for split in args.splits:
+        data_file = os.path.join(args.dataset_path, split + '.json')
+        if not os.path.exists(data_file):
+            print("skipping missing", data_file)
+            continue
+        pack_images(data_file, args.img_side_len, max_workers=args.num_workers)
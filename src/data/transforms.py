@@ -1,10 +1,17 @@
 import torch
+import torch.nn.functional as F
 from PIL import Image
 import numpy as np
 import torchvision.transforms as transforms
 # from abc import abstractmethod
 import torch
 from PIL import ImageEnhance
+from collections import defaultdict
+
+
+def to_array(x):
+    # a named function (unlike a lambda) can be pickled with the dataset, e.g. to spawned processes
+    return np.array(x)
 
 
 """
@@ -47,6 +54,18 @@ class TransformLoader:
         else:
             return method() # these methods go not have arguments
 
+    def get_normalize_param(self, dataset_name):
+        """mean and std used to normalize the images of dataset_name"""
+        if 'cifar' in dataset_name.lower() or 'fc100' in dataset_name.lower():
+            return dict(mean=[x/255.0 for x in [129.37731888, 124.10583864, 112.47758569]],
+                        std=[x/255.0 for x in [68.20947949, 65.43124043, 70.45866994]])
+        elif 'mini' in dataset_name.lower():
+            return self.normalize_param
+        else:
+            assert 'tier' in dataset_name.lower()
+            return dict(mean=[x/255.0 for x in [120.39586422,  115.59361427, 104.54012653]],
+                        std=[x/255.0 for x in [70.68188272,  68.27635443,  72.54505529]])
+
     def get_composed_transform(self, dataset_name, aug=False):
         """Generate a composed transform for dataset_name
 
@@ -58,22 +77,20 @@ class TransformLoader:
             [type]: [description]
         """        
         if  'cifar' in dataset_name.lower() or 'fc100' in dataset_name.lower():
-            mean_pix = [x/255.0 for x in [129.37731888, 124.10583864, 112.47758569]]
-            std_pix = [x/255.0 for x in [68.20947949, 65.43124043, 70.45866994]]
-            normalize = transforms.Normalize(mean=mean_pix, std=std_pix)
+            normalize = transforms.Normalize(**self.get_normalize_param(dataset_name))
             if aug:
                 print("Using cifar/fc100 specific augmentation strategy")
                 transform = transforms.Compose([
                     transforms.RandomCrop(size=32, padding=4), # border is padded with 4 px on each side
                     transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4), # [max(0, 1 - brightness), 1 + brightness] 
                     transforms.RandomHorizontalFlip(p=0.5),
-                    lambda x: np.array(x), # TODO: is this necessary?
+                    to_array, # TODO: is this necessary?
                     transforms.ToTensor(),
                     normalize
                 ])
             else:
                 transform = transforms.Compose([
-                    lambda x: np.array(x),
+                    to_array,
                     transforms.ToTensor(),
                     normalize
                 ])
@@ -89,27 +106,263 @@ class TransformLoader:
 
         else:
             assert 'tier' in dataset_name.lower()
-            mean_pix = [x/255.0 for x in [120.39586422,  115.59361427, 104.54012653]]
-            std_pix = [x/255.0 for x in [70.68188272,  68.27635443,  72.54505529]]
-            normalize = transforms.Normalize(mean=mean_pix, std=std_pix)
+            normalize = transforms.Normalize(**self.get_normalize_param(dataset_name))
             if aug:
                 transform = transforms.Compose([
                     transforms.RandomCrop(84, padding=8),
                     transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4),
                     transforms.RandomHorizontalFlip(),
-                    lambda x: np.array(x),
+                    to_array,
                     transforms.ToTensor(),
                     normalize
                 ])
             else:
                 transform = transforms.Compose([
-                    lambda x: np.array(x),
+                    to_array,
                     transforms.ToTensor(),
                     normalize
                 ])
 
         return transform
 
+    def get_batched_transform(self, dataset_name, aug=False):
+        """Generate a BatchedTransform for dataset_name, which applies the same
+        augmentation policy as get_composed_transform to a whole batch of images at once
+
+        Args:
+            dataset_name (str): name of the dataset (determines what type of image transformation to be used)
+            aug (bool, optional): whether to use data augmentation. Defaults to False.
+
+        Returns:
+            BatchedTransform: maps a list of uint8 (h, w, 3) arrays to a (n, 3, image_size, image_size) Tensor
+        """
+        normalize_param = self.get_normalize_param(dataset_name)
+        if 'cifar' in dataset_name.lower() or 'fc100' in dataset_name.lower():
+            if aug:
+                # RandomCrop(32, padding=4), ColorJitter, RandomHorizontalFlip
+                return BatchedTransform(32, normalize_param, crop_padding=4,
+                    jitter=0.4, random_jitter_order=True, flip=True)
+            return BatchedTransform(None, normalize_param)
+        elif 'mini' in dataset_name.lower():
+            if aug:
+                # RandomResizedCrop, ImageJitter, RandomHorizontalFlip
+                return BatchedTransform(self.image_size, normalize_param, random_resized_crop=True,
+                    jitter=self.jitter_param['Brightness'], random_jitter_order=False, flip=True)
+            return BatchedTransform(self.image_size, normalize_param, resize=True)
+        else:
+            assert 'tier' in dataset_name.lower()
+            if aug:
+                # RandomCrop(84, padding=8), ColorJitter, RandomHorizontalFlip
+                return BatchedTransform(84, normalize_param, crop_padding=8,
+                    jitter=0.4, random_jitter_order=True, flip=True)
+            return BatchedTransform(None, normalize_param)
+
+
+"""
+Batched augmentation on uint8 image tensors.
+The random crops (and flips) of a batch are gathered or resampled in one operation and
+the brightness, contrast and saturation (PIL ImageEnhance Brightness, Contrast and Color)
+factors are blended per image, so a whole episode is augmented with a few tensor operations
+instead of one PIL pipeline per image. The geometric transforms are applied before the
+color ones, which commutes with the per-image PIL pipelines above.
+"""
+GRAYSCALE_WEIGHTS = torch.tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)
+
+
+def batched_grayscale(x):
+    # ITU-R 601-2 luma transform of PIL convert('L'), x is (n, 3, h, w)
+    return (x * GRAYSCALE_WEIGHTS).sum(dim=1, keepdim=True)
+
+
+# like PIL, the blends are clipped and truncated to integer values
+def batched_adjust_brightness(x, factor):
+    # blend with a black image, factor is (n, 1, 1, 1)
+    return (x * factor).clamp_(0, 255).floor_()
+
+
+def batched_adjust_contrast(x, factor):
+    # blend with the mean grayscale value of each image
+    mean = (x.mean(dim=(2, 3), keepdim=True) * GRAYSCALE_WEIGHTS).sum(dim=1, keepdim=True)
+    return (x - mean).mul_(factor).add_(mean).clamp_(0, 255).floor_()
+
+
+def batched_adjust_saturation(x, factor):
+    # blend with the grayscale image
+    gray = batched_grayscale(x)
+    return (x - gray).mul_(factor).add_(gray).clamp_(0, 255).floor_()
+
+
+def batched_random_resized_crop_params(n, height, width, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), n_attempts=10):
+    """the crop boxes of transforms.RandomResizedCrop for n images of the same size, sampled together
+
+    Returns:
+        tuple: (top, left, crop height, crop width), each a (n,) Tensor
+    """
+    area = height * width
+    log_ratio = torch.log(torch.tensor(ratio))
+    target_area = area * torch.empty(n, n_attempts).uniform_(scale[0], scale[1])
+    aspect_ratio = torch.exp(torch.empty(n, n_attempts).uniform_(log_ratio[0], log_ratio[1]))
+    w = torch.round(torch.sqrt(target_area * aspect_ratio))
+    h = torch.round(torch.sqrt(target_area / aspect_ratio))
+    valid = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+
+    # fallback to the central crop, as in transforms.RandomResizedCrop
+    in_ratio = width / height
+    if in_ratio < min(ratio):
+        fallback_w, fallback_h = width, round(width / min(ratio))
+    elif in_ratio > max(ratio):
+        fallback_w, fallback_h = round(height * max(ratio)), height
+    else:
+        fallback_w, fallback_h = width, height
+
+    # first valid attempt of each image
+    first = torch.argmax(valid.int(), dim=1)
+    found = valid.any(dim=1)
+    crop_w = torch.where(found, w.gather(1, first.unsqueeze(1)).squeeze(1), torch.tensor(float(fallback_w)))
+    crop_h = torch.where(found, h.gather(1, first.unsqueeze(1)).squeeze(1), torch.tensor(float(fallback_h)))
+    top = torch.where(found, torch.floor(torch.rand(n) * (height - crop_h + 1)), torch.floor((height - crop_h) / 2))
+    left = torch.where(found, torch.floor(torch.rand(n) * (width - crop_w + 1)), torch.floor((width - crop_w) / 2))
+    return top, left, crop_h, crop_w
+
+
+def batched_resized_crop(x, top, left, crop_h, crop_w, size, flip=None):
+    """crop a box of each image and resize it to (size, size) with bilinear interpolation,
+    optionally flipping it horizontally, with a single grid_sample
+
+    Args:
+        x: a (n, c, h, w) float Tensor.
+        top, left, crop_h, crop_w: (n,) Tensors, the crop boxes in pixels.
+        size: a scalar. Output side length.
+        flip: an optional (n,) bool Tensor of the images to flip.
+    Returns: a (n, c, size, size) Tensor.
+    """
+    n, _, height, width = x.size()
+    # maps the normalized output coordinates to the normalized input coordinates of the box
+    theta = torch.zeros(n, 2, 3, dtype=x.dtype)
+    theta[:, 0, 0] = crop_w / width
+    theta[:, 0, 2] = (2 * left + crop_w) / width - 1
+    theta[:, 1, 1] = crop_h / height
+    theta[:, 1, 2] = (2 * top + crop_h) / height - 1
+    if flip is not None:
+        theta[:, 0, 0] = torch.where(flip, -theta[:, 0, 0], theta[:, 0, 0])
+    grid = F.affine_grid(theta, (n, x.size(1), size, size), align_corners=False)
+    # rounded to integer values like the uint8 output of the PIL resize
+    return F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False).round_()
+
+
+def batched_padded_random_crop(x, size, padding, flip=None):
+    """transforms.RandomCrop(size, padding) (zero padding) of every image, optionally flipping it
+    horizontally, gathered along the rows and then the columns
+
+    Args:
+        x: a (n, c, h, w) Tensor.
+        size: a scalar. Output side length.
+        padding: a scalar. Number of zero pixels added on each side.
+        flip: an optional (n,) bool Tensor of the images to flip.
+    Returns: a (n, c, size, size) Tensor.
+    """
+    n, c, height, width = x.size()
+    x = F.pad(x, (padding, padding, padding, padding))
+    top = torch.randint(0, height + 2 * padding - size + 1, (n, 1))
+    left = torch.randint(0, width + 2 * padding - size + 1, (n, 1))
+    offsets = torch.arange(size).unsqueeze(0)
+    rows = top + offsets
+    cols = left + offsets
+    if flip is not None:
+        cols = torch.where(flip.unsqueeze(1), cols.flip(1), cols)
+    x = x.gather(2, rows.view(n, 1, size, 1).expand(n, c, size, x.size(3)))
+    return x.gather(3, cols.view(n, 1, 1, size).expand(n, c, size, size))
+
+
+class BatchedTransform(object):
+
+    def __init__(self, image_size, normalize_param, resize=False, random_resized_crop=False,
+                 crop_padding=0, jitter=0., random_jitter_order=False, flip=False):
+        """augmentation policy applied to a batch of images at once
+
+        Args:
+            image_size (int): side length of the output images (None to keep the input size)
+            normalize_param (dict): mean and std of the final normalization
+            resize (bool, optional): resize the images to image_size (transforms.Resize). Defaults to False.
+            random_resized_crop (bool, optional): transforms.RandomResizedCrop(image_size). Defaults to False.
+            crop_padding (int, optional): if > 0, transforms.RandomCrop(image_size, padding=crop_padding). Defaults to 0.
+            jitter (float, optional): brightness, contrast and saturation factors are drawn
+                                      uniformly in [1 - jitter, 1 + jitter]. Defaults to 0 (no jitter).
+            random_jitter_order (bool, optional): apply the three adjustments in a random order for each image
+                                                  (transforms.ColorJitter) instead of brightness, contrast,
+                                                  saturation (ImageJitter). Defaults to False.
+            flip (bool, optional): random horizontal flips. Defaults to False.
+        """
+        self.image_size = image_size
+        self.mean = torch.tensor(normalize_param['mean']).view(1, 3, 1, 1) * 255.
+        self.std = torch.tensor(normalize_param['std']).view(1, 3, 1, 1) * 255.
+        self.resize = resize
+        self.random_resized_crop = random_resized_crop
+        self.crop_padding = crop_padding
+        self.jitter = jitter
+        self.random_jitter_order = random_jitter_order
+        self.flip = flip
+
+
+    def geometric(self, x):
+        # crops, flips and resizing of a (n, 3, h, w) batch of images of the same size
+        n, _, height, width = x.size()
+        flip = torch.rand(n) < 0.5 if self.flip else None
+        if self.random_resized_crop:
+            top, left, crop_h, crop_w = batched_random_resized_crop_params(n, height, width)
+            return batched_resized_crop(x, top, left, crop_h, crop_w, self.image_size, flip)
+        if self.crop_padding > 0:
+            return batched_padded_random_crop(x, self.image_size, self.crop_padding, flip)
+        if self.resize and (height, width) != (self.image_size, self.image_size):
+            x = F.interpolate(x, size=(self.image_size, self.image_size), mode='bilinear',
+                align_corners=False, antialias=True).round_().clamp_(0, 255)
+        if flip is not None:
+            x = torch.where(flip.view(n, 1, 1, 1), x.flip(3), x)
+        return x
+
+
+    def color(self, x):
+        # brightness, contrast and saturation jitter of a (n, 3, h, w) batch
+        n = x.size(0)
+        adjustments = [batched_adjust_brightness, batched_adjust_contrast, batched_adjust_saturation]
+        factors = torch.empty(n, len(adjustments)).uniform_(1. - self.jitter, 1. + self.jitter)
+        if not self.random_jitter_order:
+            for k, adjust in enumerate(adjustments):
+                x = adjust(x, factors[:, k].view(n, 1, 1, 1))
+            return x
+        order = torch.argsort(torch.rand(n, len(adjustments)), dim=1)
+        for step in range(len(adjustments)):
+            for k, adjust in enumerate(adjustments):
+                # the images whose step-th adjustment is the k-th one
+                selected = torch.nonzero(order[:, step] == k).squeeze(1)
+                if len(selected) > 0:
+                    x[selected] = adjust(x[selected], factors[selected, k].view(-1, 1, 1, 1))
+        return x
+
+
+    def __call__(self, images):
+        """
+        Args:
+            images (list of np.array): uint8 (h, w, 3) images
+
+        Returns:
+            a (n, 3, image_size, image_size) float Tensor of normalized images
+        """
+        # images of the same size are transformed together
+        groups = defaultdict(list)
+        for i, image in enumerate(images):
+            groups[image.shape].append(i)
+        outputs = [None] * len(images)
+        for indices in groups.values():
+            x = torch.from_numpy(np.stack([images[i] for i in indices])).permute(0, 3, 1, 2).float()
+            for i, transformed in zip(indices, self.geometric(x)):
+                outputs[i] = transformed
+        x = torch.stack(outputs)
+
+        if self.jitter > 0:
+            x = self.color(x)
+        return (x - self.mean) / self.std
+
 
 """
 Jitter transform: Brightness, Contrast, Color, Sharpness
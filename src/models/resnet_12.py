@@ -117,6 +117,9 @@ class ResNet(nn.Module):
             # for 32 by 32 input, resnet 12 will return 2 by 2.
         self.keep_avg_pool = avg_pool
         print("Average pooling: ", self.keep_avg_pool) 
+        # the stages of forward in order (fc includes the pooling and the projection),
+        # a prefix of frozen stages can be run separately with start_stage/end_stage
+        self.stages = ['layer1', 'layer2', 'layer3', 'layer4', 'fc']
 
 
         # classifier creation
@@ -161,11 +164,16 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers) # Oscar: why is this a Sequential? isn't layer just an nn.Module?
 
-    def forward(self, x, only_features=False):
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
+    def forward(self, x, only_features=False, start_stage=0, end_stage=None):
+        """
+        Runs the stages self.stages[start_stage:end_stage] on x,
+        the output of the stage before start_stage (the images if start_stage is 0).
+        """
+        end_stage = len(self.stages) if end_stage is None else end_stage
+        for layer in [self.layer1, self.layer2, self.layer3, self.layer4][start_stage:end_stage]:
+            x = layer(x)
+        if end_stage < len(self.stages):
+            return x
         if self.keep_avg_pool:
             x = self.avgpool(x)
         x = x.view(x.size(0), -1)
@@ -80,6 +80,10 @@ class ShallowConv(nn.Module):
             conv_block(h_dim, z_dim),
         )
         
+        # the stages of forward in order (fc includes the projection),
+        # a prefix of frozen stages can be run separately with start_stage/end_stage
+        self.stages = ['encoder.0', 'encoder.1', 'encoder.2', 'encoder.3', 'fc']
+
         # classifier creation
         self.projection = projection
         print("Unit norm projection is ", self.projection)
@@ -111,8 +115,15 @@ class ShallowConv(nn.Module):
 
 
 
-    def forward(self, x, only_features=False):
-        x = self.encoder(x)
+    def forward(self, x, only_features=False, start_stage=0, end_stage=None):
+        """
+        Runs the stages self.stages[start_stage:end_stage] on x,
+        the output of the stage before start_stage (the images if start_stage is 0).
+        """
+        end_stage = len(self.stages) if end_stage is None else end_stage
+        x = self.encoder[start_stage:end_stage](x)
+        if end_stage < len(self.stages):
+            return x
         x = x.view(x.size(0), -1)
         
         # hypersphere projection
@@ -0,0 +1,163 @@
+import numpy as np
+import pytest
+import torch
+from scipy.special import softmax
+
+from src.algorithms.utils import (
+    logistic_regression_grad_with_respect_to_w,
+    logistic_regression_hessian_pieces_with_respect_to_w,
+    logistic_regression_hessian_with_respect_to_w,
+    logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X,
+    logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X_left_multiply,
+    batched_logistic_regression_grad_with_respect_to_w,
+    batched_logistic_regression_hessian_pieces_with_respect_to_w,
+    batched_logistic_regression_hessian_with_respect_to_w,
+    batched_logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X,
+    batched_logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X_left_multiply,
+)
+
+
+"""
+Parity of the vectorized NumPy logistic-regression derivatives and of their batched torch versions
+with the per-sample loop implementations they replaced (kept below as the reference).
+"""
+
+
+N_BATCH, N, D, C = 3, 7, 4, 5
+
+
+def loop_grad(X, y, w):
+    p = softmax(np.matmul(X, w.T), axis=1)
+    result = np.zeros((C * X.shape[1], 1), dtype=np.float32)
+    I = np.eye(C, dtype=np.float32)
+    for i in range(X.shape[0]):
+        result += np.kron(p[i].reshape(-1, 1) - I[:, y[i]: y[i]+1], X[i].reshape(-1, 1))
+    return result / X.shape[0]
+
+
+def loop_hessian_pieces(X, y, w):
+    p = softmax(np.matmul(X, w.T), axis=1)
+    n, d = X.shape[0], X.shape[1] - 1
+    Xbar = np.zeros(shape=(n * (C+1), C * (d+1)), dtype=np.float32)
+    diag = []
+    for i in range(n):
+        for j in range(C):
+            Xbar[i * C + j, j * (d+1): (j+1) * (d+1)] = X[i]
+        diag.extend(p[i] / n)
+    for i in range(n):
+        Xbar[n * C + i, :] = np.kron(p[i], X[i])
+        diag.append(-1 / n)
+    return diag, Xbar
+
+
+def loop_hessian(X, y, w):
+    diag, Xbar = loop_hessian_pieces(X, y, w)
+    return np.matmul(np.matmul(Xbar.T, np.diag(diag)), Xbar)
+
+
+def loop_mixed_derivatives(X, y, w):
+    p = softmax(np.matmul(X, w.T), axis=1)
+    n, d = X.shape[0], X.shape[1] - 1
+    I_C = np.eye(C, dtype=np.float32)
+    result = np.kron((p - I_C[y]).T, np.eye(d + 1, dtype=np.float32))
+    for i in range(n):
+        weighted_w = np.matmul(np.diag(p[i]), np.matmul(I_C - p[i], w))
+        for j in range(C):
+            result[j*(d+1):(j+1)*(d+1), i*(d+1): (i+1)*(d+1)] += np.outer(X[i], weighted_w[j])
+    return result / n
+
+
+def loop_mixed_derivatives_left_multiply(X, y, w, a):
+    p = softmax(np.matmul(X, w.T), axis=1)
+    n, d = X.shape[0], X.shape[1] - 1
+    a_reshape = a.reshape(C, d + 1)
+    Xap = np.multiply(np.matmul(X, a_reshape.T), p)
+    Xapw = np.matmul(Xap, w)
+    Xap_row_sum = np.sum(Xap, axis=1, keepdims=False)
+    weighted_w = np.matmul(p, w)
+    result = np.matmul(p, a_reshape).reshape(-1)
+    for i in range(n):
+        result[i*(d+1): (i+1)*(d+1)] += -a_reshape[y[i]] + Xapw[i] - Xap_row_sum[i] * weighted_w[i]
+    return result / n
+
+
+@pytest.fixture
+def tasks():
+    # N_BATCH tasks of N samples with D features plus the bias, in float32 like the LogisticRegression head
+    rng = np.random.RandomState(0)
+    X = rng.randn(N_BATCH, N, D + 1).astype(np.float32)
+    X[:, :, -1] = 1.
+    y = rng.randint(C, size=(N_BATCH, N))
+    w = rng.randn(N_BATCH, C, D + 1).astype(np.float32)
+    a = rng.randn(N_BATCH, C * (D + 1)).astype(np.float32)
+    return X, y, w, a
+
+
+def assert_close(actual, expected):
+    np.testing.assert_allclose(np.asarray(actual, dtype=np.float64), np.asarray(expected, dtype=np.float64),
+        rtol=1e-4, atol=1e-6)
+
+
+def test_grad(tasks):
+    X, y, w, _ = tasks
+    batched = batched_logistic_regression_grad_with_respect_to_w(
+        torch.from_numpy(X), torch.from_numpy(y), torch.from_numpy(w))
+    for b in range(N_BATCH):
+        expected = loop_grad(X[b], y[b], w[b])
+        result = logistic_regression_grad_with_respect_to_w(X[b], y[b], w[b])
+        assert result.shape == expected.shape and result.dtype == expected.dtype
+        assert_close(result, expected)
+        assert_close(batched[b].numpy().reshape(-1, 1), expected)
+
+
+def test_hessian_pieces(tasks):
+    X, y, w, _ = tasks
+    batched_diag, batched_Xbar = batched_logistic_regression_hessian_pieces_with_respect_to_w(
+        torch.from_numpy(X), torch.from_numpy(y), torch.from_numpy(w))
+    for b in range(N_BATCH):
+        expected_diag, expected_Xbar = loop_hessian_pieces(X[b], y[b], w[b])
+        diag, Xbar = logistic_regression_hessian_pieces_with_respect_to_w(X[b], y[b], w[b])
+        assert len(diag) == len(expected_diag) and Xbar.shape == expected_Xbar.shape
+        assert_close(diag, expected_diag)
+        assert_close(Xbar, expected_Xbar)
+        assert_close(batched_diag[b].numpy(), expected_diag)
+        assert_close(batched_Xbar[b].numpy(), expected_Xbar)
+
+
+def test_hessian_without_diag_matrix(tasks):
+    X, y, w, _ = tasks
+    batched = batched_logistic_regression_hessian_with_respect_to_w(
+        torch.from_numpy(X), torch.from_numpy(y), torch.from_numpy(w))
+    for b in range(N_BATCH):
+        expected = loop_hessian(X[b], y[b], w[b])
+        result = logistic_regression_hessian_with_respect_to_w(X[b], y[b], w[b])
+        assert result.shape == expected.shape
+        assert_close(result, expected)
+        assert_close(batched[b].numpy(), expected)
+
+
+def test_mixed_derivatives(tasks):
+    X, y, w, _ = tasks
+    batched = batched_logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X(
+        torch.from_numpy(X), torch.from_numpy(y), torch.from_numpy(w))
+    for b in range(N_BATCH):
+        expected = loop_mixed_derivatives(X[b], y[b], w[b])
+        result = logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X(X[b], y[b], w[b])
+        assert result.shape == expected.shape
+        assert_close(result, expected)
+        assert_close(batched[b].numpy(), expected)
+
+
+def test_mixed_derivatives_left_multiply(tasks):
+    X, y, w, a = tasks
+    batched = batched_logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X_left_multiply(
+        torch.from_numpy(X), torch.from_numpy(y), torch.from_numpy(w), torch.from_numpy(a))
+    for b in range(N_BATCH):
+        expected = loop_mixed_derivatives_left_multiply(X[b], y[b], w[b], a[b].reshape(-1, 1))
+        result = logistic_regression_mixed_derivatives_with_respect_to_w_then_to_X_left_multiply(
+            X[b], y[b], w[b], a[b].reshape(-1, 1))
+        assert result.shape == expected.shape
+        assert_close(result, expected)
+        assert_close(batched[b].numpy(), expected)
+        # the left product is a^T times the full mixed partial matrix
+        assert_close(result, np.matmul(a[b], loop_mixed_derivatives(X[b], y[b], w[b])))